@@ -0,0 +1,32 @@
+"""add_incident_history_summary
+
+Revision ID: b41d7e2a9c05
+Revises: 7053c17081fa
+Create Date: 2026-10-18 10:12:41.318204
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'b41d7e2a9c05'
+down_revision: Union[str, Sequence[str], None] = '7053c17081fa'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Add rolling history summary columns to incident."""
+    with op.batch_alter_table('incident', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('history_summary', sa.String(), nullable=True))
+        batch_op.add_column(sa.Column('summary_upto_id', sa.Integer(), nullable=True))
+
+
+def downgrade() -> None:
+    """Drop rolling history summary columns."""
+    with op.batch_alter_table('incident', schema=None) as batch_op:
+        batch_op.drop_column('summary_upto_id')
+        batch_op.drop_column('history_summary')
@@ -0,0 +1,60 @@
+"""add_ai_usage_ledger
+
+Revision ID: c83e5f1d2a67
+Revises: b41d7e2a9c05
+Create Date: 2026-10-18 11:02:17.554310
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'c83e5f1d2a67'
+down_revision: Union[str, Sequence[str], None] = 'b41d7e2a9c05'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Create the per-call AI usage and latency ledger."""
+    op.create_table(
+        'ai_usage',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('created_at', sa.DateTime(), nullable=False),
+        sa.Column('incident_id', sa.Integer(), nullable=True),
+        sa.Column('user_id', sa.Integer(), nullable=True),
+        sa.Column('scenario_id', sa.Integer(), nullable=True),
+        sa.Column('kind', sa.String(), nullable=False),
+        sa.Column('model', sa.String(), nullable=False),
+        sa.Column('input_tokens', sa.Integer(), nullable=False),
+        sa.Column('output_tokens', sa.Integer(), nullable=False),
+        sa.Column('cache_read_tokens', sa.Integer(), nullable=False),
+        sa.Column('cache_creation_tokens', sa.Integer(), nullable=False),
+        sa.Column('ai_latency_ms', sa.Integer(), nullable=False),
+        sa.Column('queue_wait_ms', sa.Integer(), nullable=False),
+        sa.Column('retries', sa.Integer(), nullable=False),
+        sa.Column('degraded', sa.Boolean(), nullable=False),
+        sa.Column('prefetched', sa.Boolean(), nullable=False),
+        sa.ForeignKeyConstraint(['incident_id'], ['incident.id'], ondelete='SET NULL'),
+        sa.ForeignKeyConstraint(['user_id'], ['app_user.id'], ondelete='SET NULL'),
+        sa.ForeignKeyConstraint(['scenario_id'], ['scenario.id'], ondelete='SET NULL'),
+        sa.PrimaryKeyConstraint('id'),
+    )
+    with op.batch_alter_table('ai_usage', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_ai_usage_created_at'), ['created_at'], unique=False)
+        batch_op.create_index(batch_op.f('ix_ai_usage_incident_id'), ['incident_id'], unique=False)
+        batch_op.create_index(batch_op.f('ix_ai_usage_user_id'), ['user_id'], unique=False)
+        batch_op.create_index(batch_op.f('ix_ai_usage_scenario_id'), ['scenario_id'], unique=False)
+
+
+def downgrade() -> None:
+    """Drop the AI usage ledger."""
+    with op.batch_alter_table('ai_usage', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_ai_usage_scenario_id'))
+        batch_op.drop_index(batch_op.f('ix_ai_usage_user_id'))
+        batch_op.drop_index(batch_op.f('ix_ai_usage_incident_id'))
+        batch_op.drop_index(batch_op.f('ix_ai_usage_created_at'))
+    op.drop_table('ai_usage')
@@ -0,0 +1,33 @@
+"""add_rate_limit_table
+
+Revision ID: e5a19c4d7b38
+Revises: c83e5f1d2a67
+Create Date: 2026-10-18 16:41:05.218734
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'e5a19c4d7b38'
+down_revision: Union[str, Sequence[str], None] = 'c83e5f1d2a67'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Create the shared rate-limit state table."""
+    op.create_table(
+        'rate_limit',
+        sa.Column('key', sa.String(), nullable=False),
+        sa.Column('tat', sa.Float(), nullable=False),
+        sa.PrimaryKeyConstraint('key'),
+    )
+
+
+def downgrade() -> None:
+    """Drop the shared rate-limit state table."""
+    op.drop_table('rate_limit')
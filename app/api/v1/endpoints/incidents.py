@@ -1,10 +1,11 @@
 from datetime import datetime, timezone
 from typing import List
 
-from fastapi import APIRouter, Depends, HTTPException, Query
+from fastapi import APIRouter, BackgroundTasks, Depends, HTTPException, Query
 from sqlalchemy import update as sa_update
 from sqlmodel import Session, select
 
+from app.core.config import settings
 from app.core.deps import get_current_user
 from app.db.session import get_session
 from app.models.incident import CallStatus, ChatMessage, Incident
@@ -12,6 +13,7 @@ from app.models.scenario import Scenario
 from app.models.user import User
 from app.schemas.incident import IncidentCreate
 from app.schemas.simulation import TranscriptMessage
+from app.services.simulation_service import caller_profile, forget_call, prefetch_opening_line
 
 router = APIRouter()
 
@@ -19,10 +21,12 @@ router = APIRouter()
 @router.post("/incidents", response_model=Incident, status_code=201)
 def create_incident(
     payload: IncidentCreate,
+    background_tasks: BackgroundTasks,
     session: Session = Depends(get_session),
     current_user: User = Depends(get_current_user),
 ):
     now = datetime.now(timezone.utc)
+    scenario = None
     if payload.scenario_id:
         scenario = session.get(Scenario, payload.scenario_id)
         if not scenario:
@@ -52,9 +56,16 @@ def create_incident(
             call_status=CallStatus.EN_CURS,
             call_start_at=now,
         )
+    profile = caller_profile(incident, scenario)
     session.add(incident)
     session.commit()
     session.refresh(incident)
+    if settings.AI_PREFETCH_OPENING_LINE:
+        # La primera frase de l'alertant es genera mentre l'operador encara no ha parlat
+        background_tasks.add_task(
+            prefetch_opening_line, incident.id, incident.priority, profile, payload.lang,
+            user_id=incident.creator_id, scenario_id=incident.scenario_id,
+        )
     return incident
 
 
@@ -89,6 +100,7 @@ def delete_incident(
     incident = session.get(Incident, incident_id)
     if not incident:
         raise HTTPException(status_code=404, detail="Incidència no trobada")
+    forget_call(incident_id)
     session.delete(incident)
     session.commit()
 
@@ -106,6 +118,7 @@ def end_call(
     if incident.call_status == CallStatus.FINALITZADA:
         raise HTTPException(status_code=409, detail="La trucada ja està finalitzada")
 
+    forget_call(incident_id)
     session.execute(
         sa_update(Incident)
         .where(Incident.id == incident_id)
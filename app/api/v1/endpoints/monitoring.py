@@ -0,0 +1,123 @@
+import math
+from collections import defaultdict
+from datetime import datetime
+from typing import List, Optional
+
+from fastapi import APIRouter, Depends, Query
+from sqlalchemy import case, func
+from sqlmodel import Session, select
+
+from app.core import rate_limit
+from app.core.deps import auth_cache_snapshot, require_role
+from app.db.session import get_session
+from app.models.ai_usage import AIUsageRecord
+from app.models.user import User, UserRole
+from app.schemas.monitoring import UsageAggregate, UsageGroupBy
+from app.services import http_clients, usage_ledger, voice_service
+from app.services.ai_service import ai_status
+from app.services.simulation_service import call_states_snapshot, speculation_snapshot
+from app.services.tts_cache import tts_cache
+
+router = APIRouter(prefix="/monitoring", tags=["monitoring"])
+
+
+@router.get("/status")
+def monitoring_status(
+    _: User = Depends(require_role(UserRole.ADMIN, UserRole.FORMADOR)),
+):
+    """Estat intern per procés: circuit breaker i latències de la IA, salut dels proveïdors de veu."""
+    return {
+        "ai": ai_status(),
+        "call_states": call_states_snapshot(),
+        "speculation": speculation_snapshot(),
+        "usage_ledger": usage_ledger.snapshot(),
+        "tts_cache": tts_cache.snapshot(),
+        "providers": http_clients.provider_status(),
+        "transcriptions": voice_service.transcripts_snapshot(),
+        "presynthesis": voice_service.presynth_snapshot(),
+        "rate_limit": rate_limit.snapshot(),
+        "auth_cache": auth_cache_snapshot(),
+    }
+
+
+def _percentile(values: list[int], p: float) -> Optional[int]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[max(1, math.ceil(p / 100 * len(ordered))) - 1]
+
+
+@router.get("/usage", response_model=List[UsageAggregate])
+def usage_aggregates(
+    group_by: UsageGroupBy = Query("day"),
+    since: Optional[datetime] = Query(None),
+    until: Optional[datetime] = Query(None),
+    session: Session = Depends(get_session),
+    _: User = Depends(require_role(UserRole.ADMIN, UserRole.FORMADOR)),
+):
+    """Tokens i latència de la IA agregats per usuari, escenari o dia."""
+    key_col = {
+        "user":     AIUsageRecord.user_id,
+        "scenario": AIUsageRecord.scenario_id,
+        "day":      func.date(AIUsageRecord.created_at),
+    }[group_by]
+
+    filters = []
+    if since is not None:
+        filters.append(AIUsageRecord.created_at >= since)
+    if until is not None:
+        filters.append(AIUsageRecord.created_at < until)
+
+    is_turn = AIUsageRecord.kind == "turn"
+    totals = session.exec(
+        select(
+            key_col,
+            func.count(AIUsageRecord.id),
+            func.sum(case((is_turn, 1), else_=0)),
+            func.sum(case((AIUsageRecord.kind == "summary", 1), else_=0)),
+            func.sum(case((AIUsageRecord.kind == "speculation", 1), else_=0)),
+            func.sum(case((AIUsageRecord.kind == "prefetch", 1), else_=0)),
+            func.sum(AIUsageRecord.input_tokens),
+            func.sum(AIUsageRecord.output_tokens),
+            func.sum(AIUsageRecord.cache_read_tokens),
+            func.sum(AIUsageRecord.cache_creation_tokens),
+            func.sum(AIUsageRecord.retries),
+            func.sum(case((AIUsageRecord.degraded, 1), else_=0)),
+        )
+        .where(*filters)
+        .group_by(key_col)
+        .order_by(key_col)
+    ).all()
+
+    # Els percentils no són portables en SQL (SQLite): es calculen aquí només
+    # amb les dues columnes de latència dels torns
+    latencies: dict = defaultdict(lambda: ([], []))
+    for key, ai_ms, queue_ms in session.exec(
+        select(key_col, AIUsageRecord.ai_latency_ms, AIUsageRecord.queue_wait_ms)
+        .where(is_turn, AIUsageRecord.prefetched.is_(False), *filters)
+    ).all():
+        latencies[key][0].append(ai_ms)
+        latencies[key][1].append(queue_ms)
+
+    result = []
+    for (key, calls, turns, summaries, speculations, prefetches,
+         inp, out, cache_read, cache_creation, retries, degraded) in totals:
+        ai_ms, queue_ms = latencies.get(key, ([], []))
+        result.append(UsageAggregate(
+            key=None if key is None else str(key),
+            calls=calls,
+            turns=turns or 0,
+            summaries=summaries or 0,
+            speculations=speculations or 0,
+            prefetches=prefetches or 0,
+            input_tokens=inp or 0,
+            output_tokens=out or 0,
+            cache_read_tokens=cache_read or 0,
+            cache_creation_tokens=cache_creation or 0,
+            retries=retries or 0,
+            degraded=degraded or 0,
+            p50_ai_latency_ms=_percentile(ai_ms, 50),
+            p95_ai_latency_ms=_percentile(ai_ms, 95),
+            p95_queue_wait_ms=_percentile(queue_ms, 95),
+        ))
+    return result
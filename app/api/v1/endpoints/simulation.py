@@ -1,16 +1,28 @@
+import asyncio
+import base64
+import hashlib
+import json
 import logging
 import re
 
-from fastapi import APIRouter, Depends, HTTPException
-from sqlmodel import Session, select
+from fastapi import APIRouter, Depends, Header, HTTPException, Query, WebSocket, WebSocketDisconnect, status
+from fastapi.responses import StreamingResponse
+from pydantic import ValidationError
+from sqlmodel import Session
 
-from app.core.deps import get_current_user
-from app.core.rate_limit import chat_limiter
-from app.db.session import get_session
-from app.models.incident import CallStatus, ChatMessage, Incident
+from app.core.cache import LRUCache
+from app.core.config import settings
+from app.core.deps import authenticate_token, get_current_user
+from app.core.rate_limit import chat_limiter, speculate_limiter, transcribe_limiter, tts_limiter
+from app.db.session import engine
+from app.models.incident import CallStatus, Incident
 from app.models.user import User
-from app.schemas.simulation import ChatRequest, ChatResponse
-from app.services.simulation_service import process_chat
+from app.schemas.simulation import ChatRequest, ChatResponse, SpeculateResponse
+from app.services import voice_service
+from app.services.voice_service import SpeechPipeline
+from app.services.simulation_service import (
+    CallState, acquire_turn, load_call_state, process_chat, release_turn, speculate,
+)
 
 router = APIRouter()
 logger = logging.getLogger(__name__)
@@ -19,12 +31,68 @@ _WORD_RE = re.compile(r'\w{2,}', re.UNICODE)
 _MIN_REAL_WORDS = 2
 
 
-@router.post("/simulate/chat", response_model=ChatResponse)
-def chat(
-    request: ChatRequest,
-    session: Session = Depends(get_session),
-    current_user: User = Depends(get_current_user),
-):
+# Respostes ja servides per (usuari, Idempotency-Key): un reintent les rep de nou
+_replies: LRUCache[tuple[str, ChatResponse]] = LRUCache(
+    settings.IDEMPOTENCY_CACHE_SIZE, ttl=settings.IDEMPOTENCY_TTL_SECONDS,
+)
+
+
+def _sse(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+def _fingerprint(request: ChatRequest) -> str:
+    return hashlib.sha256(request.model_dump_json().encode()).hexdigest()
+
+
+def _replay(request: ChatRequest, current_user: User, key: str | None) -> ChatResponse | None:
+    """Resposta desada per a aquesta Idempotency-Key, si n'hi ha."""
+    if key is None:
+        return None
+    stored = _replies.get((current_user.id, key))
+    if stored is None:
+        return None
+    fingerprint, response = stored
+    if fingerprint != _fingerprint(request):
+        raise HTTPException(status_code=422, detail="Idempotency-Key reutilitzada amb una petició diferent")
+    logger.debug("Replaying stored chat response (incident_id=%s)", request.incident_id)
+    return response
+
+
+def _remember(request: ChatRequest, current_user: User, key: str | None, response: ChatResponse) -> None:
+    if key is not None:
+        _replies.set((current_user.id, key), (_fingerprint(request), response))
+
+
+async def _start_turn(
+    request: ChatRequest, current_user: User, key: str | None,
+) -> tuple[tuple[Incident, CallState] | None, ChatResponse | None]:
+    """Ocupa el torn de l'incident i valida la petició.
+
+    Retorna ((incident, estat), None) amb el torn ocupat, o (None, resposta) si
+    és un reintent d'una petició ja servida (sense ocupar el torn). Un
+    silent_trigger mentre hi ha un torn en curs es rebutja amb 409 en lloc d'esperar.
+    """
+    if (replayed := _replay(request, current_user, key)) is not None:
+        return None, replayed
+    await acquire_turn(request.incident_id, wait=not request.silent_trigger)
+    try:
+        # Un duplicat concurrent pot haver acabat mentre esperàvem el torn
+        if (replayed := _replay(request, current_user, key)) is not None:
+            release_turn(request.incident_id)
+            return None, replayed
+        return await asyncio.to_thread(_check_turn, request, current_user), None
+    except BaseException:
+        release_turn(request.incident_id)
+        raise
+
+
+def _check_turn(request: ChatRequest, current_user: User) -> tuple[Incident, CallState]:
+    """Validacions comunes abans d'executar un torn; retorna l'incident en curs i el seu estat.
+
+    S'executa en un fil amb una sessió pròpia que es tanca abans de cridar el
+    model: cap connexió del pool queda ocupada mentre es genera la resposta.
+    """
     if not request.silent_trigger:
         chat_limiter.check(str(current_user.id))
         # Descartar missatges amb menys de 2 paraules reals (soroll transcrit)
@@ -32,31 +100,356 @@ def chat(
         if len(real_words) < _MIN_REAL_WORDS:
             logger.debug("Chat rejected (noise, %d words): %r", len(real_words), request.operator_message)
             raise HTTPException(status_code=422, detail="Missatge massa curt o sense contingut")
-    else:
-        # Validate silent_trigger: only allowed if last message is from assistant
-        last_msg = session.exec(
-            select(ChatMessage)
-            .where(ChatMessage.incident_id == request.incident_id)
-            .order_by(ChatMessage.timestamp.desc())  # type: ignore[union-attr]
-        ).first()
-        if last_msg and last_msg.role != "assistant":
-            raise HTTPException(status_code=409, detail="silent_trigger requereix que l'últim missatge sigui de l'assistant")
-
-    incident = session.get(Incident, request.incident_id)
-    if not incident:
-        raise HTTPException(status_code=404, detail="Incidència no trobada")
-    if incident.call_status != CallStatus.EN_CURS:
-        raise HTTPException(
-            status_code=409,
-            detail="La trucada no està en curs" if incident.call_status == CallStatus.ESPERANT
-                   else "La trucada ja ha estat finalitzada",
-        )
+
+    with Session(engine) as session:
+        incident = session.get(Incident, request.incident_id)
+        if not incident:
+            raise HTTPException(status_code=404, detail="Incidència no trobada")
+        if incident.call_status != CallStatus.EN_CURS:
+            raise HTTPException(
+                status_code=409,
+                detail="La trucada no està en curs" if incident.call_status == CallStatus.ESPERANT
+                       else "La trucada ja ha estat finalitzada",
+            )
+        state = load_call_state(incident, session)
+    # silent_trigger només és vàlid si l'últim missatge és de l'assistant
+    if request.silent_trigger and state.last_role is not None and state.last_role != "assistant":
+        raise HTTPException(status_code=409, detail="silent_trigger requereix que l'últim missatge sigui de l'assistant")
+    return incident, state
+
+
+def _speech_for(state: CallState) -> SpeechPipeline:
+    """Síntesi per frases amb la veu de l'alertant d'aquesta trucada."""
+    return SpeechPipeline(state.voice, settings.TTS_PIPELINE_MAX_PARALLEL)
+
+
+@router.post("/simulate/chat", response_model=ChatResponse)
+async def chat(
+    request: ChatRequest,
+    current_user: User = Depends(get_current_user),
+    idempotency_key: str | None = Header(None, max_length=255),
+):
+    call, replayed = await _start_turn(request, current_user, idempotency_key)
+    if replayed is not None:
+        return replayed
+    incident, state = call
 
     try:
-        reply, voice, call_ended = process_chat(request, incident, session)
+        reply, voice, call_ended = await process_chat(request, incident, state)
+    except HTTPException:
+        raise
     except Exception as exc:
         logger.exception("Error en process_chat (incident_id=%s): %s", request.incident_id, exc)
         err_type = type(exc).__name__
         raise HTTPException(status_code=502, detail=f"Simulació no disponible ({err_type})")
+    finally:
+        release_turn(request.incident_id)
+
+    response = ChatResponse(content=reply, voice=voice, call_ended=call_ended)
+    _remember(request, current_user, idempotency_key, response)
+    return response
+
+
+@router.post("/simulate/chat/stream")
+async def chat_stream(
+    request: ChatRequest,
+    speak: bool = Query(False),
+    current_user: User = Depends(get_current_user),
+    idempotency_key: str | None = Header(None, max_length=255),
+):
+    """Com /simulate/chat però envia la resposta per Server-Sent Events.
+
+    Esdeveniments: `delta` ({"text"}) per cada fragment, `done` (ChatResponse)
+    quan els missatges ja s'han persistit, o `error` ({"status", "detail"}).
+    No es persisteix res abans que la resposta sigui completa: si el client es
+    desconnecta mentre es genera, el torn no es desa (si ja s'estava desant,
+    l'escriptura acaba igualment).
+    Un reintent amb la mateixa Idempotency-Key rep només l'esdeveniment `done`.
+
+    Amb `speak=true` cada frase es sintetitza tan aviat com és completa i
+    s'envia en ordre com a `audio` ({"index", "text", "audio": MP3 en base64}),
+    acabant amb `audio_end`.
+    """
+    headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    if speak:
+        await tts_limiter.acheck(str(current_user.id))
+    call, replayed = await _start_turn(request, current_user, idempotency_key)
+    if replayed is not None:
+        return StreamingResponse(
+            iter([_sse("done", replayed.model_dump())]), media_type="text/event-stream", headers=headers,
+        )
+    incident, state = call
+    try:
+        speech = _speech_for(state) if speak else None
+    except BaseException:
+        release_turn(request.incident_id)
+        raise
+    queue: asyncio.Queue[str | None] = asyncio.Queue()
+
+    async def on_delta(text: str) -> None:
+        await queue.put(_sse("delta", {"text": text}))
+        if speech is not None:
+            speech.feed(text)
+
+    async def send_audio() -> None:
+        try:
+            index = 0
+            async for sentence, audio in speech.segments():
+                await queue.put(_sse("audio", {
+                    "index": index, "text": sentence, "audio": base64.b64encode(audio).decode(),
+                }))
+                index += 1
+            await queue.put(_sse("audio_end", {}))
+        except HTTPException as exc:
+            await queue.put(_sse("error", {"status": exc.status_code, "detail": exc.detail}))
+
+    async def run_turn() -> None:
+        speaker = asyncio.create_task(send_audio()) if speech is not None else None
+        try:
+            try:
+                reply, voice, call_ended = await process_chat(request, incident, state, on_delta=on_delta)
+            finally:
+                release_turn(request.incident_id)
+            done = ChatResponse(content=reply, voice=voice, call_ended=call_ended)
+            _remember(request, current_user, idempotency_key, done)
+            await queue.put(_sse("done", done.model_dump()))
+            if speaker is not None:
+                speech.close()
+                await speaker
+        except HTTPException as exc:
+            await queue.put(_sse("error", {
+                "status": exc.status_code, "detail": exc.detail, "retry_after": (exc.headers or {}).get("Retry-After"),
+            }))
+        except Exception as exc:
+            logger.exception("Error en process_chat stream (incident_id=%s)", request.incident_id)
+            await queue.put(_sse("error", {"status": 502, "detail": f"Simulació no disponible ({type(exc).__name__})"}))
+        finally:
+            if speaker is not None and not speaker.done():
+                speech.cancel()
+                speaker.cancel()
+            await queue.put(None)
+
+    # La tasca es crea aquí (no dins del generador) perquè alliberi el torn
+    # encara que la resposta no s'arribi a consumir
+    task = asyncio.create_task(run_turn())
+
+    async def events():
+        try:
+            while (item := await queue.get()) is not None:
+                yield item
+        finally:
+            if not task.done():
+                task.cancel()
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers=headers)
+
+
+def _read_call(request: ChatRequest, current_user: User) -> tuple[Incident, CallState] | None:
+    """Incident i estat d'una trucada en curs per especular (en un fil, sessió pròpia)."""
+    speculate_limiter.check(str(current_user.id))
+    with Session(engine) as session:
+        incident = session.get(Incident, request.incident_id)
+        if not incident:
+            raise HTTPException(status_code=404, detail="Incidència no trobada")
+        if incident.call_status != CallStatus.EN_CURS:
+            return None
+        return incident, load_call_state(incident, session)
+
+
+async def _speculate(request: ChatRequest, current_user: User) -> bool:
+    """Comença la resposta a partir d'una transcripció parcial, si escau."""
+    if not settings.AI_SPECULATIVE_REPLIES:
+        return False   # ni BD ni límit consumit si la funció està desactivada
+    call = await asyncio.to_thread(_read_call, request, current_user)
+    if call is None:
+        return False
+    return speculate(*call, request.operator_message, request.lang)
+
+
+@router.post("/simulate/chat/speculate", response_model=SpeculateResponse, status_code=202)
+async def chat_speculate(
+    request: ChatRequest,
+    current_user: User = Depends(get_current_user),
+):
+    """Transcripció parcial del torn que l'operador encara està dient.
+
+    Amb AI_SPECULATIVE_REPLIES activat es comença a generar la resposta de
+    l'alertant. El /simulate/chat següent la fa servir si el text final diu el
+    mateix; si no, es descarta i el torn es genera com sempre.
+    """
+    return SpeculateResponse(speculating=await _speculate(request, current_user))
+
+
+# ── Sessió de trucada per WebSocket ─────────────────────────────────────────
+# Protocol (JSON en frames de text, àudio en frames binaris):
+#   client → {"type": "start", "token", "lang"}   primer missatge (autenticació)
+#            <binari>                              fragments d'àudio WebM del torn
+#            {"type": "end_of_utterance"}          transcriu l'àudio acumulat i fa el torn
+#            {"type": "text", "text"}              torn escrit (sense transcripció)
+#            {"type": "silence"}                   equivalent a silent_trigger
+#            {"type": "partial", "text"}           transcripció parcial: resposta especulativa
+#                                                  (sense resposta; vegeu /simulate/chat/speculate)
+#   servidor → {"type": "ready", "incident_id"}
+#              {"type": "transcript", "text"}      "" si era soroll (no hi ha torn)
+#              {"type": "delta", "text"}           fragments de la resposta
+#              {"type": "audio", "index", "text"}  el següent frame binari és l'MP3
+#                                                  d'aquesta frase (en ordre, mentre es genera)
+#              {"type": "reply", ...ChatResponse}  missatges ja persistits
+#              {"type": "audio_end"}               ja s'ha enviat tot l'àudio del torn
+#              {"type": "error", "status", "detail"}
+#                                                  (413: l'àudio del torn supera el límit; la resta
+#                                                  del torn es descarta fins a end_of_utterance)
+# La connexió es tanca quan la trucada finalitza.
+
+_WS_AUTH_TIMEOUT = 10.0
+
+
+async def _ws_turn(websocket: WebSocket, user: User, request: ChatRequest) -> ChatResponse:
+    """Executa un torn i n'envia els esdeveniments i l'àudio; en retorna la resposta.
+
+    L'àudio es sintetitza frase a frase mentre la resposta encara es genera.
+    """
+    await tts_limiter.acheck(str(user.id))
+    (incident, state), _ = await _start_turn(request, user, None)
+    try:
+        speech = _speech_for(state)
+    except BaseException:
+        release_turn(request.incident_id)
+        raise
+
+    async def on_delta(text: str) -> None:
+        await websocket.send_json({"type": "delta", "text": text})
+        speech.feed(text)
+
+    async def send_audio() -> None:
+        index = 0
+        async for sentence, audio in speech.segments():
+            await websocket.send_json({"type": "audio", "index": index, "text": sentence})
+            await websocket.send_bytes(audio)
+            index += 1
+
+    speaker = asyncio.create_task(send_audio())
+    try:
+        try:
+            reply, voice, call_ended = await process_chat(request, incident, state, on_delta=on_delta)
+        finally:
+            release_turn(request.incident_id)
+        speech.close()
+        response = ChatResponse(content=reply, voice=voice, call_ended=call_ended)
+        await websocket.send_json({"type": "reply", **response.model_dump()})
+        await speaker
+    finally:
+        if not speaker.done():
+            speech.cancel()
+            speaker.cancel()
+    await websocket.send_json({"type": "audio_end"})
+    return response
+
+
+def _ws_open(token: str, incident_id: int) -> tuple[User, bool]:
+    """Autentica la connexió i diu si la trucada és en curs (en un fil, sessió curta)."""
+    with Session(engine) as session:
+        user = authenticate_token(token, session)
+        incident = session.get(Incident, incident_id)
+        return user, incident is not None and incident.call_status == CallStatus.EN_CURS
+
+
+@router.websocket("/simulate/call/{incident_id}")
+async def call_session(websocket: WebSocket, incident_id: int):
+    """Trucada de veu sencera per un sol socket: transcripció → alertant → síntesi.
+
+    L'autenticació es fa un cop per connexió, no per torn. La connexió no
+    reté cap sessió de BD: cada torn llegeix i escriu amb sessions curtes, i
+    entre torns no queda cap connexió del pool ocupada.
+    """
+    await websocket.accept()
+    try:
+        start = await asyncio.wait_for(websocket.receive_json(), timeout=_WS_AUTH_TIMEOUT)
+        if not isinstance(start, dict) or start.get("type") != "start":
+            raise ValueError
+        user, in_progress = await asyncio.to_thread(_ws_open, str(start.get("token", "")), incident_id)
+    except (asyncio.TimeoutError, ValueError, HTTPException):
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION, reason="Autenticació requerida")
+        return
+    except WebSocketDisconnect:
+        return
+    lang = str(start.get("lang") or "ca")
+
+    if not in_progress:
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION, reason="La trucada no està en curs")
+        return
+    await websocket.send_json({"type": "ready", "incident_id": incident_id})
+
+    audio = bytearray()
+    discarding = False   # el torn en curs ha superat el límit: se'n descarta la resta
+    try:
+        while True:
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                return
+            if message.get("bytes") is not None:
+                if discarding:
+                    continue
+                audio += message["bytes"]
+                if len(audio) > voice_service.MAX_AUDIO_BYTES:
+                    audio.clear()
+                    discarding = True
+                    await websocket.send_json({
+                        "type": "error", "status": 413, "detail": voice_service.AUDIO_TOO_LARGE,
+                    })
+                continue
+
+            try:
+                event = json.loads(message.get("text") or "")
+            except json.JSONDecodeError:
+                event = None
+            kind = event.get("type") if isinstance(event, dict) else None
+            try:
+                if kind == "end_of_utterance" and discarding:
+                    # Fi del torn massa llarg: ja s'ha notificat amb el 413
+                    discarding = False
+                    continue
+                if kind == "end_of_utterance":
+                    utterance, audio = bytes(audio), bytearray()
+                    key = voice_service.transcription_key(utterance, lang)
+                    text = voice_service.cached_transcription(key)
+                    if text is None:
+                        info = voice_service.check_audio(utterance)
+                        await transcribe_limiter.acheck(str(user.id))
+                        text = await voice_service.transcribe(utterance, lang, key=key, info=info)
+                    await websocket.send_json({"type": "transcript", "text": text})
+                    if not text:
+                        continue
+                    request = ChatRequest(incident_id=incident_id, operator_message=text, lang=lang)
+                elif kind == "text":
+                    request = ChatRequest(incident_id=incident_id, operator_message=str(event.get("text", "")), lang=lang)
+                elif kind == "silence":
+                    request = ChatRequest(incident_id=incident_id, silent_trigger=True, lang=lang)
+                elif kind == "partial":
+                    request = ChatRequest(incident_id=incident_id, operator_message=str(event.get("text", "")), lang=lang)
+                    try:
+                        await _speculate(request, user)
+                    except HTTPException:
+                        pass  # és una optimització: no es notifica
+                    continue
+                else:
+                    await websocket.send_json({"type": "error", "status": 400, "detail": "Missatge desconegut"})
+                    continue
 
-    return ChatResponse(content=reply, voice=voice, call_ended=call_ended)
+                response = await _ws_turn(websocket, user, request)
+                if response.call_ended:
+                    await websocket.close()
+                    return
+            except HTTPException as exc:
+                await websocket.send_json({"type": "error", "status": exc.status_code, "detail": exc.detail})
+            except ValidationError:
+                await websocket.send_json({"type": "error", "status": 422, "detail": "Missatge massa llarg"})
+            except WebSocketDisconnect:
+                raise
+            except Exception as exc:
+                logger.exception("Error en el torn de la trucada per WebSocket (incident_id=%s)", incident_id)
+                await websocket.send_json({
+                    "type": "error", "status": 502, "detail": f"Simulació no disponible ({type(exc).__name__})",
+                })
+    except WebSocketDisconnect:
+        logger.debug("Call WebSocket closed by client (incident_id=%s)", incident_id)
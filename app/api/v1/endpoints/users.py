@@ -3,7 +3,7 @@ from typing import List
 from fastapi import APIRouter, Depends, HTTPException, Query, status
 from sqlmodel import Session, select
 
-from app.core.deps import require_role
+from app.core.deps import forget_user, require_role
 from app.core.security import hash_password
 from app.db.session import get_session
 from app.models.user import User, UserRole
@@ -69,5 +69,6 @@ def update_user(
         setattr(user, field, value)
     session.add(user)
     session.commit()
+    forget_user(user.id)
     session.refresh(user)
     return user
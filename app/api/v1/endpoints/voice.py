@@ -1,105 +1,94 @@
-import logging
-import re
+from collections.abc import AsyncIterator
 
-from fastapi import APIRouter, Depends, File, HTTPException, Query, UploadFile
-from fastapi.responses import Response
+from fastapi import APIRouter, Depends, HTTPException, Query, Request
+from fastapi.responses import FileResponse, Response, StreamingResponse
 from pydantic import BaseModel
+from starlette.datastructures import UploadFile
+from starlette.formparsers import MultiPartException, MultiPartParser
 
-import httpx
-
-from app.core.config import settings
-from app.core.constants import EL_DEFAULT_SETTINGS, EL_TO_OAI_VOICE, EL_VOICE_SETTINGS
 from app.core.deps import get_current_user
 from app.core.rate_limit import transcribe_limiter, tts_limiter
 from app.models.user import User
+from app.services import voice_service
+from app.services.tts_cache import is_valid_key
 
-logger = logging.getLogger(__name__)
 router = APIRouter(prefix="/voice", tags=["voice"])
 
-# Palabras sueltas que Whisper alucina — match exacto (evita falsos positivos con substring)
-_HALLUCINATION_EXACT = {
-    "amara.org", "amara", "subtítulos", "subtitulado", "subtitles",
-    "transcripción", "transcription", "sous-titres", "sous titres",
-    "suscríbete", "subscribe",
-    "you", "thank you", "thanks", "bye", "goodbye", "okay", "ok",
-    "gràcies", "gracias", "merci", "adiós", "adéu", "vale",
-    "...", "…", "eh", "ah", "oh", "um", "hm", "hmm", "mm",
-    "sí", "si", "no", "ja", "oui", "yes",
-    "música", "music", "aplausos", "risas", "silencio",
-}
-# Frases más largas — match por substring
-_HALLUCINATION_SUBSTR = {
-    "thank you for watching", "thanks for watching", "gràcies per veure",
-    "gracias por ver", "subtitulado por", "sous-titres par",
-    "antarctica films", "cc por", "copyright", "todos los derechos",
-    "all rights reserved", "tots els drets",
+# L'àudio d'una clau no canvia mai, però només es serveix autenticat: el pot
+# guardar el navegador de l'usuari, no cap memòria cau compartida.
+# Content-Encoding: identity evita que GZip comprimeixi l'MP3 (i trenqui Range).
+_AUDIO_HEADERS = {
+    "Cache-Control": "private, max-age=31536000, immutable",
+    "Content-Encoding": "identity",
 }
-_MIN_TRANSCRIPTION_CHARS = 8  # mínimo de caracteres para considerar una transcripción válida
-_PUNCT_RE = re.compile(r'[^\w\s]', re.UNICODE)
-
-
-def _is_hallucination(text: str) -> bool:
-    lower = text.lower().strip()
-    # Match exacto (sin puntuación) para palabras sueltas
-    clean = _PUNCT_RE.sub('', lower).strip()
-    if clean in _HALLUCINATION_EXACT:
-        logger.debug("Whisper hallucination (exact): %r", text)
-        return True
-    # Substring match para frases largas conocidas
-    if any(h in lower for h in _HALLUCINATION_SUBSTR):
-        logger.debug("Whisper hallucination (substr): %r", text)
-        return True
-    # Texto demasiado corto → probablemente ruido
-    if len(clean) < _MIN_TRANSCRIPTION_CHARS:
-        logger.debug("Whisper hallucination (short, %d chars): %r", len(clean), text)
-        return True
-    # Repetición de palabras/frases — alucinación clásica de Whisper
-    words = clean.split()
-    if len(words) >= 3:
-        unique = set(words)
-        if len(unique) <= len(words) * 0.4:
-            logger.debug("Whisper hallucination (repetition): %r", text)
-            return True
-    return False
-
-
-@router.post("/transcribe")
-async def transcribe_audio(
-    audio: UploadFile = File(...),
-    lang: str = Query(default="ca"),
-    current_user: User = Depends(get_current_user),
-):
-    transcribe_limiter.check(str(current_user.id))
-    if not settings.DispatchSimKeyOpenAI:
-        raise HTTPException(503, "Transcription service not configured")
-
-    audio_bytes = await audio.read()
-    _MAX_AUDIO_BYTES = 5 * 1024 * 1024  # 5 MB
-    if len(audio_bytes) > _MAX_AUDIO_BYTES:
-        raise HTTPException(413, "L'arxiu d'àudio supera el límit de 5 MB")
-    # WebM/EBML magic bytes: 0x1A 0x45 0xDF 0xA3
-    if len(audio_bytes) < 4 or audio_bytes[:4] != b'\x1a\x45\xdf\xa3':
-        raise HTTPException(415, "Format d'àudio no vàlid (es requereix WebM)")
 
-    async with httpx.AsyncClient() as client:
-        response = await client.post(
-            "https://api.openai.com/v1/audio/transcriptions",
-            headers={"Authorization": f"Bearer {settings.DispatchSimKeyOpenAI}"},
-            files={"file": ("audio.webm", audio_bytes, "audio/webm")},
-            data={"model": "whisper-1", "language": lang},
-            timeout=30.0,
-        )
 
-    if response.status_code != 200:
-        raise HTTPException(502, f"Transcription failed: {response.text}")
+# Marge per a les capçaleres multipart que embolcallen el fitxer
+_MULTIPART_OVERHEAD = 16 * 1024
 
-    text = response.json().get("text", "").strip()
-    if _is_hallucination(text):
-        return {"text": ""}
-
-    return {"text": text}
+_UPLOAD_BODY = {
+    "requestBody": {
+        "required": True,
+        "content": {"multipart/form-data": {"schema": {
+            "type": "object",
+            "required": ["audio"],
+            "properties": {"audio": {"type": "string", "format": "binary"}},
+        }}},
+    },
+}
 
 
+async def _limited(stream: AsyncIterator[bytes], limit: int) -> AsyncIterator[bytes]:
+    """Talla la pujada tan bon punt supera `limit` bytes (també sense Content-Length)."""
+    received = 0
+    async for chunk in stream:
+        received += len(chunk)
+        if received > limit:
+            raise HTTPException(413, voice_service.AUDIO_TOO_LARGE)
+        yield chunk
+
+
+async def _receive_audio(request: Request) -> UploadFile:
+    """Llegeix el camp `audio` del cos multipart a mesura que arriba.
+
+    El fitxer es bolca a un temporal (en memòria fins a 1 MB) a mesura que es
+    rep, i la pujada s'interromp amb 413 si supera el límit.
+    """
+    limit = voice_service.MAX_AUDIO_BYTES + _MULTIPART_OVERHEAD
+    length = request.headers.get("content-length", "")
+    if length.isdigit() and int(length) > limit:
+        raise HTTPException(413, voice_service.AUDIO_TOO_LARGE)
+    if not request.headers.get("content-type", "").startswith("multipart/form-data"):
+        raise HTTPException(415, "Es requereix multipart/form-data")
+    parser = MultiPartParser(request.headers, _limited(request.stream(), limit), max_files=1, max_fields=1)
+    try:
+        form = await parser.parse()
+    except MultiPartException as exc:
+        raise HTTPException(400, exc.message)
+    audio = form.get("audio")
+    if not isinstance(audio, UploadFile):
+        await form.close()
+        raise HTTPException(422, "Falta el camp 'audio'")
+    return audio
+
+
+@router.post("/transcribe", openapi_extra=_UPLOAD_BODY)
+async def transcribe_audio(
+    request: Request,
+    lang: str = Query(default="ca"),
+    current_user: User = Depends(get_current_user),
+):
+    audio = await _receive_audio(request)
+    try:
+        # Un reenviament del mateix clip (xarxa inestable) no consumeix límit ni crida Whisper
+        key = voice_service.transcription_key(audio.file, lang)
+        if (text := voice_service.cached_transcription(key)) is not None:
+            return {"text": text}
+        await transcribe_limiter.acheck(str(current_user.id))
+        info = voice_service.check_audio(audio.file)
+        return {"text": await voice_service.transcribe(audio.file, lang, key=key, info=info)}
+    finally:
+        await audio.close()
 
 
 class TTSRequest(BaseModel):
@@ -107,54 +96,47 @@ class TTSRequest(BaseModel):
     voice: str = "nova"
 
 
+def _speech_headers(request: Request, key: str, source: str) -> dict[str, str]:
+    headers = {**_AUDIO_HEADERS, "ETag": f'"{key}"', "X-TTS-Cache": source}
+    # Només quan hi ha memòria cau a disc: sense, /voice/audio/{key} sempre seria 404
+    if voice_service.tts_cache.enabled:
+        headers["Content-Location"] = request.url_for("cached_audio", key=key).path
+    return headers
+
+
 @router.post("/speak")
 async def text_to_speech(
     req: TTSRequest,
+    request: Request,
+    current_user: User = Depends(get_current_user),
+):
+    # La resposta del torn ja pre-sintetitzada no torna a passar pel proveïdor
+    if (ready := await voice_service.presynthesized(req.text, req.voice)) is not None:
+        key, audio = ready
+        return Response(audio, media_type="audio/mpeg", headers=_speech_headers(request, key, "presynthesized"))
+    await tts_limiter.acheck(str(current_user.id))
+    # L'àudio del proveïdor es passa al client a mesura que arriba
+    key, chunks, hit = await voice_service.stream_speech(req.text, req.voice)
+    return StreamingResponse(
+        chunks, media_type="audio/mpeg", headers=_speech_headers(request, key, "hit" if hit else "miss"),
+    )
+
+
+@router.get("/audio/{key}", name="cached_audio")
+def cached_audio(
+    key: str,
+    request: Request,
     current_user: User = Depends(get_current_user),
 ):
-    tts_limiter.check(str(current_user.id))
-    # ElevenLabs tiene prioridad si está configurado
-    if settings.DispatchSimKeyEleven:
-        voice_settings = EL_VOICE_SETTINGS.get(req.voice, EL_DEFAULT_SETTINGS)
-        async with httpx.AsyncClient() as client:
-            el_response = await client.post(
-                f"https://api.elevenlabs.io/v1/text-to-speech/{req.voice}",
-                headers={
-                    "xi-api-key": settings.DispatchSimKeyEleven,
-                    "Content-Type": "application/json",
-                },
-                json={
-                    "text": req.text,
-                    "model_id": "eleven_multilingual_v2",
-                    "voice_settings": voice_settings,
-                },
-                timeout=60.0,
-            )
-        if el_response.status_code == 200:
-            return Response(content=el_response.content, media_type="audio/mpeg")
-        logger.error("ElevenLabs TTS error %s: %s", el_response.status_code, el_response.text[:300])
-        # Si ElevenLabs falla, intentar OpenAI como fallback
-
-    # OpenAI TTS
-    if not settings.DispatchSimKeyOpenAI:
-        raise HTTPException(503, "TTS service not configured")
-
-    _OAI_VOICES = {"alloy", "echo", "fable", "onyx", "nova", "shimmer"}
-    oai_voice = EL_TO_OAI_VOICE.get(req.voice, req.voice if req.voice in _OAI_VOICES else "nova")
-
-    async with httpx.AsyncClient() as client:
-        oai_response = await client.post(
-            "https://api.openai.com/v1/audio/speech",
-            headers={
-                "Authorization": f"Bearer {settings.DispatchSimKeyOpenAI}",
-                "Content-Type": "application/json",
-            },
-            json={"model": "tts-1-hd", "input": req.text, "voice": oai_voice},
-            timeout=60.0,
-        )
-
-    if oai_response.status_code != 200:
-        logger.error("OpenAI TTS error %s: %s", oai_response.status_code, oai_response.text[:300])
-        raise HTTPException(502, f"TTS failed: {oai_response.text}")
-
-    return Response(content=oai_response.content, media_type="audio/mpeg")
+    """Àudio ja sintetitzat, per la seva clau (reproducció amb Range i ETag).
+
+    Només serveix àudio que ja és a la memòria cau a disc, mai no crida cap proveïdor.
+    """
+    path = voice_service.tts_cache.path(key) if is_valid_key(key) else None
+    if path is None:
+        raise HTTPException(404, "Àudio no trobat")
+    etag = f'"{key}"'
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers={**_AUDIO_HEADERS, "ETag": etag})
+    return FileResponse(path, media_type="audio/mpeg", headers={**_AUDIO_HEADERS, "ETag": etag})
+
@@ -1,6 +1,8 @@
 from fastapi import APIRouter
 
-from app.api.v1.endpoints import auth, history, incidents, interventions, scenarios, simulation, users, voice
+from app.api.v1.endpoints import (
+    auth, history, incidents, interventions, monitoring, scenarios, simulation, users, voice,
+)
 
 api_router = APIRouter()
 
@@ -12,3 +14,4 @@ api_router.include_router(interventions.router)
 api_router.include_router(simulation.router, tags=["simulation"])
 api_router.include_router(history.router)
 api_router.include_router(voice.router)
+api_router.include_router(monitoring.router)
@@ -0,0 +1,119 @@
+"""
+Control d'admissió per a crides concurrents a un servei car (p. ex. la IA).
+Limita les crides simultànies, fa esperar la resta en una cua amb prioritat
+acotada i respon HTTP 503 + Retry-After quan la cua és plena.
+Pensat per a un sol event loop (per procés).
+"""
+import asyncio
+import heapq
+import itertools
+import time
+from collections.abc import AsyncIterator
+from contextlib import asynccontextmanager
+
+from fastapi import HTTPException, status
+
+from app.core.metrics import LatencyTracker
+
+# Classes de prioritat (menor = més prioritari)
+PRIORITY_OPERATOR   = 0  # torn real de l'operador
+PRIORITY_SILENCE    = 1  # reacció a silenci (silent_trigger)
+PRIORITY_BACKGROUND = 2  # feina de fons (resums, pregeneració)
+
+
+class AdmissionController:
+    def __init__(self, name: str, max_concurrent: int, max_queue: int, retry_after_seconds: int):
+        self.name         = name
+        self._max         = max_concurrent
+        self._max_queue   = max_queue
+        self._retry_after = retry_after_seconds
+        self._active      = 0
+        self._waiters: list[tuple[int, int, int, asyncio.Future]] = []
+        self._seq         = itertools.count()
+        self._admitted    = 0
+        self._rejected    = 0
+        self._max_depth   = 0
+        self.wait_times   = LatencyTracker()
+
+    @property
+    def queue_depth(self) -> int:
+        return sum(1 for *_, fut in self._waiters if not fut.done())
+
+    @asynccontextmanager
+    async def slot(self, turn_class: int = PRIORITY_OPERATOR, priority: int = 0) -> AsyncIterator[float]:
+        """Ocupa una plaça durant el bloc i en retorna el temps d'espera (s).
+
+        Entre iguals de `turn_class`, `priority` més alta passa primer.
+        """
+        wait = await self._acquire(turn_class, priority)
+        try:
+            yield wait
+        finally:
+            self._release()
+
+    def try_acquire(self) -> bool:
+        """Ocupa una plaça només si n'hi ha una de lliure i ningú no espera.
+
+        Per a feina opcional (p. ex. peticions duplicades): mai no fa cua.
+        Qui l'obté l'ha de tornar amb release().
+        """
+        if self._active < self._max and not self.queue_depth:
+            self._active += 1
+            self._admitted += 1
+            return True
+        return False
+
+    def release(self) -> None:
+        self._release()
+
+    async def _acquire(self, turn_class: int, priority: int) -> float:
+        if self._active < self._max and not self.queue_depth:
+            self._active += 1
+            self._admitted += 1
+            self.wait_times.observe(0.0)
+            return 0.0
+        if self.queue_depth >= self._max_queue:
+            self._rejected += 1
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail="Servei de simulació saturat. Torna-ho a provar d'aquí a uns segons.",
+                headers={"Retry-After": str(self._retry_after)},
+            )
+
+        fut: asyncio.Future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (turn_class, -priority, next(self._seq), fut))
+        self._max_depth = max(self._max_depth, self.queue_depth)
+        start = time.perf_counter()
+        try:
+            await fut
+        except asyncio.CancelledError:
+            # Si ja se'ns havia cedit la plaça, cal alliberar-la
+            if fut.done() and not fut.cancelled():
+                self._release()
+            raise
+        wait = time.perf_counter() - start
+        self._admitted += 1
+        self.wait_times.observe(wait)
+        return wait
+
+    def _release(self) -> None:
+        # Cedeix la plaça directament al següent de la cua (active no canvia)
+        while self._waiters:
+            *_, fut = heapq.heappop(self._waiters)
+            if not fut.done():
+                fut.set_result(None)
+                return
+        self._active -= 1
+
+    def snapshot(self) -> dict:
+        return {
+            "name": self.name,
+            "active": self._active,
+            "max_concurrent": self._max,
+            "queue_depth": self.queue_depth,
+            "max_queue": self._max_queue,
+            "max_queue_depth_seen": self._max_depth,
+            "admitted": self._admitted,
+            "rejected": self._rejected,
+            "wait": self.wait_times.snapshot(),
+        }
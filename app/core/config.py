@@ -1,3 +1,5 @@
+from typing import Literal
+
 from pydantic import ConfigDict, field_validator, model_validator
 from pydantic_settings import BaseSettings
 
@@ -19,9 +21,95 @@ class Settings(BaseSettings):
     # Admin inicial — si estan definits es crea automàticament al primer arrencada
     ADMIN_USERNAME: str = ""
     ADMIN_PASSWORD: str = ""
+    # Memòria cau d'autenticació (token i usuari) per procés; 0 = desactivada
+    AUTH_CACHE_SIZE: int = 1024
+    AUTH_CACHE_TTL_SECONDS: float = 30.0
     # Serveis
     CLEANUP_INTERVAL_SECONDS: int = 3600
     AI_MAX_TOKENS: int = 500
+    # Backend de l'alertant: "anthropic" (real) o "stub" (local, per a proves de càrrega)
+    LLM_BACKEND: Literal["anthropic", "stub"] = "anthropic"
+    AI_MODEL: str = "claude-sonnet-4-6"
+    AI_STUB_LATENCY_MS: int = 300           # temps fins al primer token
+    AI_STUB_TOKENS_PER_SECOND: float = 50.0  # 0 = sense espera entre tokens
+    AI_STUB_END_AFTER_TURNS: int = 0         # 0 = mai; N = [FI] a partir del torn N
+    AI_STUB_END_ON_GOODBYE: bool = True      # [FI] quan l'operador s'acomiada
+    # Resiliència de les crides a la IA
+    AI_MAX_RETRIES: int = 2                  # reintents per errors transitoris
+    AI_RETRY_BASE_DELAY: float = 0.5         # backoff exponencial amb jitter (s)
+    AI_RETRY_MAX_DELAY: float = 4.0
+    AI_HEDGE_PERCENTILE: float = 95.0        # petició duplicada si supera aquest percentil (0 = off)
+    AI_HEDGE_MIN_SAMPLES: int = 20           # mostres de latència mínimes abans de fer hedging
+    AI_BREAKER_FAILURE_THRESHOLD: int = 5    # errors consecutius que obren el circuit
+    AI_BREAKER_RESET_SECONDS: float = 30.0   # temps obert abans de la crida de prova
+    # Control d'admissió: crides simultànies a la IA i cua d'espera acotada
+    AI_MAX_CONCURRENCY: int = 8
+    AI_MAX_QUEUE: int = 32
+    AI_QUEUE_RETRY_AFTER: int = 5            # segons (capçalera Retry-After del 503)
+    # Finestra d'historial enviada a la IA (tokens estimats); la resta es resumeix
+    AI_HISTORY_TOKEN_BUDGET: int = 3000
+    AI_SUMMARY_MAX_TOKENS: int = 300
+    # Pregenera la resposta de l'alertant a la salutació estàndard en crear
+    # l'incident (opt-in: costa una crida encara que la trucada no s'atengui)
+    AI_PREFETCH_OPENING_LINE: bool = False
+    # Comença la resposta de l'alertant amb la transcripció parcial (opt-in)
+    AI_SPECULATIVE_REPLIES: bool = False
+    # Estat de conversa de les trucades en curs guardat en memòria (LRU)
+    CALL_STATE_CACHE_SIZE: int = 512
+    # Clients HTTP de veu (OpenAI i ElevenLabs): pool keep-alive i temps d'espera (s)
+    OPENAI_MAX_CONNECTIONS: int = 10
+    ELEVENLABS_MAX_CONNECTIONS: int = 10
+    HTTP_KEEPALIVE_EXPIRY: float = 30.0
+    HTTP_CONNECT_TIMEOUT: float = 5.0
+    VOICE_TRANSCRIBE_TIMEOUT: float = 30.0
+    VOICE_TTS_TIMEOUT: float = 60.0
+    VOICE_TTS_FIRST_BYTE_TIMEOUT: float = 10.0   # sense àudio en aquest temps → següent proveïdor
+    # Salut dels proveïdors de veu: un proveïdor amb errors se salta fins que una
+    # sonda (cada PROVIDER_PROBE_SECONDS) torna a anar bé
+    PROVIDER_HEALTH_WINDOW: int = 20
+    PROVIDER_HEALTH_MIN_SAMPLES: int = 5
+    PROVIDER_MAX_ERROR_RATE: float = 0.5
+    PROVIDER_FAILURE_THRESHOLD: int = 3      # errors seguits
+    PROVIDER_SLOW_SECONDS: float = 5.0       # primer byte més lent que això = error
+    PROVIDER_PROBE_SECONDS: float = 15.0
+    # Mida màxima d'un clip a transcriure
+    VOICE_MAX_AUDIO_MB: int = 5
+    # Durada mínima (s) d'un clip perquè valgui la pena enviar-lo a Whisper
+    VOICE_MIN_AUDIO_SECONDS: float = 0.5
+    # Clips de més d'aquests segons es tallen entre Clusters en trossos de
+    # VOICE_CHUNK_SECONDS i es transcriuen en paral·lel (0 = mai)
+    VOICE_CHUNKED_TRANSCRIPTION_SECONDS: float = 0.0
+    VOICE_CHUNK_SECONDS: float = 15.0
+    VOICE_CHUNK_MAX_PARALLEL: int = 4
+    # Transcripcions recents per hash de l'àudio (reenviaments del mateix clip)
+    TRANSCRIPTION_CACHE_SIZE: int = 256
+    TRANSCRIPTION_CACHE_TTL_SECONDS: float = 600.0
+    # Memòria cau d'àudio TTS a disc (0 = desactivada)
+    TTS_CACHE_DIR: str = "tts_cache"
+    TTS_CACHE_MAX_BYTES: int = 256 * 1024 * 1024
+    # Frases de la resposta que es sintetitzen alhora (veu per frases)
+    TTS_PIPELINE_MAX_PARALLEL: int = 2
+    # Pre-síntesi de la resposta de /simulate/chat abans que el navegador la demani (opt-in)
+    TTS_PRESYNTHESIZE: bool = False
+    TTS_PRESYNTH_CACHE_SIZE: int = 64
+    TTS_PRESYNTH_TTL_SECONDS: float = 120.0
+    # Respostes de /simulate/chat desades per Idempotency-Key (reintents)
+    IDEMPOTENCY_CACHE_SIZE: int = 2048
+    IDEMPOTENCY_TTL_SECONDS: float = 300.0
+    # Rate limiting: "memory" (per procés) o compartit entre workers ("sql" amb
+    # la BD de l'aplicació, "redis" amb RATE_LIMIT_REDIS_URL; requereix el paquet redis)
+    RATE_LIMIT_BACKEND: Literal["memory", "sql", "redis"] = "memory"
+    RATE_LIMIT_REDIS_URL: str = "redis://localhost:6379/0"
+    # Fracció del límit que un worker reserva d'un cop quan la clau va sobrada
+    RATE_LIMIT_LEASE_FRACTION: float = 0.2
+    # Caiguda del backend compartit: errors seguits que obren el circuit (es
+    # limita en memòria mentre és obert) i temps obert abans de la crida de prova
+    RATE_LIMIT_BREAKER_THRESHOLD: int = 3
+    RATE_LIMIT_BREAKER_RESET_SECONDS: float = 10.0
+    # Registre d'ús i latència de la IA (insercions en lot fora del torn)
+    AI_USAGE_FLUSH_SECONDS: float = 5.0
+    AI_USAGE_BATCH_SIZE: int = 100           # força un flush quan n'hi ha tants pendents
+    AI_USAGE_MAX_PENDING: int = 10_000       # si la BD no respon, es descarten els més antics
 
     @field_validator("DATABASE_URL", mode="before")
     @classmethod
@@ -1,4 +1,5 @@
 import logging
+import time
 from datetime import datetime, timezone
 
 from fastapi import Depends, HTTPException, status
@@ -6,19 +7,37 @@ from fastapi.security import HTTPAuthorizationCredentials, HTTPBearer
 import jwt
 from sqlmodel import Session
 
+from app.core.cache import LRUCache
+from app.core.config import settings
 from app.core.security import decode_token
-from app.db.session import get_session
+from app.db.session import engine
 from app.models.user import User, UserRole
 
 bearer_scheme = HTTPBearer()
 logger = logging.getLogger(__name__)
 
+# Memòria cau d'autenticació: token → (user_id, exp) i user_id → dades de
+# l'usuari. La majoria de peticions s'autentiquen sense decodificar el JWT ni
+# tocar la BD. update_user i la neteja d'expirats invaliden l'usuari amb
+# forget_user(); amb diversos workers la invalidació només arriba al procés
+# que fa el canvi, i la resta ho veuen en caducar l'entrada (TTL curt).
+_tokens: LRUCache[tuple[int, float]] = LRUCache(maxsize=settings.AUTH_CACHE_SIZE, ttl=settings.AUTH_CACHE_TTL_SECONDS)
+_users: LRUCache[dict] = LRUCache(maxsize=settings.AUTH_CACHE_SIZE, ttl=settings.AUTH_CACHE_TTL_SECONDS)
 
-def get_current_user(
-    credentials: HTTPAuthorizationCredentials = Depends(bearer_scheme),
-    session: Session = Depends(get_session),
-) -> User:
-    token = credentials.credentials
+
+def forget_user(user_id: int) -> None:
+    """Treu l'usuari de la memòria cau (s'ha modificat o esborrat)."""
+    _users.pop(user_id)
+
+
+def auth_cache_snapshot() -> dict:
+    return {"tokens": _tokens.snapshot(), "users": _users.snapshot()}
+
+
+def _token_user_id(token: str) -> int:
+    cached = _tokens.get(token)
+    if cached is not None and cached[1] > time.time():
+        return cached[0]
     try:
         payload = decode_token(token)
         raw = payload.get("sub")
@@ -32,8 +51,27 @@ def get_current_user(
             detail="Token invàlid o expirat",
             headers={"WWW-Authenticate": "Bearer"},
         )
+    if settings.AUTH_CACHE_TTL_SECONDS > 0:
+        # Un token sense exp no caduca mai; la memòria cau el reté com a molt el TTL
+        _tokens.set(token, (user_id, float(payload.get("exp", "inf"))))
+    return user_id
+
 
+def _load_user(user_id: int, session: Session) -> User | None:
+    data = _users.get(user_id)
+    if data is not None:
+        # Còpia fora de sessió: cada petició en té una de pròpia
+        return User(**data)
     user = session.get(User, user_id)
+    if user is not None and settings.AUTH_CACHE_TTL_SECONDS > 0:
+        _users.set(user_id, user.model_dump())
+    return user
+
+
+def authenticate_token(token: str, session: Session) -> User:
+    """Valida un JWT i retorna l'usuari actiu i no caducat (HTTPException si no)."""
+    user_id = _token_user_id(token)
+    user = _load_user(user_id, session)
     if not user or not user.is_active:
         logger.warning("AUTH_DENIED_INACTIVE user_id=%s", user_id)
         raise HTTPException(
@@ -49,6 +87,20 @@ def get_current_user(
     return user
 
 
+def get_current_user(
+    credentials: HTTPAuthorizationCredentials = Depends(bearer_scheme),
+) -> User:
+    """Usuari de la petició, llegit amb una sessió pròpia que es tanca en acabar.
+
+    No fa servir la sessió de la petició: si ho fes, una fallada de la memòria
+    cau deixaria una connexió del pool ocupada fins al final de la petició,
+    també mentre un torn de xat espera el model. Com a dependència síncrona
+    s'executa al threadpool, fora del bucle d'esdeveniments.
+    """
+    with Session(engine) as session:
+        return authenticate_token(credentials.credentials, session)
+
+
 def require_role(*roles: UserRole):
     """Dependència de fàbrica: exigeix que l'usuari tingui un dels rols indicats."""
     def _check(current_user: User = Depends(get_current_user)) -> User:
@@ -1,43 +1,382 @@
 """
-Rate limiter de finestra lliscant en memòria.
-Thread-safe, sense dependències externes, per clau (user_id o IP).
+Rate limiters per clau (user_id, username o IP).
+Per defecte en memòria (per procés); amb RATE_LIMIT_BACKEND = "sql" o "redis"
+el límit es comparteix entre tots els workers.
 """
+import asyncio
+import logging
+import math
 import time
-from collections import defaultdict, deque
+from collections import OrderedDict
+from dataclasses import dataclass
 from threading import Lock
+from typing import Protocol
 
 from fastapi import HTTPException, status
+from sqlalchemy import case, delete, select
 
+from app.core.config import settings
+from app.core.resilience import CircuitBreaker
+from app.models.rate_limit import RateLimitBucket
 
-class SlidingWindowLimiter:
-    def __init__(self, max_calls: int, period_seconds: int):
-        self._max    = max_calls
-        self._period = period_seconds
-        self._calls: dict[str, deque] = defaultdict(deque)
-        self._lock   = Lock()
+logger = logging.getLogger(__name__)
+
+
+_EVICT_PER_CHECK = 8
+
+# Marge d'arrodoniment (ràfega exacta de max_calls)
+_EPSILON = 1e-9
+
+
+class RateLimitBackend(Protocol):
+    """
+    Magatzem compartit de TATs. acquire() aplica el GCRA de forma atòmica a
+    `cells` crides alhora: les reserva totes si hi caben (el TAT nou no supera
+    ara + `limit`) o no en reserva cap. Retorna (reservades, TAT) — el nou si
+    s'han reservat, l'actual si no.
+    """
+
+    name: str
+
+    def acquire(self, key: str, cells: int, interval: float, limit: float, now: float) -> tuple[bool, float]: ...
+
+    def purge(self, now: float) -> int: ...
+
+
+class SQLRateLimitBackend:
+    """
+    TATs a la taula rate_limit de la BD de l'aplicació. Cada acquire() és un
+    sol INSERT ... ON CONFLICT DO UPDATE ... WHERE ... RETURNING: la fila
+    només s'actualitza si les crides hi caben, i si no hi caben no torna res.
+    """
+
+    name = "sql"
+
+    def __init__(self, engine):
+        dialect = engine.dialect.name
+        if dialect == "sqlite":
+            from sqlalchemy.dialects.sqlite import insert
+        elif dialect == "postgresql":
+            from sqlalchemy.dialects.postgresql import insert
+        else:
+            raise ValueError(f"RATE_LIMIT_BACKEND=sql no suporta la BD {dialect}")
+        self._engine = engine
+        self._insert = insert
+
+    def acquire(self, key: str, cells: int, interval: float, limit: float, now: float) -> tuple[bool, float]:
+        table = RateLimitBucket.__table__
+        tat = case((table.c.tat > now, table.c.tat), else_=now) + cells * interval
+        stmt = (
+            self._insert(table)
+            .values(key=key, tat=now + cells * interval)
+            .on_conflict_do_update(
+                index_elements=[table.c.key],
+                set_={"tat": tat},
+                where=tat - now <= limit,
+            )
+            .returning(table.c.tat)
+        )
+        with self._engine.begin() as conn:
+            new_tat = conn.execute(stmt).scalar()
+            if new_tat is not None:
+                return True, new_tat
+            return False, conn.execute(select(table.c.tat).where(table.c.key == key)).scalar_one()
+
+    def purge(self, now: float) -> int:
+        """Esborra les claus que ja tornen a estar buides."""
+        with self._engine.begin() as conn:
+            return conn.execute(delete(RateLimitBucket).where(RateLimitBucket.tat <= now)).rowcount
+
+
+# Mateix càlcul que SQLRateLimitBackend, dins de Redis (atòmic). Els números
+# tornen com a text: Redis trunca a enter els números de Lua.
+_GCRA_LUA = """
+local now      = tonumber(ARGV[1])
+local interval = tonumber(ARGV[2])
+local cells    = tonumber(ARGV[3])
+local limit    = tonumber(ARGV[4])
+local tat = tonumber(redis.call('GET', KEYS[1])) or now
+if tat < now then tat = now end
+local new_tat = tat + cells * interval
+if new_tat - now > limit then
+    return {0, tostring(tat)}
+end
+redis.call('SET', KEYS[1], tostring(new_tat), 'PX', math.ceil((new_tat - now) * 1000))
+return {1, tostring(new_tat)}
+"""
+
+
+class RedisRateLimitBackend:
+    """
+    TATs a Redis (o qualsevol servidor compatible: Valkey, KeyDB, fakeredis
+    en proves). Cada acquire() és un script Lua atòmic, i cada clau caduca
+    sola quan torna a estar buida. Requereix el paquet redis.
+    """
+
+    name = "redis"
+
+    def __init__(self, client, prefix: str = "rate_limit:"):
+        self._client = client
+        self._prefix = prefix
+        self._script = client.register_script(_GCRA_LUA)
+
+    @classmethod
+    def from_url(cls, url: str) -> "RedisRateLimitBackend":
+        import redis
+
+        return cls(redis.Redis.from_url(url, socket_timeout=1.0, socket_connect_timeout=1.0))
+
+    def acquire(self, key: str, cells: int, interval: float, limit: float, now: float) -> tuple[bool, float]:
+        allowed, tat = self._script(keys=[self._prefix + key], args=[repr(now), repr(interval), cells, repr(limit)])
+        return bool(allowed), float(tat)
+
+    def purge(self, now: float) -> int:
+        return 0   # les claus caduquen soles (PX)
+
+
+@dataclass
+class _Lease:
+    """Crides ja reservades al backend compartit que aquest procés encara pot servir."""
+    remaining: int
+    expires:   float
+    headroom:  int     # crides que quedaven lliures al backend després de reservar
+
+
+class GCRALimiter:
+    """
+    GCRA (generic cell rate algorithm) amb un sol float per clau: l'instant
+    teòric en què la clau tornarà a estar buida (TAT).
+
+    Contracte: mai més de `max_calls` crides en qualsevol finestra de
+    `period_seconds`. Se'n permeten `burst` seguides (per defecte la meitat);
+    després, una cada period_seconds / (max_calls - burst + 1). Una ràfega
+    més gran es paga amb un ritme sostingut més lent: amb burst = max_calls,
+    una crida per període.
+
+    Les claus sense ús ja estan buides (TAT <= ara) i s'esborren: cada check()
+    treu del davant les menys usades que estiguin inactives, de manera que la
+    memòria no creix amb claus arbitràries (p. ex. usernames d'un atac de
+    credencials).
+
+    Amb un `backend` compartit el TAT viu fora del procés i el límit és el
+    mateix per a tots els workers. Per no fer una consulta a cada crida, quan
+    la clau va sobrada es reserven `lease_calls` crides d'un cop i se serveixen
+    localment; a prop del límit es reserva d'una en una. Si el backend falla,
+    es degrada al límit en memòria d'aquest procés; després de
+    RATE_LIMIT_BREAKER_THRESHOLD errors seguits el `breaker` s'obre i, fins a
+    la crida de prova, ni s'intenta (una caiguda no costa un timeout per crida).
+    Des de codi asíncron s'ha de fer servir acheck(): la consulta es fa en un fil.
+    """
+
+    def __init__(
+        self,
+        max_calls: int,
+        period_seconds: float,
+        *,
+        burst: int | None = None,
+        name: str = "",
+        backend: RateLimitBackend | None = None,
+        lease_calls: int = 1,
+        breaker: CircuitBreaker | None = None,
+    ):
+        burst = (max_calls + 1) // 2 if burst is None else max(1, min(burst, max_calls))
+        self._max       = max_calls
+        self._burst     = burst
+        self._period    = period_seconds
+        self._interval  = period_seconds / (max_calls - burst + 1)   # temps que "costa" cada crida
+        self._tolerance = (burst - 1) * self._interval              # marge per a la ràfega
+        self._tat: OrderedDict[str, float] = OrderedDict()
+        self._lock      = Lock()
+        self._name      = name
+        self._backend   = backend
+        self._lease     = max(1, min(lease_calls, burst))
+        self._leases: OrderedDict[str, _Lease] = OrderedDict()
+        self._breaker   = breaker or (_backend_breaker(f"rate_limit:{name}") if backend is not None else None)
+        self._stats     = {"local": 0, "round_trips": 0, "fallbacks": 0}
 
     def check(self, key: str) -> None:
-        """Llança HTTP 429 si la clau ha superat el límit en el període actual."""
-        now    = time.monotonic()
-        cutoff = now - self._period
+        """Llança HTTP 429 (amb Retry-After) si la clau ha superat el límit."""
+        if self._backend is not None:
+            try:
+                if self._check_shared(key):
+                    return
+            except HTTPException:
+                raise
+            except Exception:
+                logger.warning("Rate limit backend %s failed; using the in-process limit",
+                               self._backend.name, exc_info=True)
+            self._stats["fallbacks"] += 1
+        self._check_local(key)
+
+    async def acheck(self, key: str) -> None:
+        """Com check(), per a codi asíncron: la consulta al backend compartit no bloqueja el bucle."""
+        if self._backend is None:
+            self.check(key)
+        else:
+            await asyncio.to_thread(self.check, key)
+
+    def _check_local(self, key: str) -> None:
+        now = time.monotonic()
         with self._lock:
-            dq = self._calls[key]
-            while dq and dq[0] < cutoff:
-                dq.popleft()
-            if len(dq) >= self._max:
-                raise HTTPException(
-                    status_code=status.HTTP_429_TOO_MANY_REQUESTS,
-                    detail=f"Massa peticions. Màxim {self._max} missatges per {self._period}s.",
-                )
-            dq.append(now)
-
-
-# 10 missatges per minut per usuari — suficient per a una sessió de formació
-chat_limiter = SlidingWindowLimiter(max_calls=10, period_seconds=60)
-
-# Login: 5 intents/minut per username — protecció contra força bruta
-login_limiter = SlidingWindowLimiter(max_calls=5, period_seconds=60)
-
-# Veu: 15 peticions/minut per endpoint — marge per a conversa fluida amb VAD
-transcribe_limiter = SlidingWindowLimiter(max_calls=15, period_seconds=60)
-tts_limiter        = SlidingWindowLimiter(max_calls=15, period_seconds=60)
+            tat = max(self._tat.get(key, now), now)
+            if tat - now > self._tolerance + _EPSILON:
+                raise self._too_many(tat - now)
+            self._tat[key] = tat + self._interval
+            self._tat.move_to_end(key)
+            # Expulsió de claus inactives, com a molt unes quantes per crida:
+            # el lock mai no es reté O(claus), i com que cada crida n'afegeix
+            # com a molt una, les inactives no s'acumulen
+            for _ in range(_EVICT_PER_CHECK):
+                oldest, oldest_tat = next(iter(self._tat.items()))
+                if oldest_tat > now:
+                    break
+                del self._tat[oldest]
+
+    def _check_shared(self, key: str) -> bool:
+        """Aplica el límit compartit; False si el backend no està disponible (breaker obert)."""
+        # Rellotge de paret: el TAT es compara entre processos
+        now = time.time()
+        with self._lock:
+            lease = self._leases.get(key)
+            if lease is not None and lease.expires > now:
+                if lease.remaining > 0:
+                    lease.remaining -= 1
+                    self._stats["local"] += 1
+                    return True
+                cells = self._lease if lease.headroom >= self._lease else 1
+            else:
+                cells = self._lease
+            for _ in range(_EVICT_PER_CHECK):
+                if not self._leases:
+                    break
+                oldest, oldest_lease = next(iter(self._leases.items()))
+                if oldest_lease.expires > now:
+                    break
+                del self._leases[oldest]
+
+        if not self._breaker.allow():
+            return False
+        # La consulta es fa fora del lock: dues crides simultànies de la mateixa
+        # clau poden reservar cadascuna, però totes dues compten al backend
+        shared_key = f"{self._name}:{key}"
+        limit = self._tolerance + self._interval + _EPSILON
+        allowed, tat = self._acquire(shared_key, cells, limit, now)
+        if not allowed and cells > 1 and tat - now <= self._tolerance + _EPSILON:
+            # No hi cabia la reserva sencera però sí aquesta crida
+            cells = 1
+            allowed, tat = self._acquire(shared_key, cells, limit, now)
+        if not allowed:
+            raise self._too_many(tat - now)
+
+        headroom = int((limit - (tat - now)) / self._interval)
+        with self._lock:
+            # Les crides reservades i no usades caduquen quan el backend ja les
+            # hauria retornades: mai no es gasten més tard del que han costat
+            self._leases[key] = _Lease(remaining=cells - 1, expires=now + cells * self._interval, headroom=headroom)
+            self._leases.move_to_end(key)
+        return True
+
+    def _acquire(self, shared_key: str, cells: int, limit: float, now: float) -> tuple[bool, float]:
+        try:
+            result = self._backend.acquire(shared_key, cells, self._interval, limit, now)
+        except Exception:
+            self._breaker.record_failure()
+            raise
+        self._breaker.record_success()
+        self._stats["round_trips"] += 1
+        return result
+
+    def _too_many(self, wait: float) -> HTTPException:
+        return HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail=(
+                f"Massa peticions. Se'n permeten {self._burst} seguides i després una cada "
+                f"{self._interval:g} s (màxim {self._max} cada {self._period:g} s)."
+            ),
+            headers={"Retry-After": str(max(1, math.ceil(wait - self._tolerance)))},
+        )
+
+    def __len__(self) -> int:
+        return len(self._tat) + len(self._leases)
+
+    def reset(self) -> None:
+        with self._lock:
+            self._tat.clear()
+            self._leases.clear()
+
+    def snapshot(self) -> dict:
+        snapshot = {"keys": len(self), **self._stats}
+        if self._backend is not None:
+            snapshot["breaker"] = self._breaker.state
+        return snapshot
+
+
+def _backend_breaker(name: str) -> CircuitBreaker:
+    return CircuitBreaker(
+        name,
+        failure_threshold=settings.RATE_LIMIT_BREAKER_THRESHOLD,
+        reset_seconds=settings.RATE_LIMIT_BREAKER_RESET_SECONDS,
+    )
+
+
+def _shared_backend() -> RateLimitBackend | None:
+    if settings.RATE_LIMIT_BACKEND == "sql":
+        from app.db.session import engine
+
+        return SQLRateLimitBackend(engine)
+    if settings.RATE_LIMIT_BACKEND == "redis":
+        return RedisRateLimitBackend.from_url(settings.RATE_LIMIT_REDIS_URL)
+    return None
+
+
+backend = _shared_backend()
+
+# Un sol circuit per al backend: una caiguda l'obre per a tots els limiters
+backend_breaker = _backend_breaker("rate_limit")
+
+
+def _limiter(name: str, max_calls: int, period_seconds: float, burst: int | None = None) -> GCRALimiter:
+    return GCRALimiter(
+        max_calls,
+        period_seconds,
+        burst=burst,
+        name=name,
+        backend=backend,
+        lease_calls=int(max_calls * settings.RATE_LIMIT_LEASE_FRACTION),
+        breaker=backend_breaker,
+    )
+
+
+# Xat: 5 missatges seguits per usuari, després un cada 10 s (mai més de 10 per
+# minut) — suficient per a una sessió de formació
+chat_limiter = _limiter("chat", max_calls=10, period_seconds=60)
+
+# Login: 5 intents seguits per username, després un per minut — protecció
+# contra força bruta
+login_limiter = _limiter("login", max_calls=5, period_seconds=60, burst=5)
+
+# Veu, per endpoint: 8 peticions seguides, després una cada 7,5 s (mai més de
+# 15 per minut) — marge per a conversa fluida amb VAD
+transcribe_limiter = _limiter("transcribe", max_calls=15, period_seconds=60)
+tts_limiter        = _limiter("tts", max_calls=15, period_seconds=60)
+
+# Respostes especulatives (transcripció parcial): cada una és una generació de la IA
+# (10 seguides, després una cada 6 s)
+speculate_limiter = _limiter("speculate", max_calls=20, period_seconds=60)
+
+_limiters = (chat_limiter, login_limiter, transcribe_limiter, tts_limiter, speculate_limiter)
+
+
+def purge_expired() -> int:
+    """Esborra del backend compartit les claus inactives (la neteja periòdica)."""
+    if backend is None:
+        return 0
+    return backend.purge(time.time())
+
+
+def snapshot() -> dict:
+    return {
+        "backend": backend.name if backend is not None else "memory",
+        "breaker": backend_breaker.snapshot() if backend is not None else None,
+        "limiters": {limiter._name: limiter.snapshot() for limiter in _limiters},
+    }
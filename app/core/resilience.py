@@ -0,0 +1,219 @@
+"""
+Primitives de resiliència per a crides a serveis externs.
+Thread-safe, sense dependències externes.
+"""
+import random
+import time
+from collections import deque
+from threading import Lock
+
+from app.core.metrics import LatencyTracker
+
+
+def backoff_delay(attempt: int, base: float, cap: float) -> float:
+    """Retard amb "full jitter": aleatori entre 0 i min(cap, base·2^attempt)."""
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
+
+
+class CircuitBreaker:
+    """
+    Circuit breaker clàssic de tres estats.
+    - closed: tot passa; `failure_threshold` errors consecutius l'obren.
+    - open: no passa res durant `reset_seconds`.
+    - half_open: deixa passar una sola crida de prova; si va bé es tanca,
+      si falla es torna a obrir.
+    """
+
+    CLOSED    = "closed"
+    OPEN      = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, name: str, failure_threshold: int, reset_seconds: float):
+        self.name       = name
+        self._threshold = failure_threshold
+        self._reset     = reset_seconds
+        self._lock      = Lock()
+        self._state     = self.CLOSED
+        self._failures  = 0
+        self._opened_at = 0.0
+        self._probing   = False
+        self._opens     = 0
+
+    def _current_state(self, now: float) -> str:
+        if self._state == self.OPEN and now - self._opened_at >= self._reset:
+            self._state = self.HALF_OPEN
+            self._probing = False
+        return self._state
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            return self._current_state(time.monotonic())
+
+    def allow(self) -> bool:
+        """Indica si es pot fer una crida ara (en half_open, només la de prova)."""
+        with self._lock:
+            state = self._current_state(time.monotonic())
+            if state == self.CLOSED:
+                return True
+            if state == self.HALF_OPEN and not self._probing:
+                self._probing = True
+                return True
+            return False
+
+    def record_success(self) -> None:
+        with self._lock:
+            self._state    = self.CLOSED
+            self._failures = 0
+            self._probing  = False
+
+    def record_failure(self) -> None:
+        with self._lock:
+            now = time.monotonic()
+            state = self._current_state(now)
+            self._failures += 1
+            if state == self.HALF_OPEN or self._failures >= self._threshold:
+                if state != self.OPEN:
+                    self._opens += 1
+                self._state     = self.OPEN
+                self._opened_at = now
+                self._probing   = False
+
+    def reset(self) -> None:
+        with self._lock:
+            self._state    = self.CLOSED
+            self._failures = 0
+            self._probing  = False
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            now = time.monotonic()
+            state = self._current_state(now)
+            retry_in = max(0.0, self._reset - (now - self._opened_at)) if state == self.OPEN else 0.0
+            return {
+                "name": self.name,
+                "state": state,
+                "consecutive_failures": self._failures,
+                "times_opened": self._opens,
+                "retry_in_seconds": round(retry_in, 1),
+            }
+
+
+class ProviderHealth:
+    """
+    Salut d'un proveïdor extern segons les seves últimes `window` crides.
+    - healthy: es fa servir. Passa a unhealthy amb `failure_threshold` errors
+      seguits o, amb almenys `min_samples` crides a la finestra, quan la taxa
+      d'errors arriba a `max_error_rate`. Una crida més lenta que
+      `slow_seconds` compta com a error.
+    - unhealthy: els clients el salten. Torna a healthy quan una sonda en
+      segon pla (record_probe) o la crida de prova que es deixa passar cada
+      `retry_seconds` va bé.
+    """
+
+    HEALTHY   = "healthy"
+    UNHEALTHY = "unhealthy"
+
+    def __init__(
+        self,
+        name: str,
+        window: int,
+        min_samples: int,
+        max_error_rate: float,
+        failure_threshold: int,
+        slow_seconds: float,
+        retry_seconds: float,
+    ):
+        self.name        = name
+        self._outcomes: deque[bool] = deque(maxlen=window)
+        self._min        = min_samples
+        self._max_rate   = max_error_rate
+        self._threshold  = failure_threshold
+        self._slow       = slow_seconds
+        self._retry      = retry_seconds
+        self._latency    = LatencyTracker(window)
+        self._lock       = Lock()
+        self._state      = self.HEALTHY
+        self._failures   = 0
+        self._since      = 0.0
+        self._trial      = False
+        self._skipped    = 0
+        self._trips      = 0
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            return self._state
+
+    def allow(self) -> bool:
+        """Indica si cal fer servir el proveïdor ara (en unhealthy, només la crida de prova)."""
+        with self._lock:
+            if self._state == self.HEALTHY:
+                return True
+            if not self._trial and time.monotonic() - self._since >= self._retry:
+                self._trial = True
+                return True
+            self._skipped += 1
+            return False
+
+    def _error_rate(self) -> float | None:
+        if len(self._outcomes) < self._min:
+            return None
+        return self._outcomes.count(False) / len(self._outcomes)
+
+    def record(self, ok: bool, seconds: float) -> None:
+        """Resultat d'una crida real; *seconds* és el temps fins a la primera resposta."""
+        ok = ok and seconds <= self._slow
+        with self._lock:
+            self._outcomes.append(ok)
+            if ok:
+                self._latency.observe(seconds)
+                self._failures = 0
+                if self._state == self.UNHEALTHY:
+                    self._recover()
+                return
+            self._failures += 1
+            rate = self._error_rate()
+            if self._state == self.UNHEALTHY:
+                # La crida de prova ha fallat: s'espera un altre interval
+                self._since = time.monotonic()
+                self._trial = False
+            elif self._failures >= self._threshold or (rate is not None and rate >= self._max_rate):
+                self._state = self.UNHEALTHY
+                self._since = time.monotonic()
+                self._trial = False
+                self._trips += 1
+
+    def record_probe(self, ok: bool) -> None:
+        """Resultat d'una sonda en segon pla (no compta a la finestra de crides)."""
+        with self._lock:
+            if self._state != self.UNHEALTHY:
+                return
+            if ok:
+                self._recover()
+            else:
+                self._since = time.monotonic()
+
+    def _recover(self) -> None:
+        self._state    = self.HEALTHY
+        self._failures = 0
+        self._trial    = False
+        self._outcomes.clear()
+
+    def reset(self) -> None:
+        with self._lock:
+            self._recover()
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            rate = self._error_rate()
+            return {
+                "name": self.name,
+                "state": self._state,
+                "calls": len(self._outcomes),
+                "error_rate": round(rate, 3) if rate is not None else None,
+                "consecutive_failures": self._failures,
+                "times_tripped": self._trips,
+                "skipped": self._skipped,
+                "latency": self._latency.snapshot(),
+            }
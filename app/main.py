@@ -19,6 +19,7 @@ from app.core.config import settings
 from app.core.logging import setup_logging
 from app.db.seed import seed_admin
 from app.db.session import create_db_and_tables, get_session
+from app.services import http_clients, usage_ledger
 from app.services.cleanup import expired_user_cleanup_loop
 
 logger = logging.getLogger(__name__)
@@ -60,9 +61,20 @@ async def lifespan(app: FastAPI):
     create_db_and_tables()
     if settings.ADMIN_USERNAME and settings.ADMIN_PASSWORD:
         seed_admin(settings.ADMIN_USERNAME, settings.ADMIN_PASSWORD)
+    http_clients.open_clients()
     task = asyncio.create_task(expired_user_cleanup_loop())
+    usage_task = asyncio.create_task(usage_ledger.usage_flush_loop())
+    probe_task = asyncio.create_task(http_clients.health_probe_loop())
     yield
     task.cancel()
+    usage_task.cancel()
+    probe_task.cancel()
+    # Escriu el que quedi pendent del registre d'ús abans de tancar
+    try:
+        usage_ledger.flush()
+    except Exception:
+        logger.exception("No s'ha pogut desar el registre d'ús de la IA en tancar")
+    await http_clients.close_clients()
 
 
 app = FastAPI(title=settings.APP_NAME, debug=settings.DEBUG, lifespan=lifespan)
@@ -73,7 +85,7 @@ app.add_middleware(
     allow_origins=_allowed_origins,
     allow_credentials=False,
     allow_methods=["GET", "POST", "PATCH", "DELETE"],
-    allow_headers=["Authorization", "Content-Type"],
+    allow_headers=["Authorization", "Content-Type", "Idempotency-Key"],
 )
 app.add_middleware(SecurityHeadersMiddleware)
 app.add_middleware(GZipMiddleware, minimum_size=500)
@@ -4,3 +4,5 @@ from app.models.scenario import Scenario  # noqa: F401  ← debe ir antes que In
 from app.models.incident import ChatMessage, Incident  # noqa: F401
 from app.models.user import User  # noqa: F401
 from app.models.intervention import InterventionData  # noqa: F401
+from app.models.ai_usage import AIUsageRecord  # noqa: F401
+from app.models.rate_limit import RateLimitBucket  # noqa: F401
@@ -0,0 +1,28 @@
+from datetime import datetime, timezone
+from typing import Optional
+
+from sqlalchemy import Column, ForeignKey, Integer
+from sqlmodel import Field, SQLModel
+
+
+class AIUsageRecord(SQLModel, table=True):
+    """Una fila per crida a la IA: cost (tokens) i latència de cada torn o resum."""
+    __tablename__ = "ai_usage"
+
+    id:                    Optional[int] = Field(default=None, primary_key=True)
+    created_at:            datetime      = Field(default_factory=lambda: datetime.now(timezone.utc), index=True)
+    # SET NULL: el registre de costos sobreviu a l'esborrat d'incidents i usuaris
+    incident_id:           Optional[int] = Field(default=None, sa_column=Column(Integer, ForeignKey("incident.id", ondelete="SET NULL"), index=True))
+    user_id:               Optional[int] = Field(default=None, sa_column=Column(Integer, ForeignKey("app_user.id", ondelete="SET NULL"), index=True))
+    scenario_id:           Optional[int] = Field(default=None, sa_column=Column(Integer, ForeignKey("scenario.id", ondelete="SET NULL"), index=True))
+    kind:                  str           = "turn"   # "turn" | "summary" | "speculation" | "prefetch" (descartades)
+    model:                 str
+    input_tokens:          int           = 0
+    output_tokens:         int           = 0
+    cache_read_tokens:     int           = 0
+    cache_creation_tokens: int           = 0
+    ai_latency_ms:         int           = 0   # temps de la IA (sense la cua)
+    queue_wait_ms:         int           = 0   # espera al control d'admissió
+    retries:               int           = 0
+    degraded:              bool          = False
+    prefetched:            bool          = False  # servida des de la pregeneració o d'una especulació
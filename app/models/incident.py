@@ -29,6 +29,9 @@ class Incident(SQLModel, table=True):
     call_start_at:    Optional[datetime] = Field(default=None)
     type_decided_at:  Optional[datetime] = Field(default=None)
     call_end_at:      Optional[datetime] = Field(default=None)
+    # Resum acumulat dels torns que ja no s'envien a la IA (finestra per tokens)
+    history_summary:  Optional[str]      = Field(default=None)
+    summary_upto_id:  Optional[int]      = Field(default=None)  # últim ChatMessage.id inclòs al resum
 
     # Relationships — passive_deletes deixa que la BD faci CASCADE
     messages:     List["ChatMessage"]          = Relationship(back_populates="incident", passive_deletes="all")
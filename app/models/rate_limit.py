@@ -0,0 +1,9 @@
+from sqlmodel import Field, SQLModel
+
+
+class RateLimitBucket(SQLModel, table=True):
+    """TAT del rate limiting (GCRA) per clau, compartit entre workers (RATE_LIMIT_BACKEND=sql)."""
+    __tablename__ = "rate_limit"
+
+    key: str   = Field(primary_key=True)   # "<limiter>:<clau>", p. ex. "chat:42"
+    tat: float                             # epoch (s) en què la clau torna a estar buida
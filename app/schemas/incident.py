@@ -9,6 +9,7 @@ class IncidentCreate(BaseModel):
     location:     Optional[str] = None
     description:  Optional[str] = None
     priority:     int = Field(..., ge=1, le=5)
+    lang:         str = 'ca'  # idioma de la trucada (per pregenerar la primera frase)
 
     @model_validator(mode="after")
     def check_required_without_scenario(self) -> "IncidentCreate":
@@ -0,0 +1,24 @@
+from typing import Literal, Optional
+
+from pydantic import BaseModel
+
+UsageGroupBy = Literal["user", "scenario", "day"]
+
+
+class UsageAggregate(BaseModel):
+    """Cost (tokens) i latència de la IA agregats per usuari, escenari o dia."""
+    key:                   Optional[str]   # id d'usuari/escenari, o data ISO; None = sense assignar
+    calls:                 int
+    turns:                 int
+    summaries:             int
+    speculations:          int             # respostes especulatives descartades (cost sense torn)
+    prefetches:            int             # línies inicials pregenerades i no servides (cost sense torn)
+    input_tokens:          int
+    output_tokens:         int
+    cache_read_tokens:     int
+    cache_creation_tokens: int
+    retries:               int
+    degraded:              int
+    p50_ai_latency_ms:     Optional[int]   # només torns de xat
+    p95_ai_latency_ms:     Optional[int]
+    p95_queue_wait_ms:     Optional[int]
@@ -17,6 +17,10 @@ class ChatResponse(BaseModel):
     call_ended: bool = False
 
 
+class SpeculateResponse(BaseModel):
+    speculating: bool
+
+
 class TranscriptMessage(BaseModel):
     role: str
     content: str
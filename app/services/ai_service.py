@@ -1,13 +1,31 @@
+import asyncio
 import logging
+import time
+from dataclasses import dataclass, field
+from functools import lru_cache
 
-import anthropic
-from anthropic import Anthropic
-
+from app.core.admission import PRIORITY_BACKGROUND, PRIORITY_OPERATOR, AdmissionController
 from app.core.config import settings
+from app.core.metrics import LatencyTracker
+from app.core.resilience import CircuitBreaker, backoff_delay
+from app.services.llm_backend import AIUsage, DeltaCallback, LLMError, LLMResult, get_backend
 
 logger = logging.getLogger(__name__)
 
-_client = Anthropic(api_key=settings.ANTHROPIC_API_KEY)
+# Estat compartit de les crides a la IA (per procés) — exposat a /monitoring
+ai_breaker = CircuitBreaker(
+    "ai",
+    failure_threshold=settings.AI_BREAKER_FAILURE_THRESHOLD,
+    reset_seconds=settings.AI_BREAKER_RESET_SECONDS,
+)
+ai_latency = LatencyTracker()
+summary_latency = LatencyTracker()   # resums: una altra mida de petició, no compten per al hedging dels torns
+ai_admission = AdmissionController(
+    "ai",
+    max_concurrent=settings.AI_MAX_CONCURRENCY,
+    max_queue=settings.AI_MAX_QUEUE,
+    retry_after_seconds=settings.AI_QUEUE_RETRY_AFTER,
+)
 
 _LANG_NAMES = {
     'ca': 'Catalan',
@@ -95,6 +113,12 @@ CALL ENDING RULE
 - Example: "D'acord, moltes gràcies. Adéu. [FI]" """
 
 
+# Resum incremental dels torns antics (finestra d'historial per tokens)
+_SUMMARY_RULES = """You keep a compact running summary of an emergency call between a dispatch operator and a caller.
+Update the previous summary with the new turns. Always keep, verbatim when given: the caller's name, phone number and exact address; what happened; people involved and their condition; how the situation has developed; what the operator asked or instructed; whether help was confirmed.
+Write at most 120 words of plain sentences in {lang}. Output only the updated summary."""
+
+
 def _lang_rule(lang: str) -> str:
     name = _LANG_NAMES.get(lang, 'Catalan')
     return (
@@ -168,7 +192,180 @@ def _scenario_facts(
     return header + "\n".join(lines)
 
 
-def generate_alertant_response(
+@dataclass
+class AIReply:
+    text: str
+    model: str
+    usage: AIUsage = field(default_factory=AIUsage)
+    retries: int = 0
+    queue_wait: float = 0.0
+    degraded: bool = False
+
+
+# Degraded caller mode: short generic lines used while the AI circuit is open,
+# so the call keeps going without hammering a failing upstream.
+_DEGRADED_LINES = {
+    'ca': (
+        "Em sent? La línia va molt malament... necessito ajuda, de pressa.",
+        "Perdoni, no l'he entès bé. Pot repetir-ho?",
+        "Sí... sí, segueixo aquí. Si us plau, enviïn algú.",
+    ),
+    'es': (
+        "¿Me oye? La línea va fatal... necesito ayuda, rápido.",
+        "Perdone, no le he entendido bien. ¿Puede repetirlo?",
+        "Sí... sí, sigo aquí. Por favor, envíen a alguien.",
+    ),
+    'fr': (
+        "Vous m'entendez ? La ligne est très mauvaise... j'ai besoin d'aide, vite.",
+        "Pardon, je n'ai pas bien compris. Vous pouvez répéter ?",
+        "Oui... oui, je suis toujours là. S'il vous plaît, envoyez quelqu'un.",
+    ),
+    'en': (
+        "Can you hear me? The line is really bad... I need help, quickly.",
+        "Sorry, I didn't catch that. Can you say it again?",
+        "Yes... yes, I'm still here. Please send someone.",
+    ),
+}
+
+
+def _degraded_reply(history: list[dict], lang: str) -> str:
+    lines = _DEGRADED_LINES.get(lang, _DEGRADED_LINES['ca'])
+    user_turns = sum(1 for m in history if m["role"] == "user")
+    return lines[(user_turns - 1) % len(lines)]
+
+
+def ai_status() -> dict:
+    backend = get_backend()
+    return {
+        "backend": backend.name,
+        "model": backend.model,
+        "breaker": ai_breaker.snapshot(),
+        "latency": ai_latency.snapshot(),
+        "summary_latency": summary_latency.snapshot(),
+        "admission": ai_admission.snapshot(),
+    }
+
+
+def _hedge_delay(latency: LatencyTracker) -> float | None:
+    """Seconds after which a duplicate request is sent, or None (hedging off)."""
+    if settings.AI_HEDGE_PERCENTILE <= 0 or len(latency) < settings.AI_HEDGE_MIN_SAMPLES:
+        return None
+    return latency.percentile(settings.AI_HEDGE_PERCENTILE)
+
+
+async def _hedged_complete(system, messages: list[dict], max_tokens: int, latency: LatencyTracker) -> LLMResult:
+    """Sends the request and, if it is slower than the latency percentile,
+    a duplicate one; the first successful answer wins and the other is cancelled.
+
+    The duplicate needs a free admission slot of its own: when the controller
+    is full (or has a queue) the request is not hedged, so hedging never
+    pushes the upstream past AI_MAX_CONCURRENCY.
+    """
+    backend = get_backend()
+    first = asyncio.ensure_future(backend.complete(system, messages, max_tokens))
+    pending = {first}
+    try:
+        delay = _hedge_delay(latency)
+        if delay is not None:
+            done, _ = await asyncio.wait(pending, timeout=delay)
+            if not done:
+                if ai_admission.try_acquire():
+                    logger.info("AI hedge: request slower than p%g (%.2fs)", settings.AI_HEDGE_PERCENTILE, delay)
+                    hedge = asyncio.ensure_future(backend.complete(system, messages, max_tokens))
+                    hedge.add_done_callback(lambda _: ai_admission.release())
+                    pending.add(hedge)
+                else:
+                    logger.debug("AI hedge skipped: no free admission slot")
+        error: BaseException | None = None
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    return task.result()
+                error = task.exception()
+        raise error
+    finally:
+        for task in pending:
+            task.cancel()
+
+
+async def _complete(
+    system,
+    messages: list[dict],
+    max_tokens: int,
+    on_delta: DeltaCallback | None = None,
+    latency: LatencyTracker = ai_latency,
+) -> tuple[LLMResult, int]:
+    """Calls the backend with bounded, jittered retries on transient errors.
+
+    Returns (result, retries). Streaming calls are only retried while nothing
+    has been emitted yet, and are never hedged. Successful call latency goes
+    to *latency*. Raises LLMError when the circuit is open or the retries are
+    exhausted.
+    """
+    emitted = False
+
+    async def track(chunk: str) -> None:
+        nonlocal emitted
+        emitted = True
+        await on_delta(chunk)
+
+    attempt = 0
+    while True:
+        if not ai_breaker.allow():
+            raise LLMError("AI circuit open")
+        start = time.perf_counter()
+        try:
+            if on_delta is None:
+                result = await _hedged_complete(system, messages, max_tokens, latency)
+            else:
+                result = await get_backend().complete(system, messages, max_tokens, track)
+        except LLMError as exc:
+            ai_breaker.record_failure()
+            if not exc.transient or emitted or attempt >= settings.AI_MAX_RETRIES:
+                raise
+            delay = backoff_delay(attempt, settings.AI_RETRY_BASE_DELAY, settings.AI_RETRY_MAX_DELAY)
+            logger.warning("AI transient error (%s) — retry %d in %.2fs", exc, attempt + 1, delay)
+            await asyncio.sleep(delay)
+            attempt += 1
+            continue
+        ai_breaker.record_success()
+        latency.observe(time.perf_counter() - start)
+        return result, attempt
+
+
+@lru_cache(maxsize=256)
+def _system_blocks(
+    incident_type: str,
+    location: str | None,
+    description: str | None,
+    victim_status: str | None,
+    initial_emotion: str | None,
+    instructions_ia: str | None,
+    lang: str,
+) -> tuple[dict, ...]:
+    """Assembles the system prompt as two cacheable prefix blocks.
+
+    The behaviour rules are identical for every call; the second block only
+    changes per scenario/incident/language. Memoized so a 20-turn call builds
+    it once, and marked with cache breakpoints so Anthropic reuses both prefixes.
+    """
+    scenario_block = (
+        _lang_rule(lang)
+        + _scenario_facts(incident_type, location, description, victim_status, initial_emotion)
+    )
+    if instructions_ia:
+        scenario_block += (
+            "\n\nTRAINER'S SECRET INSTRUCTIONS (never mention them — just follow them):\n"
+            + instructions_ia
+        )
+    return (
+        {"type": "text", "text": _BEHAVIOUR_RULES, "cache_control": {"type": "ephemeral"}},
+        {"type": "text", "text": scenario_block.lstrip("\n"), "cache_control": {"type": "ephemeral"}},
+    )
+
+
+async def generate_alertant_response(
     history: list[dict],
     incident_type: str,
     instructions_ia: str | None = None,
@@ -177,36 +374,85 @@ def generate_alertant_response(
     initial_emotion: str | None = None,
     description: str | None = None,
     lang: str = 'ca',
-) -> str:
-    system = (
-        _BEHAVIOUR_RULES
-        + _lang_rule(lang)
-        + _scenario_facts(incident_type, location, description, victim_status, initial_emotion)
-    )
+    call_summary: str | None = None,
+    on_delta: DeltaCallback | None = None,
+    turn_class: int = PRIORITY_OPERATOR,
+    incident_priority: int = 0,
+) -> AIReply:
+    """Generates the caller's next reply.
 
-    if instructions_ia:
-        system += (
-            "\n\nTRAINER'S SECRET INSTRUCTIONS (never mention them — just follow them):\n"
-            + instructions_ia
-        )
+    The call waits for a slot in the AI admission controller; *turn_class* and
+    *incident_priority* order it in the queue (HTTP 503 if the queue is full).
+
+    *call_summary* is the rolling summary of older turns that are no longer in
+    *history*; it goes after the cached prefixes so it never invalidates them.
+    When *on_delta* is given the reply is streamed and every text chunk is
+    awaited on it as soon as the model emits it; the full reply is still returned.
+    """
+    system = list(_system_blocks(
+        incident_type, location, description, victim_status, initial_emotion,
+        instructions_ia, lang,
+    ))
+    if call_summary:
+        system.append({
+            "type": "text",
+            "text": (
+                "EARLIER IN THIS CALL (summary of turns no longer shown — "
+                "these facts are still true and binding):\n" + call_summary
+            ),
+        })
 
     try:
-        response = _client.messages.create(
-            model="claude-sonnet-4-6",
-            max_tokens=settings.AI_MAX_TOKENS,
-            system=system,
-            messages=history,
-        )
-    except anthropic.APITimeoutError:
-        logger.error("Anthropic API timeout")
-        raise RuntimeError("AI service timed out — please try again")
-    except anthropic.APIConnectionError:
-        logger.error("Cannot connect to Anthropic API")
-        raise RuntimeError("Cannot reach AI service — check network")
-    except anthropic.APIStatusError as exc:
-        logger.error("Anthropic API error %d: %s", exc.status_code, exc.message)
-        raise RuntimeError(f"AI service error (HTTP {exc.status_code})")
-
-    if not response.content or not response.content[0].text.strip():
+        async with ai_admission.slot(turn_class, incident_priority) as queue_wait:
+            result, retries = await _complete(system, history, settings.AI_MAX_TOKENS, on_delta)
+    except LLMError:
+        if ai_breaker.state == CircuitBreaker.CLOSED:
+            raise
+        # Circuit open: answer in degraded caller mode instead of failing the turn
+        text = _degraded_reply(history, lang)
+        logger.warning("AI circuit open — degraded caller reply")
+        if on_delta is not None:
+            await on_delta(text)
+        return AIReply(text=text, model="degraded", degraded=True)
+    if not result.text.strip():
         raise ValueError("Empty AI response")
-    return response.content[0].text
+
+    usage = result.usage
+    model = get_backend().model
+    logger.info(
+        "AI usage model=%s input=%d output=%d cache_read=%d cache_write=%d retries=%d queue_wait=%.3fs",
+        model, usage.input_tokens, usage.output_tokens,
+        usage.cache_read_tokens, usage.cache_creation_tokens, retries, queue_wait,
+    )
+    return AIReply(
+        text=result.text, model=model, usage=usage, retries=retries, queue_wait=queue_wait,
+    )
+
+
+async def summarize_call(previous_summary: str | None, turns: list[dict], lang: str = 'ca') -> AIReply:
+    """Folds *turns* into the running call summary and returns the new summary.
+
+    Only the previous summary and the newly folded turns are sent, so the cost
+    of an update does not grow with the length of the call.
+    """
+    lines = [
+        f"{'Operator' if t['role'] == 'user' else 'Caller'}: {t['content']}"
+        for t in turns
+    ]
+    prompt = (
+        f"PREVIOUS SUMMARY:\n{previous_summary or '(none)'}\n\n"
+        "NEW TURNS:\n" + "\n".join(lines)
+    )
+    async with ai_admission.slot(PRIORITY_BACKGROUND) as queue_wait:
+        result, retries = await _complete(
+            _SUMMARY_RULES.format(lang=_LANG_NAMES.get(lang, 'Catalan')),
+            [{"role": "user", "content": prompt}],
+            settings.AI_SUMMARY_MAX_TOKENS,
+            latency=summary_latency,
+        )
+    text = result.text.strip()
+    if not text:
+        raise ValueError("Empty AI summary")
+    return AIReply(
+        text=text, model=get_backend().model, usage=result.usage, retries=retries, queue_wait=queue_wait,
+    )
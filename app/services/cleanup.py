@@ -5,11 +5,14 @@ from datetime import datetime, timezone
 from sqlalchemy import delete as sa_delete, or_
 from sqlmodel import Session, select
 
+from app.core import rate_limit
 from app.core.config import settings
+from app.core.deps import forget_user
 from app.db.session import engine
 from app.models.incident import ChatMessage, Incident
 from app.models.intervention import InterventionData
 from app.models.user import User
+from app.services.simulation_service import forget_call
 
 logger = logging.getLogger(__name__)
 
@@ -57,9 +60,13 @@ def run_expired_user_cleanup() -> int:
             session.execute(
                 sa_delete(Incident).where(Incident.id.in_(incident_ids))
             )
+            for incident_id in incident_ids:
+                forget_call(incident_id)
 
         session.execute(sa_delete(User).where(User.id.in_(user_ids)))
         session.commit()
+        for user_id in user_ids:
+            forget_user(user_id)
 
         logger.info(
             "Cleanup: %d usuari(s) expirat(s) eliminat(s) · %d incident(s) eliminat(s)",
@@ -76,4 +83,8 @@ async def expired_user_cleanup_loop() -> None:
             run_expired_user_cleanup()
         except Exception:
             logger.exception("Error durant la neteja d'usuaris expirats")
+        try:
+            await asyncio.to_thread(rate_limit.purge_expired)
+        except Exception:
+            logger.exception("Error durant la neteja del rate limiting compartit")
         await asyncio.sleep(settings.CLEANUP_INTERVAL_SECONDS)
@@ -0,0 +1,122 @@
+"""
+Clients HTTP compartits (un per proveïdor) amb pool de connexions keep-alive.
+Es creen al lifespan de l'aplicació i es tanquen en aturar-la; si algú en
+demana un fora del lifespan (scripts, proves) es crea al moment.
+
+També hi ha la salut de cada proveïdor: qui fa les crides hi registra el
+resultat, i una tasca en segon pla sondeja els que estan marcats com a caiguts.
+"""
+import asyncio
+import importlib.util
+import logging
+
+import httpx
+
+from app.core.config import settings
+from app.core.resilience import ProviderHealth
+
+logger = logging.getLogger(__name__)
+
+OPENAI     = "openai"
+ELEVENLABS = "elevenlabs"
+
+# HTTP/2 només si hi ha el paquet h2 instal·lat (httpx[http2])
+_HTTP2 = importlib.util.find_spec("h2") is not None
+
+_clients: dict[str, httpx.AsyncClient] = {}
+
+# Endpoint lleuger de cada proveïdor per comprovar si torna a respondre
+_PROBE_PATHS = {OPENAI: "/models", ELEVENLABS: "/models"}
+
+
+def _new_health(provider: str) -> ProviderHealth:
+    return ProviderHealth(
+        provider,
+        window=settings.PROVIDER_HEALTH_WINDOW,
+        min_samples=settings.PROVIDER_HEALTH_MIN_SAMPLES,
+        max_error_rate=settings.PROVIDER_MAX_ERROR_RATE,
+        failure_threshold=settings.PROVIDER_FAILURE_THRESHOLD,
+        slow_seconds=settings.PROVIDER_SLOW_SECONDS,
+        retry_seconds=settings.PROVIDER_PROBE_SECONDS,
+    )
+
+
+health: dict[str, ProviderHealth] = {provider: _new_health(provider) for provider in (OPENAI, ELEVENLABS)}
+
+
+def _build(provider: str) -> httpx.AsyncClient:
+    if provider == OPENAI:
+        base_url = "https://api.openai.com/v1"
+        headers = {"Authorization": f"Bearer {settings.DispatchSimKeyOpenAI}"}
+        max_connections = settings.OPENAI_MAX_CONNECTIONS
+    elif provider == ELEVENLABS:
+        base_url = "https://api.elevenlabs.io/v1"
+        headers = {"xi-api-key": settings.DispatchSimKeyEleven}
+        max_connections = settings.ELEVENLABS_MAX_CONNECTIONS
+    else:
+        raise ValueError(f"Proveïdor desconegut: {provider}")
+    return httpx.AsyncClient(
+        base_url=base_url,
+        headers=headers,
+        http2=_HTTP2,
+        limits=httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_connections,
+            keepalive_expiry=settings.HTTP_KEEPALIVE_EXPIRY,
+        ),
+        timeout=httpx.Timeout(settings.VOICE_TTS_TIMEOUT, connect=settings.HTTP_CONNECT_TIMEOUT),
+    )
+
+
+def get_client(provider: str) -> httpx.AsyncClient:
+    client = _clients.get(provider)
+    if client is None or client.is_closed:
+        client = _clients[provider] = _build(provider)
+    return client
+
+
+def open_clients() -> None:
+    for provider in (OPENAI, ELEVENLABS):
+        get_client(provider)
+    logger.debug("HTTP clients ready (http2=%s)", _HTTP2)
+
+
+async def close_clients() -> None:
+    clients = list(_clients.values())
+    _clients.clear()
+    for client in clients:
+        await client.aclose()
+
+
+def _configured(provider: str) -> bool:
+    return bool(settings.DispatchSimKeyOpenAI if provider == OPENAI else settings.DispatchSimKeyEleven)
+
+
+def provider_status() -> dict:
+    return {
+        provider: {**tracker.snapshot(), "configured": _configured(provider)}
+        for provider, tracker in health.items()
+    }
+
+
+async def probe_unhealthy() -> None:
+    """Sondeja els proveïdors marcats com a caiguts."""
+    for provider, tracker in health.items():
+        if tracker.state != ProviderHealth.UNHEALTHY or not _configured(provider):
+            continue
+        try:
+            response = await get_client(provider).get(_PROBE_PATHS[provider], timeout=settings.PROVIDER_SLOW_SECONDS)
+            ok = response.status_code == 200
+        except httpx.HTTPError:
+            ok = False
+        tracker.record_probe(ok)
+        logger.info("Provider probe %s: %s", provider, "ok" if ok else "still failing")
+
+
+async def health_probe_loop() -> None:
+    while True:
+        await asyncio.sleep(settings.PROVIDER_PROBE_SECONDS)
+        try:
+            await probe_unhealthy()
+        except Exception:
+            logger.exception("Provider health probe failed")
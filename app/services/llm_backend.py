@@ -0,0 +1,189 @@
+"""
+LLM backends for the simulated caller.
+
+The backend is chosen with Settings.LLM_BACKEND:
+- "anthropic": the real model through the Anthropic API.
+- "stub": a local deterministic caller with configurable latency, token rate
+  and [FI] behaviour, for offline capacity tests of the whole chat path.
+"""
+import asyncio
+import hashlib
+import logging
+import re
+from abc import ABC, abstractmethod
+from collections.abc import Awaitable, Callable
+from dataclasses import dataclass, field
+from functools import lru_cache
+
+import anthropic
+from anthropic import AsyncAnthropic
+
+from app.core.config import settings
+
+logger = logging.getLogger(__name__)
+
+DeltaCallback = Callable[[str], Awaitable[None]]
+
+
+@dataclass
+class AIUsage:
+    input_tokens: int = 0
+    output_tokens: int = 0
+    cache_read_tokens: int = 0
+    cache_creation_tokens: int = 0
+
+
+@dataclass
+class LLMResult:
+    text: str
+    usage: AIUsage = field(default_factory=AIUsage)
+
+
+class LLMError(RuntimeError):
+    """Backend failure; *transient* errors are worth retrying."""
+
+    def __init__(self, message: str, transient: bool = False):
+        super().__init__(message)
+        self.transient = transient
+
+
+# 408 timeout, 409 conflict, 429 rate limit, 5xx/529 overloaded
+_TRANSIENT_STATUS = {408, 409, 429}
+
+
+class LLMBackend(ABC):
+    """Interface every backend implements."""
+
+    name: str = ""
+    model: str = ""
+
+    @abstractmethod
+    async def complete(
+        self,
+        system: str | list[dict],
+        messages: list[dict],
+        max_tokens: int,
+        on_delta: DeltaCallback | None = None,
+    ) -> LLMResult:
+        """Runs one completion. With *on_delta*, text chunks are awaited on it as they are produced."""
+
+
+class AnthropicBackend(LLMBackend):
+    name = "anthropic"
+
+    def __init__(self, api_key: str, model: str):
+        self.model = model
+        self._client = AsyncAnthropic(api_key=api_key)
+
+    async def complete(self, system, messages, max_tokens, on_delta=None) -> LLMResult:
+        request = {
+            "model": self.model,
+            "max_tokens": max_tokens,
+            "system": system,
+            "messages": messages,
+        }
+        try:
+            if on_delta is None:
+                response = await self._client.messages.create(**request)
+            else:
+                async with self._client.messages.stream(**request) as stream:
+                    async for chunk in stream.text_stream:
+                        await on_delta(chunk)
+                    response = await stream.get_final_message()
+        except anthropic.APITimeoutError:
+            logger.error("Anthropic API timeout")
+            raise LLMError("AI service timed out — please try again", transient=True)
+        except anthropic.APIConnectionError:
+            logger.error("Cannot connect to Anthropic API")
+            raise LLMError("Cannot reach AI service — check network", transient=True)
+        except anthropic.APIStatusError as exc:
+            logger.error("Anthropic API error %d: %s", exc.status_code, exc.message)
+            raise LLMError(
+                f"AI service error (HTTP {exc.status_code})",
+                transient=exc.status_code in _TRANSIENT_STATUS or exc.status_code >= 500,
+            )
+
+        text = "".join(b.text for b in response.content if getattr(b, "type", "text") == "text")
+        usage = response.usage
+        return LLMResult(
+            text=text,
+            usage=AIUsage(
+                input_tokens=usage.input_tokens or 0,
+                output_tokens=usage.output_tokens or 0,
+                cache_read_tokens=getattr(usage, "cache_read_input_tokens", None) or 0,
+                cache_creation_tokens=getattr(usage, "cache_creation_input_tokens", None) or 0,
+            ),
+        )
+
+
+# Frases de l'alertant simulat (el contingut no importa per a proves de capacitat)
+_STUB_LINES = (
+    "Si us plau, vinguin ràpid, hi ha molt de fum aquí dins.",
+    "No ho sé, no ho sé... hi ha una persona a terra i no es mou.",
+    "Estic al carrer Major, número dotze, segon pis.",
+    "Sí, sí, respira però molt fluix. Què faig?",
+    "D'acord, d'acord. Ja els espero a la porta.",
+)
+_STUB_GOODBYE_RE = re.compile(r"\b(adéu|adeu|adiós|adios|au revoir|goodbye|bye|penji|cuelgue)\b", re.IGNORECASE)
+_TOKEN_RE = re.compile(r"\S+\s*")
+
+
+class StubBackend(LLMBackend):
+    """Deterministic local caller: same history → same reply, no network."""
+
+    name = "stub"
+    model = "stub"
+
+    def __init__(
+        self,
+        latency_ms: int,
+        tokens_per_second: float,
+        end_after_turns: int = 0,
+        end_on_goodbye: bool = True,
+    ):
+        self._latency = latency_ms / 1000
+        self._token_delay = 1 / tokens_per_second if tokens_per_second > 0 else 0.0
+        self._end_after_turns = end_after_turns
+        self._end_on_goodbye = end_on_goodbye
+
+    def _reply_for(self, messages: list[dict]) -> str:
+        last = messages[-1]["content"] if messages else ""
+        user_turns = sum(1 for m in messages if m["role"] == "user")
+        digest = hashlib.sha256(f"{user_turns}:{last}".encode()).digest()
+        reply = _STUB_LINES[digest[0] % len(_STUB_LINES)]
+        ends = (
+            (self._end_after_turns and user_turns >= self._end_after_turns)
+            or (self._end_on_goodbye and _STUB_GOODBYE_RE.search(last))
+        )
+        return f"{reply} [FI]" if ends else reply
+
+    async def complete(self, system, messages, max_tokens, on_delta=None) -> LLMResult:
+        reply = self._reply_for(messages)
+        tokens = _TOKEN_RE.findall(reply)[:max_tokens]
+        await asyncio.sleep(self._latency)
+        for token in tokens:
+            if self._token_delay:
+                await asyncio.sleep(self._token_delay)
+            if on_delta is not None:
+                await on_delta(token)
+
+        system_text = system if isinstance(system, str) else "".join(b["text"] for b in system)
+        prompt_chars = len(system_text) + sum(len(m["content"]) for m in messages)
+        return LLMResult(
+            text="".join(tokens),
+            usage=AIUsage(input_tokens=prompt_chars // 4, output_tokens=len(tokens)),
+        )
+
+
+@lru_cache(maxsize=1)
+def get_backend() -> LLMBackend:
+    """Returns the process-wide backend configured in Settings."""
+    if settings.LLM_BACKEND == "stub":
+        logger.warning("LLM backend: stub (no real model calls)")
+        return StubBackend(
+            latency_ms=settings.AI_STUB_LATENCY_MS,
+            tokens_per_second=settings.AI_STUB_TOKENS_PER_SECOND,
+            end_after_turns=settings.AI_STUB_END_AFTER_TURNS,
+            end_on_goodbye=settings.AI_STUB_END_ON_GOODBYE,
+        )
+    return AnthropicBackend(api_key=settings.ANTHROPIC_API_KEY, model=settings.AI_MODEL)
@@ -1,16 +1,25 @@
+import asyncio
 import logging
 import re
+import time
+from collections.abc import Awaitable, Callable
+from dataclasses import dataclass, field
 from datetime import datetime, timezone
 
 from fastapi import HTTPException
-from sqlalchemy import update as sa_update
+from sqlalchemy import func, update as sa_update
 from sqlmodel import Session, select
 
+from app.core.admission import PRIORITY_BACKGROUND, PRIORITY_OPERATOR, PRIORITY_SILENCE
+from app.core.cache import LRUCache
+from app.core.config import settings
 from app.core.constants import DEFAULT_VOICE, VOICE_MAP
+from app.db.session import engine
 from app.models.incident import CallStatus, ChatMessage, Incident
 from app.models.scenario import Scenario
 from app.schemas.simulation import ChatRequest
-from app.services.ai_service import generate_alertant_response
+from app.services import usage_ledger, voice_service
+from app.services.ai_service import AIReply, generate_alertant_response, summarize_call
 
 logger = logging.getLogger(__name__)
 
@@ -28,11 +37,399 @@ _END_MARKER = "[FI]"
 _NON_WORD_RE = re.compile(r'^[\W\d_]+$', re.UNICODE)
 
 
+class _EndMarkerFilter:
+    """Strips the end-of-call marker from a streamed reply.
+
+    A chunk ending in a possible prefix of the marker (e.g. "[F") is held back
+    until the next chunk shows whether the marker is complete.
+    """
+
+    def __init__(self) -> None:
+        self._pending = ""
+
+    def feed(self, chunk: str) -> str:
+        text = (self._pending + chunk).replace(_END_MARKER, "")
+        for keep in range(min(len(_END_MARKER) - 1, len(text)), 0, -1):
+            if _END_MARKER.startswith(text[-keep:]):
+                self._pending = text[-keep:]
+                return text[:-keep]
+        self._pending = ""
+        return text
+
+    def flush(self) -> str:
+        text, self._pending = self._pending, ""
+        return text
+
+
+def _estimate_tokens(content: str) -> int:
+    """Cheap token estimate (~4 characters per token plus per-message overhead)."""
+    return len(content) // 4 + 4
+
+
+def _window_by_budget(history: list[dict], budget: int) -> list[dict]:
+    """Keeps the newest messages that fit *budget* estimated tokens.
+
+    The last message (the current operator turn) is always kept, and the
+    window is trimmed so it starts with a user turn as the API requires.
+    """
+    kept: list[dict] = []
+    used = 0
+    for msg in reversed(history):
+        cost = _estimate_tokens(msg["content"])
+        if kept and used + cost > budget:
+            break
+        kept.append(msg)
+        used += cost
+    kept.reverse()
+    while len(kept) > 1 and kept[0]["role"] != "user":
+        kept.pop(0)
+    return kept
+
+
+def _messages_to_fold(messages: list["_Turn"], budget: int) -> list["_Turn"]:
+    """Selects the oldest unsummarized messages to fold into the summary.
+
+    Folding starts once the unsummarized history uses 3/4 of the budget and
+    brings it down to half, so a summary update runs every few turns rather
+    than every turn. The cut is made after an assistant reply so the remaining
+    history still starts with a user turn.
+    """
+    costs = [_estimate_tokens(m.content) for m in messages]
+    total = sum(costs)
+    if total <= budget * 3 // 4:
+        return []
+    cut = 0
+    while cut < len(messages) and (total > budget // 2 or messages[cut - 1].role != "assistant"):
+        total -= costs[cut]
+        cut += 1
+    return list(messages[:cut])
+
+
+_folding: set[int] = set()
+_background_tasks: set[asyncio.Task] = set()
+
+
+def _schedule_fold(incident: Incident, messages: list["_Turn"], lang: str) -> None:
+    """Updates the incident's rolling summary in the background (off the turn's path)."""
+    if incident.id in _folding:
+        return
+    _folding.add(incident.id)
+    task = asyncio.create_task(_fold_history(
+        incident.id,
+        incident.history_summary,
+        incident.summary_upto_id,
+        [{"role": m.role, "content": m.content} for m in messages],
+        messages[-1].id,
+        lang,
+        user_id=incident.creator_id,
+        scenario_id=incident.scenario_id,
+    ))
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+
+
+async def _fold_history(
+    incident_id: int,
+    previous_summary: str | None,
+    previous_upto_id: int | None,
+    turns: list[dict],
+    upto_id: int,
+    lang: str,
+    user_id: int | None = None,
+    scenario_id: int | None = None,
+) -> None:
+    try:
+        start = time.perf_counter()
+        reply = await summarize_call(previous_summary, turns, lang)
+        usage_ledger.record(
+            reply, kind="summary", incident_id=incident_id, user_id=user_id,
+            scenario_id=scenario_id, elapsed=time.perf_counter() - start,
+        )
+        await asyncio.to_thread(_store_summary, incident_id, reply.text, previous_upto_id, upto_id)
+        logger.debug("History summary updated for incident_id=%s (upto_id=%s)", incident_id, upto_id)
+    except Exception:
+        logger.warning("History summary update failed for incident_id=%s", incident_id, exc_info=True)
+    finally:
+        _folding.discard(incident_id)
+
+
+def _store_summary(incident_id: int, summary: str, previous_upto_id: int | None, upto_id: int) -> None:
+    with Session(engine) as session:
+        # Only apply on top of the summary this fold was based on
+        same_base = (
+            Incident.summary_upto_id.is_(None) if previous_upto_id is None
+            else Incident.summary_upto_id == previous_upto_id
+        )
+        session.execute(
+            sa_update(Incident)
+            .where(Incident.id == incident_id, same_base)
+            .values(history_summary=summary, summary_upto_id=upto_id)
+        )
+        session.commit()
+
+
+def caller_profile(incident: Incident, scenario: Scenario | None) -> dict:
+    """Scenario-dependent keyword arguments for generate_alertant_response."""
+    return {
+        "incident_type":   incident.type,
+        "instructions_ia": scenario.instructions_ia if scenario else None,
+        "location":        (scenario.location_exact if scenario else None) or incident.location,
+        "victim_status":   scenario.victim_status if scenario else None,
+        "initial_emotion": scenario.initial_emotion if scenario else None,
+        "description":     incident.description,
+    }
+
+
+# ── Conversation state of active calls ───────────────────────────────────────
+# Unsummarized history, caller profile and voice of each EN_CURS incident,
+# kept write-through by process_chat so a turn does not reload them from the
+# database. The cache is per process and the app may run several workers (or
+# persist a turn whose request was cancelled), so every load checks the
+# incident's last message id in the database and reloads a state that is
+# behind it; the summary cut-off comes from the freshly read incident.
+
+@dataclass(frozen=True)
+class _Turn:
+    id: int
+    role: str
+    content: str
+
+
+@dataclass
+class CallState:
+    turns: list[_Turn]
+    profile: dict
+    voice: str
+    last_id: int | None = None  # newest message of the call this state has seen
+
+    @property
+    def last_role(self) -> str | None:
+        return self.turns[-1].role if self.turns else None
+
+
+_call_states: LRUCache[CallState] = LRUCache(settings.CALL_STATE_CACHE_SIZE)
+
+
+def load_call_state(incident: Incident, session: Session) -> CallState:
+    """Returns the cached state of an active call, loading it from the DB on a miss.
+
+    A cached state whose last message is not the newest one in the database
+    (written by another worker) is reloaded; the check is one indexed lookup.
+    """
+    last_id = session.exec(
+        select(func.max(ChatMessage.id)).where(ChatMessage.incident_id == incident.id)
+    ).one()
+    state = _call_states.get(incident.id)
+    if state is None or state.last_id != last_id:
+        query = select(ChatMessage).where(ChatMessage.incident_id == incident.id)
+        if incident.summary_upto_id is not None:
+            query = query.where(ChatMessage.id > incident.summary_upto_id)
+        turns = [
+            _Turn(m.id, m.role, m.content)
+            for m in session.exec(query.order_by(ChatMessage.timestamp)).all()
+        ]
+        scenario = session.get(Scenario, incident.scenario_id) if incident.scenario_id else None
+        profile = caller_profile(incident, scenario)
+        state = CallState(
+            turns=turns,
+            profile=profile,
+            voice=VOICE_MAP.get(profile["initial_emotion"] or "", DEFAULT_VOICE),
+            last_id=last_id,
+        )
+        _call_states.set(incident.id, state)
+    elif incident.summary_upto_id is not None:
+        # Turns folded into the summary since the last turn are not needed any more
+        state.turns = [t for t in state.turns if t.id > incident.summary_upto_id]
+    return state
+
+
+def call_states_snapshot() -> dict:
+    return _call_states.snapshot()
+
+
+def forget_call(incident_id: int) -> None:
+    """Drops everything held in memory for a call (finalised or deleted). Safe from any thread."""
+    _call_states.pop(incident_id)
+    cancel_opening_line(incident_id)
+    cancel_speculation(incident_id)
+
+
+# ── Turn serialisation ───────────────────────────────────────────────────────
+# Only one turn per incident runs at a time, so a double submit or a VAD
+# trigger during an in-flight turn cannot pay for a second generation on the
+# same history or interleave the persisted messages.
+
+@dataclass
+class _TurnLock:
+    lock: asyncio.Lock = field(default_factory=asyncio.Lock)
+    users: int = 0
+
+
+_turn_locks: dict[int, _TurnLock] = {}
+
+
+async def acquire_turn(incident_id: int, wait: bool = True) -> None:
+    """Takes the incident's turn lock; with wait=False a busy incident raises 409."""
+    entry = _turn_locks.setdefault(incident_id, _TurnLock())
+    if not wait and entry.lock.locked():
+        raise HTTPException(status_code=409, detail="A turn is already in progress for this incident")
+    entry.users += 1
+    try:
+        await entry.lock.acquire()
+    except BaseException:
+        _drop_turn_user(incident_id, entry)
+        raise
+
+
+def turn_in_progress(incident_id: int) -> bool:
+    entry = _turn_locks.get(incident_id)
+    return entry is not None and entry.lock.locked()
+
+
+def release_turn(incident_id: int) -> None:
+    entry = _turn_locks[incident_id]
+    entry.lock.release()
+    _drop_turn_user(incident_id, entry)
+
+
+def _drop_turn_user(incident_id: int, entry: _TurnLock) -> None:
+    entry.users -= 1
+    if entry.users == 0:
+        _turn_locks.pop(incident_id, None)
+
+
+# ── Pre-generated opening line ──────────────────────────────────────────────
+# Opt-in (AI_PREFETCH_OPENING_LINE): the caller's reply to the standard
+# greeting is generated in the background as soon as the call starts. It is
+# served only when the operator's first message is that greeting (case,
+# punctuation and spacing aside); any other opening discards it, so the first
+# reply always answers what the operator actually said.
+
+_OPENING_GREETINGS = {
+    'ca': "112, digui?",
+    'es': "112, ¿dígame?",
+    'fr': "112, j'écoute ?",
+    'en': "112, what is your emergency?",
+}
+_OPENING_TTL_SECONDS = 600
+
+
+def _text_key(text: str) -> str:
+    """Words of *text*, lowercased: two texts with the same key say the same thing."""
+    return " ".join(re.findall(r'\w+', text.lower(), re.UNICODE))
+
+
+_GREETING_KEYS = frozenset(_text_key(g) for g in _OPENING_GREETINGS.values())
+
+
+@dataclass
+class _OpeningLine:
+    lang: str
+    task: asyncio.Task
+    ledger: dict
+    created: float = field(default_factory=time.monotonic)
+
+
+_opening_lines: dict[int, _OpeningLine] = {}
+
+
+async def prefetch_opening_line(
+    incident_id: int,
+    incident_priority: int,
+    profile: dict,
+    lang: str,
+    user_id: int | None = None,
+    scenario_id: int | None = None,
+) -> None:
+    """Starts generating the caller's opening line for a call that just began.
+
+    *profile* is caller_profile() of the incident, computed by the caller while
+    its ORM objects are still attached to a session. *user_id* and
+    *scenario_id* attribute the cost of a line that is never served.
+    """
+    now = time.monotonic()
+    for stale_id, pending in list(_opening_lines.items()):
+        if now - pending.created > _OPENING_TTL_SECONDS:
+            cancel_opening_line(stale_id)
+
+    greeting = _OPENING_GREETINGS.get(lang, _OPENING_GREETINGS['ca'])
+    task = asyncio.create_task(generate_alertant_response(
+        [{"role": "user", "content": greeting}],
+        **profile,
+        lang=lang,
+        turn_class=PRIORITY_BACKGROUND,
+        incident_priority=incident_priority,
+    ))
+    cancel_opening_line(incident_id)
+    _opening_lines[incident_id] = _OpeningLine(
+        lang=lang,
+        task=task,
+        ledger={"incident_id": incident_id, "user_id": user_id, "scenario_id": scenario_id},
+    )
+    logger.debug("Opening line prefetch started for incident_id=%s", incident_id)
+
+
+def _cancel_task(task: asyncio.Task) -> None:
+    loop = task.get_loop()
+    if not task.done() and not loop.is_closed():
+        loop.call_soon_threadsafe(task.cancel)
+
+
+def _discard_opening_line(pending: _OpeningLine) -> None:
+    """Cancels an unserved opening line; if it already finished, its tokens still go to the ledger."""
+    task = pending.task
+    if not task.done():
+        _cancel_task(task)
+    elif not task.cancelled() and task.exception() is None:
+        usage_ledger.record(task.result(), kind="prefetch", **pending.ledger)
+
+
+def cancel_opening_line(incident_id: int) -> None:
+    """Drops a pending opening line (call ended or deleted). Safe from any thread."""
+    pending = _opening_lines.pop(incident_id, None)
+    if pending:
+        _discard_opening_line(pending)
+
+
+async def _take_opening_line(incident_id: int, lang: str, text: str) -> AIReply | None:
+    """Returns the pre-generated opening line (waiting if still in flight), or None.
+
+    Only served when *text*, the operator's first message, is the greeting it
+    was generated for; otherwise it is discarded.
+    """
+    pending = _opening_lines.pop(incident_id, None)
+    if pending is None:
+        return None
+    task = pending.task
+    greeting = _OPENING_GREETINGS.get(pending.lang, _OPENING_GREETINGS['ca'])
+    if pending.lang != lang or _text_key(text) != _text_key(greeting) \
+            or task.get_loop() is not asyncio.get_running_loop():
+        _discard_opening_line(pending)
+        return None
+    try:
+        reply = await task
+    except asyncio.CancelledError:
+        if asyncio.current_task().cancelling():
+            raise
+        return None  # the prefetch was cancelled, not this turn
+    except Exception:
+        logger.warning("Opening line prefetch failed for incident_id=%s", incident_id, exc_info=True)
+        return None
+    if reply.degraded or _END_MARKER in reply.text:
+        usage_ledger.record(reply, kind="prefetch", **pending.ledger)
+        return None
+    logger.debug("Serving pre-generated opening line for incident_id=%s", incident_id)
+    return reply
+
+
 def _is_empty_input(text: str) -> bool:
     """Return True if *text* is too empty or incoherent to be a real operator turn."""
     stripped = text.strip()
     if not stripped:
         return True
+    # The standard greeting ("112, digui?") is a real turn even with a single word
+    if _text_key(stripped) in _GREETING_KEYS:
+        return False
     # Only punctuation / symbols / digits — no letters at all
     if _NON_WORD_RE.match(stripped):
         return True
@@ -41,40 +438,174 @@ def _is_empty_input(text: str) -> bool:
     return len(words) < 2
 
 
-def process_chat(
+# ── Speculative replies ─────────────────────────────────────────────────────
+# Opt-in (AI_SPECULATIVE_REPLIES): an interim transcript of the operator's
+# sentence starts generating the caller reply while the operator is still
+# speaking. The turn reuses it when the final text says the same thing (case,
+# punctuation and spacing aside) on the same history; otherwise it is dropped
+# and the turn generates as usual.
+
+_SPECULATION_TTL_SECONDS = 120
+
+
+@dataclass
+class _Speculation:
+    text_key: str
+    lang: str
+    history_mark: int | None
+    task: asyncio.Task
+    ledger: dict
+    created: float = field(default_factory=time.monotonic)
+
+
+_speculations: dict[int, _Speculation] = {}
+_speculation_stats = {"started": 0, "restarted": 0, "hits": 0, "misses": 0}
+
+
+def _history_mark(incident: Incident, state: CallState) -> int | None:
+    """Identifies the history a reply was generated on (last turn seen)."""
+    return state.turns[-1].id if state.turns else incident.summary_upto_id
+
+
+def _discard_speculation(pending: _Speculation) -> None:
+    """Cancels an unused speculation; if it already finished, its tokens still go to the ledger."""
+    task = pending.task
+    if not task.done():
+        _cancel_task(task)
+    elif not task.cancelled() and task.exception() is None:
+        usage_ledger.record(task.result(), kind="speculation", **pending.ledger)
+
+
+def cancel_speculation(incident_id: int) -> None:
+    """Drops a pending speculative reply. Safe from any thread."""
+    pending = _speculations.pop(incident_id, None)
+    if pending:
+        _discard_speculation(pending)
+
+
+def speculate(incident: Incident, state: CallState, text: str, lang: str) -> bool:
+    """Starts (or keeps) a speculative reply to the interim operator text *text*.
+
+    *state* is load_call_state() of the incident, read beforehand off the loop.
+
+    Returns False when speculation does not apply: disabled, a turn already
+    in progress, the first exchange (served by the opening line), or *text*
+    is not a real sentence yet.
+    """
+    if not settings.AI_SPECULATIVE_REPLIES or turn_in_progress(incident.id) or _is_empty_input(text):
+        return False
+    if state.last_role == "user" or (not state.turns and incident.summary_upto_id is None):
+        return False
+
+    text_key = _text_key(text)
+    mark = _history_mark(incident, state)
+    loop = asyncio.get_running_loop()
+    pending = _speculations.get(incident.id)
+    if pending is not None:
+        if (pending.text_key, pending.lang, pending.history_mark) == (text_key, lang, mark) \
+                and pending.task.get_loop() is loop and not pending.task.done():
+            return True
+        # The interim text moved on: restart on the new one
+        cancel_speculation(incident.id)
+        _speculation_stats["restarted"] += 1
+
+    now = time.monotonic()
+    for stale_id, stale in list(_speculations.items()):
+        if now - stale.created > _SPECULATION_TTL_SECONDS:
+            cancel_speculation(stale_id)
+
+    history = [{"role": t.role, "content": t.content} for t in state.turns]
+    history.append({"role": "user", "content": text})
+    task = asyncio.create_task(generate_alertant_response(
+        _window_by_budget(history, settings.AI_HISTORY_TOKEN_BUDGET),
+        **state.profile,
+        lang=lang,
+        call_summary=incident.history_summary,
+        turn_class=PRIORITY_OPERATOR,
+        incident_priority=incident.priority,
+    ))
+    _speculations[incident.id] = _Speculation(
+        text_key=text_key,
+        lang=lang,
+        history_mark=mark,
+        task=task,
+        ledger={"incident_id": incident.id, "user_id": incident.creator_id, "scenario_id": incident.scenario_id},
+    )
+    _speculation_stats["started"] += 1
+    logger.debug("Speculative reply started for incident_id=%s", incident.id)
+    return True
+
+
+async def _take_speculation(incident: Incident, state: CallState, request: ChatRequest) -> AIReply | None:
+    """Returns the speculative reply if it answers this exact turn (waiting if still in flight)."""
+    pending = _speculations.pop(incident.id, None)
+    if pending is None:
+        return None
+    matches = (
+        not request.silent_trigger
+        and pending.text_key == _text_key(request.operator_message)
+        and pending.lang == request.lang
+        and pending.history_mark == _history_mark(incident, state)
+        and pending.task.get_loop() is asyncio.get_running_loop()
+    )
+    if not matches:
+        _discard_speculation(pending)
+        _speculation_stats["misses"] += 1
+        return None
+    try:
+        reply = await pending.task
+    except asyncio.CancelledError:
+        if asyncio.current_task().cancelling():
+            raise
+        reply = None
+    except Exception:
+        logger.warning("Speculative reply failed for incident_id=%s", incident.id, exc_info=True)
+        reply = None
+    if reply is None or reply.degraded:
+        _speculation_stats["misses"] += 1
+        return None
+    _speculation_stats["hits"] += 1
+    logger.debug("Serving speculative reply for incident_id=%s", incident.id)
+    return reply
+
+
+def speculation_snapshot() -> dict:
+    decided = _speculation_stats["hits"] + _speculation_stats["misses"]
+    return {
+        "enabled": settings.AI_SPECULATIVE_REPLIES,
+        "pending": len(_speculations),
+        **_speculation_stats,
+        "hit_rate": round(_speculation_stats["hits"] / decided, 3) if decided else None,
+    }
+
+
+async def process_chat(
     request: ChatRequest,
     incident: Incident,
-    session: Session,
+    state: CallState,
+    on_delta: Callable[[str], Awaitable[None]] | None = None,
 ) -> tuple[str, str, bool]:
     """Executes one simulation chat turn.
 
-    Loads history and scenario data, persists the user message, calls the AI,
-    updates type_decided_at on the first exchange, persists the assistant reply,
-    and returns (reply_text, elevenlabs_voice_id, call_ended).
+    Calls the AI on the call's cached history, then persists both messages
+    (and type_decided_at on the first exchange) and returns (reply_text,
+    elevenlabs_voice_id, call_ended).
+
+    *incident* and *state* are read beforehand with a session that is already
+    closed (see load_call_state), so no pooled connection is held while the
+    model generates; the turn is written afterwards in a worker thread with
+    its own short session.
+
+    If *on_delta* is given the reply is streamed: visible text chunks (with the
+    end-of-call marker already stripped) are awaited on it as they arrive.
+    Persistence still happens only once the whole reply is available.
     """
     logger.debug("process_chat started for incident_id=%s", incident.id)
 
-    # Load history ordered by timestamp
-    db_messages = session.exec(
-        select(ChatMessage)
-        .where(ChatMessage.incident_id == incident.id)
-        .order_by(ChatMessage.timestamp)
-    ).all()
-
-    history = [{"role": m.role, "content": m.content} for m in db_messages]
-
-    # Load scenario overrides if the incident is linked to one
-    instructions_ia = None
-    location_exact  = None
-    victim_status   = None
-    initial_emotion = None
-    if incident.scenario_id:
-        scenario = session.get(Scenario, incident.scenario_id)
-        if scenario:
-            instructions_ia = scenario.instructions_ia
-            location_exact  = scenario.location_exact
-            victim_status   = scenario.victim_status
-            initial_emotion = scenario.initial_emotion
+    # Unsummarized history and scenario overrides (cached while the call is active)
+    turns = list(state.turns)
+    profile = state.profile
+    history = [{"role": t.role, "content": t.content} for t in turns]
 
     # Build in-memory history for the AI (DB persistence deferred to commit)
     if request.silent_trigger:
@@ -88,62 +619,119 @@ def process_chat(
         history.append({"role": "user", "content": request.operator_message})
         user_msg = ChatMessage(incident_id=incident.id, role="user", content=request.operator_message)
 
-    # Limit context sent to the AI: keep only the last 20 messages
-    # (the current user message is already the last element)
-    _MAX_HISTORY = 20
-    if len(history) > _MAX_HISTORY:
-        history = history[-_MAX_HISTORY:]
+    # Limit context sent to the AI to a token budget; older turns reach the
+    # model through the rolling summary instead
+    history = _window_by_budget(history, settings.AI_HISTORY_TOKEN_BUDGET)
 
     logger.debug(
         "Calling AI for incident_id=%s with %d messages",
         incident.id, len(history),
     )
 
+    stream_cb = None
+    marker_filter = _EndMarkerFilter()
+    if on_delta is not None:
+        async def stream_cb(chunk: str) -> None:
+            visible = marker_filter.feed(chunk)
+            if visible:
+                await on_delta(visible)
+
+    first_exchange = not turns and incident.summary_upto_id is None
+
+    start = time.perf_counter()
     try:
-        reply = generate_alertant_response(
-            history,
-            incident.type,
-            instructions_ia,
-            location=location_exact or incident.location,
-            victim_status=victim_status,
-            initial_emotion=initial_emotion,
-            description=incident.description,
-            lang=request.lang,
-        )
+        reply = None
+        if first_exchange and not request.silent_trigger:
+            reply = await _take_opening_line(incident.id, request.lang, request.operator_message)
+        elif incident.id in _speculations:
+            reply = await _take_speculation(incident, state, request)
+        if reply is not None and stream_cb is not None:
+            await stream_cb(reply.text)
+        prefetched = reply is not None
+        if reply is None:
+            reply = await generate_alertant_response(
+                history,
+                **profile,
+                lang=request.lang,
+                call_summary=incident.history_summary,
+                on_delta=stream_cb,
+                turn_class=PRIORITY_SILENCE if request.silent_trigger else PRIORITY_OPERATOR,
+                incident_priority=incident.priority,
+            )
     except Exception:
         logger.error(
             "AI call failed for incident_id=%s", incident.id, exc_info=True,
         )
         raise
+    usage_ledger.record(
+        reply,
+        incident_id=incident.id,
+        user_id=incident.creator_id,
+        scenario_id=incident.scenario_id,
+        elapsed=time.perf_counter() - start,
+        prefetched=prefetched,
+    )
 
-    # First exchange → register when the incident type was confirmed
-    if not db_messages and incident.type_decided_at is None:
-        session.execute(
-            sa_update(Incident)
-            .where(Incident.id == incident.id)
-            .values(type_decided_at=datetime.now(timezone.utc))
-        )
+    if on_delta is not None:
+        tail = marker_filter.flush()
+        if tail:
+            await on_delta(tail)
 
     # Detect end-of-call marker and strip it from the visible reply
-    call_ended = _END_MARKER in reply
-    clean_reply = reply.replace(_END_MARKER, "").strip()
+    call_ended = _END_MARKER in reply.text
+    clean_reply = reply.text.replace(_END_MARKER, "").strip()
 
     # If AI signals end of call, finalize it
     if call_ended:
         logger.info("Call ended for incident_id=%s", incident.id)
-        session.execute(
-            sa_update(Incident)
-            .where(Incident.id == incident.id)
-            .values(
-                call_status=CallStatus.FINALITZADA,
-                call_end_at=datetime.now(timezone.utc),
-            )
-        )
+        forget_call(incident.id)
 
     # Persist both messages atomically — if AI failed, nothing is written
-    session.add(user_msg)
-    session.add(ChatMessage(incident_id=incident.id, role="assistant", content=clean_reply))
-    session.commit()
+    assistant_msg = ChatMessage(incident_id=incident.id, role="assistant", content=clean_reply)
+    new_turns = await asyncio.to_thread(
+        _persist_turn,
+        incident.id,
+        [user_msg, assistant_msg],
+        # First exchange → register when the incident type was confirmed
+        decide_type=first_exchange and incident.type_decided_at is None,
+        call_ended=call_ended,
+    )
+
+    # Without on_delta the browser asks /voice/speak for the whole reply next:
+    # start synthesising it now so the audio is ready (or in flight) by then
+    if settings.TTS_PRESYNTHESIZE and on_delta is None and clean_reply:
+        voice_service.presynthesize(clean_reply, state.voice)
+
+    if not call_ended:
+        state.turns = [*state.turns, *new_turns]
+        state.last_id = new_turns[-1].id
+        to_fold = _messages_to_fold(turns, settings.AI_HISTORY_TOKEN_BUDGET)
+        if to_fold:
+            _schedule_fold(incident, to_fold, request.lang)
 
-    voice = VOICE_MAP.get(initial_emotion if initial_emotion else "", DEFAULT_VOICE)
-    return clean_reply, voice, call_ended
+    return clean_reply, state.voice, call_ended
+
+
+def _persist_turn(
+    incident_id: int, messages: list[ChatMessage], decide_type: bool, call_ended: bool,
+) -> list[_Turn]:
+    """Writes a finished turn in one transaction; runs in a worker thread."""
+    now = datetime.now(timezone.utc)
+    with Session(engine) as session:
+        if decide_type:
+            session.execute(
+                sa_update(Incident)
+                .where(Incident.id == incident_id)
+                .values(type_decided_at=now)
+            )
+        if call_ended:
+            session.execute(
+                sa_update(Incident)
+                .where(Incident.id == incident_id)
+                .values(call_status=CallStatus.FINALITZADA, call_end_at=now)
+            )
+        session.add_all(messages)
+        session.flush()
+        turns = [_Turn(m.id, m.role, m.content) for m in messages]
+        session.commit()
+    return turns
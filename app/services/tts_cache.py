@@ -0,0 +1,132 @@
+"""
+Memòria cau d'àudio TTS a disc, adreçada per contingut.
+La clau és un hash de (proveïdor, model, veu, paràmetres de veu, text), de
+manera que el mateix àudio no es torna a demanar mai al proveïdor. Mida
+total acotada amb expulsió LRU; l'ordre d'ús es desa a l'mtime dels fitxers
+perquè sobrevisqui als reinicis.
+"""
+import hashlib
+import json
+import logging
+import os
+import re
+import tempfile
+from collections import OrderedDict
+from pathlib import Path
+from threading import Lock
+
+from app.core.config import settings
+
+logger = logging.getLogger(__name__)
+
+_KEY_RE = re.compile(r'^[0-9a-f]{64}$')
+
+
+def speech_key(provider: str, model: str, voice: str, voice_settings: dict | None, text: str) -> str:
+    payload = json.dumps(
+        [provider, model, voice, voice_settings or {}, text], sort_keys=True, ensure_ascii=False,
+    )
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def is_valid_key(key: str) -> bool:
+    return bool(_KEY_RE.match(key))
+
+
+class TTSCache:
+    """Fitxers `<clau>.mp3` en un directori, amb un límit de `max_bytes` (0 = desactivada)."""
+
+    def __init__(self, directory: str | Path, max_bytes: int):
+        self._dir       = Path(directory)
+        self._max_bytes = max_bytes
+        self._lock      = Lock()
+        self._index: OrderedDict[str, int] | None = None  # clau → mida, de menys a més recent
+        self._total     = 0
+        self._hits      = 0
+        self._misses    = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self._max_bytes > 0
+
+    def _path(self, key: str) -> Path:
+        return self._dir / f"{key}.mp3"
+
+    def _load_index(self) -> OrderedDict[str, int]:
+        # Es llegeix el directori la primera vegada que cal (no a l'importar)
+        if self._index is None:
+            self._dir.mkdir(parents=True, exist_ok=True)
+            entries = []
+            for path in self._dir.glob("*.mp3"):
+                if is_valid_key(path.stem):
+                    stat = path.stat()
+                    entries.append((stat.st_mtime, path.stem, stat.st_size))
+            self._index = OrderedDict((key, size) for _, key, size in sorted(entries))
+            self._total = sum(self._index.values())
+        return self._index
+
+    def path(self, key: str) -> Path | None:
+        """Fitxer de l'entrada (i la marca com a usada), o None si no hi és."""
+        if not self.enabled or not is_valid_key(key):
+            return None
+        with self._lock:
+            index = self._load_index()
+            if key not in index:
+                self._misses += 1
+                return None
+            path = self._path(key)
+            try:
+                os.utime(path)
+            except FileNotFoundError:
+                # Esborrat des de fora: es treu de l'índex
+                self._total -= index.pop(key)
+                self._misses += 1
+                return None
+            index.move_to_end(key)
+            self._hits += 1
+            return path
+
+    def get(self, key: str) -> bytes | None:
+        path = self.path(key)
+        if path is None:
+            return None
+        try:
+            return path.read_bytes()
+        except FileNotFoundError:
+            return None
+
+    def put(self, key: str, audio: bytes) -> None:
+        if not self.enabled or not audio or len(audio) > self._max_bytes:
+            return
+        with self._lock:
+            index = self._load_index()
+            # Escriptura atòmica: un lector mai veu un fitxer a mig escriure
+            fd, tmp = tempfile.mkstemp(dir=self._dir, suffix=".tmp")
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    f.write(audio)
+                os.replace(tmp, self._path(key))
+            except OSError:
+                logger.warning("TTS cache write failed for %s", key, exc_info=True)
+                Path(tmp).unlink(missing_ok=True)
+                return
+            self._total += len(audio) - index.pop(key, 0)
+            index[key] = len(audio)
+            while self._total > self._max_bytes and index:
+                old_key, size = index.popitem(last=False)
+                self._path(old_key).unlink(missing_ok=True)
+                self._total -= size
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            lookups = self._hits + self._misses
+            return {
+                "enabled": self.enabled,
+                "entries": len(self._index or {}),
+                "bytes": self._total,
+                "max_bytes": self._max_bytes,
+                "hit_rate": round(self._hits / lookups, 3) if lookups else None,
+            }
+
+
+tts_cache = TTSCache(settings.TTS_CACHE_DIR, settings.TTS_CACHE_MAX_BYTES)
@@ -0,0 +1,163 @@
+"""
+Ledger of AI usage (tokens) and latency per call.
+
+Recording is a cheap in-memory append; rows are bulk-inserted by a background
+loop every AI_USAGE_FLUSH_SECONDS (or sooner once AI_USAGE_BATCH_SIZE rows are
+pending), so chat turns never wait on the ledger write.
+"""
+import asyncio
+import logging
+from threading import Lock
+
+from sqlalchemy.exc import IntegrityError
+from sqlmodel import Session, select
+
+from app.core.config import settings
+from app.db.session import engine
+from app.models.ai_usage import AIUsageRecord
+from app.models.incident import Incident
+from app.models.scenario import Scenario
+from app.models.user import User
+from app.services.ai_service import AIReply
+
+logger = logging.getLogger(__name__)
+
+_pending: list[AIUsageRecord] = []
+_lock = Lock()
+_dropped = 0
+_wakeup: asyncio.Event | None = None
+
+
+def record(
+    reply: AIReply,
+    *,
+    kind: str = "turn",
+    incident_id: int | None = None,
+    user_id: int | None = None,
+    scenario_id: int | None = None,
+    elapsed: float = 0.0,
+    prefetched: bool = False,
+) -> None:
+    """Queues one ledger row. *elapsed* is the wall time of the call in seconds, queue included.
+
+    A *prefetched* reply was generated before the turn; its latency is only
+    the time the turn spent waiting for it.
+    """
+    global _dropped
+    queue_wait = 0.0 if prefetched else reply.queue_wait
+    row = AIUsageRecord(
+        incident_id=incident_id,
+        user_id=user_id,
+        scenario_id=scenario_id,
+        kind=kind,
+        model=reply.model,
+        input_tokens=reply.usage.input_tokens,
+        output_tokens=reply.usage.output_tokens,
+        cache_read_tokens=reply.usage.cache_read_tokens,
+        cache_creation_tokens=reply.usage.cache_creation_tokens,
+        ai_latency_ms=round(max(0.0, elapsed - queue_wait) * 1000),
+        queue_wait_ms=round(queue_wait * 1000),
+        retries=reply.retries,
+        degraded=reply.degraded,
+        prefetched=prefetched,
+    )
+    with _lock:
+        # Bounded: if the database is down, old rows are dropped instead of growing forever
+        if len(_pending) >= settings.AI_USAGE_MAX_PENDING:
+            _pending.pop(0)
+            _dropped += 1
+        _pending.append(row)
+        full = len(_pending) >= settings.AI_USAGE_BATCH_SIZE
+    if full and _wakeup is not None:
+        _wakeup.set()
+
+
+def pending() -> int:
+    return len(_pending)
+
+
+def _insert(rows: list[AIUsageRecord]) -> None:
+    with Session(engine) as session:
+        session.add_all(rows)
+        session.commit()
+
+
+def _detach_deleted(rows: list[AIUsageRecord]) -> list[AIUsageRecord]:
+    """Copies of *rows* with references to deleted incidents, users or scenarios set to NULL.
+
+    The cost of a call survives the deletion, as with ON DELETE SET NULL.
+    """
+    refs = {"incident_id": Incident, "user_id": User, "scenario_id": Scenario}
+    existing = {}
+    with Session(engine) as session:
+        for column, model in refs.items():
+            ids = {getattr(row, column) for row in rows} - {None}
+            existing[column] = set(session.exec(select(model.id).where(model.id.in_(ids))).all()) if ids else set()
+    copies = []
+    for row in rows:
+        data = row.model_dump(exclude={"id"})
+        for column in refs:
+            if data[column] not in existing[column]:
+                data[column] = None
+        copies.append(AIUsageRecord(**data))
+    return copies
+
+
+def flush() -> int:
+    """Writes every pending row in a single transaction. Returns the number of rows written.
+
+    Rows whose incident, user or scenario was deleted after they were recorded
+    are written unassigned; a transient failure puts the batch back for the
+    next flush.
+    """
+    global _dropped
+    with _lock:
+        batch = _pending[:]
+        _pending.clear()
+    if not batch:
+        return 0
+    try:
+        try:
+            _insert(batch)
+        except IntegrityError:
+            batch = _detach_deleted(batch)
+            _insert(batch)
+    except IntegrityError:
+        # Still failing (e.g. another deletion raced the retry): retrying forever
+        # would stop the ledger for good, so the batch is dropped
+        logger.warning("AI usage ledger: dropping %d rows that violate constraints", len(batch), exc_info=True)
+        with _lock:
+            _dropped += len(batch)
+        return 0
+    except Exception:
+        # Put the batch back so the next flush retries it
+        with _lock:
+            _pending[:0] = batch
+            overflow = len(_pending) - settings.AI_USAGE_MAX_PENDING
+            if overflow > 0:
+                del _pending[:overflow]
+        raise
+    return len(batch)
+
+
+def snapshot() -> dict:
+    return {"pending": len(_pending), "dropped": _dropped}
+
+
+async def usage_flush_loop() -> None:
+    """Background loop: flushes the ledger periodically, or as soon as a batch is full."""
+    global _wakeup
+    _wakeup = asyncio.Event()
+    try:
+        while True:
+            try:
+                await asyncio.wait_for(_wakeup.wait(), timeout=settings.AI_USAGE_FLUSH_SECONDS)
+            except asyncio.TimeoutError:
+                pass
+            _wakeup.clear()
+            try:
+                await asyncio.to_thread(flush)
+            except Exception:
+                logger.exception("AI usage ledger flush failed")
+    finally:
+        _wakeup = None
@@ -0,0 +1,480 @@
+"""
+Servei de veu: transcripció (Whisper) i síntesi (ElevenLabs amb OpenAI com a
+fallback). El fan servir els endpoints HTTP de /voice i la sessió de trucada
+per WebSocket.
+"""
+import asyncio
+import hashlib
+import io
+import logging
+import re
+import time
+from collections.abc import AsyncIterator
+from typing import BinaryIO
+
+import httpx
+from fastapi import HTTPException
+
+from app.core.cache import LRUCache
+from app.core.config import settings
+from app.core.constants import EL_DEFAULT_SETTINGS, EL_TO_OAI_VOICE, EL_VOICE_SETTINGS
+from app.services import webm
+from app.services.http_clients import ELEVENLABS, OPENAI, get_client, health
+from app.services.tts_cache import speech_key, tts_cache
+
+logger = logging.getLogger(__name__)
+
+MAX_AUDIO_BYTES = settings.VOICE_MAX_AUDIO_MB * 1024 * 1024
+AUDIO_TOO_LARGE = f"L'arxiu d'àudio supera el límit de {settings.VOICE_MAX_AUDIO_MB} MB"
+_HASH_CHUNK = 64 * 1024
+_OAI_VOICES = {"alloy", "echo", "fable", "onyx", "nova", "shimmer"}
+
+# Palabras sueltas que Whisper alucina — match exacto (evita falsos positivos con substring)
+_HALLUCINATION_EXACT = {
+    "amara.org", "amara", "subtítulos", "subtitulado", "subtitles",
+    "transcripción", "transcription", "sous-titres", "sous titres",
+    "suscríbete", "subscribe",
+    "you", "thank you", "thanks", "bye", "goodbye", "okay", "ok",
+    "gràcies", "gracias", "merci", "adiós", "adéu", "vale",
+    "...", "…", "eh", "ah", "oh", "um", "hm", "hmm", "mm",
+    "sí", "si", "no", "ja", "oui", "yes",
+    "música", "music", "aplausos", "risas", "silencio",
+}
+# Frases más largas — match por substring
+_HALLUCINATION_SUBSTR = {
+    "thank you for watching", "thanks for watching", "gràcies per veure",
+    "gracias por ver", "subtitulado por", "sous-titres par",
+    "antarctica films", "cc por", "copyright", "todos los derechos",
+    "all rights reserved", "tots els drets",
+}
+_MIN_TRANSCRIPTION_CHARS = 8  # mínimo de caracteres para considerar una transcripción válida
+_PUNCT_RE = re.compile(r'[^\w\s]', re.UNICODE)
+
+
+def _is_hallucination(text: str) -> bool:
+    lower = text.lower().strip()
+    # Match exacto (sin puntuación) para palabras sueltas
+    clean = _PUNCT_RE.sub('', lower).strip()
+    if clean in _HALLUCINATION_EXACT:
+        logger.debug("Whisper hallucination (exact): %r", text)
+        return True
+    # Substring match para frases largas conocidas
+    if any(h in lower for h in _HALLUCINATION_SUBSTR):
+        logger.debug("Whisper hallucination (substr): %r", text)
+        return True
+    # Texto demasiado corto → probablemente ruido
+    if len(clean) < _MIN_TRANSCRIPTION_CHARS:
+        logger.debug("Whisper hallucination (short, %d chars): %r", len(clean), text)
+        return True
+    # Repetición de palabras/frases — alucinación clásica de Whisper
+    words = clean.split()
+    if len(words) >= 3:
+        unique = set(words)
+        if len(unique) <= len(words) * 0.4:
+            logger.debug("Whisper hallucination (repetition): %r", text)
+            return True
+    return False
+
+
+def check_audio(audio: bytes | BinaryIO) -> webm.WebMInfo:
+    """Valida mida, format (WebM amb pista d'àudio) i durada d'un àudio a transcriure.
+
+    Només llegeix les capçaleres del contenidor: un clip buit o massa curt es
+    rebutja aquí, abans de pagar la crida a Whisper.
+    """
+    stream = io.BytesIO(audio) if isinstance(audio, bytes) else audio
+    stream.seek(0, io.SEEK_END)
+    if stream.tell() > MAX_AUDIO_BYTES:
+        raise HTTPException(413, AUDIO_TOO_LARGE)
+    try:
+        info = webm.probe(stream)
+    except webm.WebMError as exc:
+        logger.debug("WebM rebutjat: %s", exc)
+        raise HTTPException(415, "Format d'àudio no vàlid (es requereix WebM)")
+    finally:
+        stream.seek(0)
+    if not info.has_audio:
+        raise HTTPException(415, "El fitxer WebM no conté cap pista d'àudio")
+    if info.duration is None or info.duration < settings.VOICE_MIN_AUDIO_SECONDS:
+        raise HTTPException(422, "L'àudio és massa curt per contenir veu")
+    return info
+
+
+# Resultat ja net ("" si era una al·lucinació) per hash de l'àudio i idioma:
+# un reenviament del mateix clip no torna a pagar Whisper
+_transcripts: LRUCache[str] = LRUCache(
+    settings.TRANSCRIPTION_CACHE_SIZE, ttl=settings.TRANSCRIPTION_CACHE_TTL_SECONDS,
+)
+
+
+def transcription_key(audio: bytes | BinaryIO, lang: str) -> str:
+    """Clau de la memòria cau de transcripcions (llegeix el fitxer per trossos)."""
+    digest = hashlib.sha256(lang.encode() + b"\x00")
+    if isinstance(audio, bytes):
+        digest.update(audio)
+    else:
+        audio.seek(0)
+        while chunk := audio.read(_HASH_CHUNK):
+            digest.update(chunk)
+        audio.seek(0)
+    return digest.hexdigest()
+
+
+def cached_transcription(key: str) -> str | None:
+    return _transcripts.get(key)
+
+
+def transcripts_snapshot() -> dict:
+    return _transcripts.snapshot()
+
+
+async def _whisper(audio: bytes | BinaryIO, lang: str) -> str:
+    response = await get_client(OPENAI).post(
+        "/audio/transcriptions",
+        files={"file": ("audio.webm", audio, "audio/webm")},
+        data={"model": "whisper-1", "language": lang},
+        timeout=settings.VOICE_TRANSCRIBE_TIMEOUT,
+    )
+    if response.status_code != 200:
+        raise HTTPException(502, f"Transcription failed: {response.text}")
+    return response.json().get("text", "").strip()
+
+
+async def _transcribe_chunks(chunks: list[bytes], lang: str) -> str:
+    """Transcriu els trossos alhora (acotat) i els torna a unir en ordre.
+
+    El filtre d'al·lucinacions s'aplica a cada tros: el silenci d'un tros no
+    embruta el text de la resta.
+    """
+    slots = asyncio.Semaphore(settings.VOICE_CHUNK_MAX_PARALLEL)
+
+    async def one(chunk: bytes) -> str:
+        async with slots:
+            text = await _whisper(chunk, lang)
+        return "" if _is_hallucination(text) else text
+
+    texts = await asyncio.gather(*(one(chunk) for chunk in chunks))
+    return " ".join(t for t in texts if t)
+
+
+def _chunks_for(audio: bytes | BinaryIO, info: webm.WebMInfo | None) -> list[bytes]:
+    threshold = settings.VOICE_CHUNKED_TRANSCRIPTION_SECONDS
+    if info is None or not threshold or info.duration is None or info.duration <= threshold:
+        return []
+    stream = io.BytesIO(audio) if isinstance(audio, bytes) else audio
+    return webm.split(stream, info, settings.VOICE_CHUNK_SECONDS)
+
+
+async def transcribe(
+    audio: bytes | BinaryIO, lang: str, key: str | None = None, info: webm.WebMInfo | None = None,
+) -> str:
+    """Transcriu un àudio WebM; retorna "" si el resultat sembla una al·lucinació.
+
+    Accepta el fitxer pujat tal qual: httpx el llegeix per trossos en construir
+    el cos multipart, sense fer-ne una segona còpia a memòria. Amb *key*
+    (transcription_key) el resultat es desa per als reenviaments. Amb *info*
+    (check_audio) un clip llarg es transcriu per trossos en paral·lel.
+    """
+    if not settings.DispatchSimKeyOpenAI:
+        raise HTTPException(503, "Transcription service not configured")
+
+    chunks = _chunks_for(audio, info)
+    if chunks:
+        logger.debug("Transcribing %.1fs clip in %d chunks", info.duration, len(chunks))
+        text = await _transcribe_chunks(chunks, lang)
+    else:
+        if not isinstance(audio, bytes):
+            audio.seek(0)
+        text = await _whisper(audio, lang)
+        if _is_hallucination(text):
+            text = ""
+    if key is not None:
+        _transcripts.set(key, text)
+    return text
+
+
+_EL_MODEL  = "eleven_multilingual_v2"
+_OAI_MODEL = "tts-1-hd"
+
+
+def _oai_voice(voice: str) -> str:
+    return EL_TO_OAI_VOICE.get(voice, voice if voice in _OAI_VOICES else "nova")
+
+
+def _el_key(text: str, voice: str) -> str:
+    return speech_key(ELEVENLABS, _EL_MODEL, voice, EL_VOICE_SETTINGS.get(voice, EL_DEFAULT_SETTINGS), text)
+
+
+def _oai_key(text: str, voice: str) -> str:
+    return speech_key(OPENAI, _OAI_MODEL, _oai_voice(voice), None, text)
+
+
+async def _cached(key: str) -> bytes | None:
+    if not tts_cache.enabled:
+        return None
+    return await asyncio.to_thread(tts_cache.get, key)
+
+
+async def _store(key: str, audio: bytes) -> None:
+    if tts_cache.enabled:
+        await asyncio.to_thread(tts_cache.put, key, audio)
+
+
+async def synthesize(text: str, voice: str) -> bytes:
+    """Sintetitza *text* a MP3. *voice* és un id d'ElevenLabs o una veu d'OpenAI."""
+    _, audio, _ = await synthesize_keyed(text, voice)
+    return audio
+
+
+async def synthesize_keyed(text: str, voice: str) -> tuple[str, bytes, bool]:
+    """Com synthesize(), però retorna (clau a la memòria cau, mp3, si ja hi era)."""
+    key, chunks, hit = await stream_speech(text, voice)
+    return key, b"".join([chunk async for chunk in chunks]), hit
+
+
+async def _single(audio: bytes) -> AsyncIterator[bytes]:
+    yield audio
+
+
+class _NoAudio(Exception):
+    """El proveïdor ha respost sense àudio.
+
+    `provider_fault` és fals si l'error és de la petició (4xx que no sigui
+    429): no diu res de la salut del proveïdor.
+    """
+
+    def __init__(self, provider_fault: bool = True):
+        super().__init__()
+        self.provider_fault = provider_fault
+
+
+def _provider_fault(status_code: int) -> bool:
+    return status_code >= 500 or status_code == 429
+
+
+async def _open_stream(
+    provider: str, url: str, payload: dict,
+) -> tuple[httpx.Response, AsyncIterator[bytes], bytes] | None:
+    """Obre la resposta en streaming i n'espera el primer tros.
+
+    Retorna None si el proveïdor falla abans d'enviar cap byte, o no n'envia
+    cap en VOICE_TTS_FIRST_BYTE_TIMEOUT (encara es pot provar el següent); la
+    resposta queda oberta si tot va bé. El resultat es registra a la salut
+    del proveïdor, tret dels 4xx causats per la petició (p. ex. una veu que
+    no existeix), que no són culpa seva.
+    """
+    client = get_client(provider)
+    response = None
+    start = time.perf_counter()
+    try:
+        async with asyncio.timeout(settings.VOICE_TTS_FIRST_BYTE_TIMEOUT):
+            response = await client.send(client.build_request("POST", url, json=payload), stream=True)
+            if response.status_code != 200:
+                await response.aread()
+                logger.error("%s TTS error %s: %s", provider, response.status_code, response.text[:300])
+                raise _NoAudio(_provider_fault(response.status_code))
+            chunks = response.aiter_bytes()
+            first = b""
+            while not first:
+                first = await anext(chunks, None)
+                if first is None:
+                    logger.error("%s TTS returned no audio", provider)
+                    raise _NoAudio
+    except (_NoAudio, httpx.HTTPError, TimeoutError) as exc:
+        if isinstance(exc, httpx.HTTPError):
+            logger.error("%s TTS request failed: %s", provider, exc)
+        elif isinstance(exc, TimeoutError):
+            logger.error("%s TTS sent no audio in %.0fs", provider, settings.VOICE_TTS_FIRST_BYTE_TIMEOUT)
+        if not isinstance(exc, _NoAudio) or exc.provider_fault:
+            health[provider].record(False, time.perf_counter() - start)
+        if response is not None:
+            await response.aclose()
+        return None
+    health[provider].record(True, time.perf_counter() - start)
+    return response, chunks, first
+
+
+async def _relay(
+    key: str, provider: str, response: httpx.Response, chunks: AsyncIterator[bytes], first: bytes,
+) -> AsyncIterator[bytes]:
+    """Passa l'àudio del proveïdor tal com arriba i el desa a la memòria cau en acabar."""
+    parts = [first]
+    complete = False
+    try:
+        yield first
+        async for chunk in chunks:
+            parts.append(chunk)
+            yield chunk
+        complete = True
+    except httpx.HTTPError as exc:
+        # Ja s'han enviat bytes: no es pot canviar de proveïdor, l'àudio queda tallat
+        logger.error("TTS stream interrupted after %d chunks: %s", len(parts), exc)
+        health[provider].record(False, 0.0)
+    finally:
+        await response.aclose()
+    if complete:
+        await _store(key, b"".join(parts))
+
+
+async def stream_speech(text: str, voice: str) -> tuple[str, AsyncIterator[bytes], bool]:
+    """Síntesi en streaming: retorna (clau, trossos d'mp3, si ja era a la memòria cau).
+
+    El canvi a OpenAI només és possible si ElevenLabs falla abans del primer
+    byte; per això aquesta funció no retorna fins que en té un.
+    """
+    # ElevenLabs tiene prioridad si está configurado
+    if settings.DispatchSimKeyEleven:
+        key = _el_key(text, voice)
+        if (audio := await _cached(key)) is not None:
+            return key, _single(audio), True
+        # Si se sabe que está caído no se espera su timeout: directamente OpenAI
+        if health[ELEVENLABS].allow() or not settings.DispatchSimKeyOpenAI:
+            opened = await _open_stream(ELEVENLABS, f"/text-to-speech/{voice}/stream", {
+                "text": text,
+                "model_id": _EL_MODEL,
+                "voice_settings": EL_VOICE_SETTINGS.get(voice, EL_DEFAULT_SETTINGS),
+            })
+            if opened is not None:
+                return key, _relay(key, ELEVENLABS, *opened), False
+        # Si ElevenLabs falla, intentar OpenAI como fallback
+
+    # OpenAI TTS (amb la seva pròpia clau: és una altra veu)
+    key = _oai_key(text, voice)
+    if (audio := await _cached(key)) is not None:
+        return key, _single(audio), True
+    if not settings.DispatchSimKeyOpenAI:
+        raise HTTPException(503, "TTS service not configured")
+
+    opened = await _open_stream(OPENAI, "/audio/speech", {
+        "model": _OAI_MODEL, "input": text, "voice": _oai_voice(voice),
+    })
+    if opened is None:
+        raise HTTPException(502, "TTS failed")
+    return key, _relay(key, OPENAI, *opened), False
+
+
+# ── Pre-síntesi de respostes ────────────────────────────────────────────────
+# Amb TTS_PRESYNTHESIZE, la resposta d'un torn es comença a sintetitzar tan
+# bon punt existeix. Quan el navegador la demana a /voice/speak, l'àudio ja hi
+# és (o s'espera la mateixa síntesi) en lloc de fer una segona crida.
+
+_presynth: LRUCache[asyncio.Task] = LRUCache(
+    settings.TTS_PRESYNTH_CACHE_SIZE, ttl=settings.TTS_PRESYNTH_TTL_SECONDS,
+)
+
+
+def _presynth_done(task: asyncio.Task) -> None:
+    if not task.cancelled() and (exc := task.exception()) is not None:
+        logger.warning("Pre-síntesi fallida: %s", exc)
+
+
+def presynthesize(text: str, voice: str) -> None:
+    """Comença a sintetitzar en segon pla l'àudio que es demanarà a /voice/speak."""
+    text = text.strip()
+    if not text:
+        return
+    task = asyncio.create_task(synthesize_keyed(text, voice))
+    task.add_done_callback(_presynth_done)
+    _presynth.set((text, voice), task)
+
+
+async def presynthesized(text: str, voice: str) -> tuple[str, bytes] | None:
+    """(clau, mp3) de la pre-síntesi d'aquest text, esperant-la si encara corre; None si no n'hi ha."""
+    task = _presynth.get((text.strip(), voice))
+    if task is None or task.get_loop() is not asyncio.get_running_loop():
+        return None
+    try:
+        # shield: si el client es desconnecta, la síntesi continua per al següent
+        key, audio, _ = await asyncio.shield(task)
+    except asyncio.CancelledError:
+        if asyncio.current_task().cancelling():
+            raise
+        return None
+    except Exception:
+        return None  # ja s'ha registrat; es torna a provar en directe
+    return key, audio
+
+
+def presynth_snapshot() -> dict:
+    return {"enabled": settings.TTS_PRESYNTHESIZE, **_presynth.snapshot()}
+
+
+# ── Síntesi per frases ───────────────────────────────────────────────────────
+# Mentre la IA encara genera, cada frase completa ja s'envia a sintetitzar;
+# l'alertant comença a parlar quan la primera frase està llesta.
+
+# Final de frase: puntuació (i cometes/parèntesis de tancament) seguida d'espai
+_SENTENCE_END_RE = re.compile(r'[.!?…]+["»”\')]*\s+|\n+')
+
+
+class SentenceSplitter:
+    """Talla un text que arriba a trossos en frases completes."""
+
+    def __init__(self):
+        self._buffer = ""
+
+    def feed(self, chunk: str) -> list[str]:
+        self._buffer += chunk
+        sentences = []
+        start = 0
+        for match in _SENTENCE_END_RE.finditer(self._buffer):
+            sentence = self._buffer[start:match.end()].strip()
+            if sentence:
+                sentences.append(sentence)
+            start = match.end()
+        self._buffer = self._buffer[start:]
+        return sentences
+
+    def flush(self) -> str:
+        tail, self._buffer = self._buffer.strip(), ""
+        return tail
+
+
+class SpeechPipeline:
+    """Sintetitza frase a frase i lliura l'àudio en ordre.
+
+    `feed()` rep el text a mesura que es genera; cada frase completa es
+    comença a sintetitzar de seguida (fins a `max_parallel` alhora).
+    `segments()` retorna (frase, mp3) en l'ordre del text.
+    """
+
+    def __init__(self, voice: str, max_parallel: int = 2):
+        self._voice    = voice
+        self._splitter = SentenceSplitter()
+        self._limit    = asyncio.Semaphore(max_parallel)
+        self._queue: asyncio.Queue[tuple[str, asyncio.Task] | None] = asyncio.Queue()
+        self._tasks: list[asyncio.Task] = []
+
+    async def _synthesize(self, sentence: str) -> bytes:
+        async with self._limit:
+            return await synthesize(sentence, self._voice)
+
+    def _start(self, sentence: str) -> None:
+        task = asyncio.create_task(self._synthesize(sentence))
+        self._tasks.append(task)
+        self._queue.put_nowait((sentence, task))
+
+    def feed(self, text: str) -> None:
+        for sentence in self._splitter.feed(text):
+            self._start(sentence)
+
+    def close(self) -> None:
+        """No hi haurà més text: sintetitza el que quedi i tanca la seqüència."""
+        tail = self._splitter.flush()
+        if tail:
+            self._start(tail)
+        self._queue.put_nowait(None)
+
+    def cancel(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        self._queue.put_nowait(None)
+
+    async def segments(self) -> AsyncIterator[tuple[str, bytes]]:
+        try:
+            while (item := await self._queue.get()) is not None:
+                sentence, task = item
+                yield sentence, await task
+        finally:
+            for task in self._tasks:
+                task.cancel()
@@ -0,0 +1,264 @@
+"""
+Lector mínim de contenidors WebM (EBML/Matroska) per validar àudio abans de
+pagar una transcripció: comprova la capçalera, llegeix les pistes i calcula
+la durada. Només llegeix capçaleres d'elements; el contingut dels blocs es
+salta amb seek, de manera que no cal carregar el fitxer a memòria.
+
+Els clips de MediaRecorder no porten Duration i tenen Segment i Cluster de
+mida desconeguda, així que la durada es dedueix dels timecodes dels blocs.
+"""
+import io
+import struct
+from dataclasses import dataclass, field
+from typing import BinaryIO
+
+EBML_MAGIC = b'\x1a\x45\xdf\xa3'
+
+# IDs d'element (amb els bits de marca de longitud inclosos)
+_EBML          = 0x1A45DFA3
+_DOCTYPE       = 0x4282
+_SEGMENT       = 0x18538067
+_INFO          = 0x1549A966
+_TIMECODESCALE = 0x2AD7B1
+_DURATION      = 0x4489
+_TRACKS        = 0x1654AE6B
+_TRACK_ENTRY   = 0xAE
+_TRACK_NUMBER  = 0xD7
+_TRACK_TYPE    = 0x83
+_CODEC_ID      = 0x86
+_CLUSTER       = 0x1F43B675
+_TIMECODE      = 0xE7
+_SIMPLE_BLOCK  = 0xA3
+_BLOCK_GROUP   = 0xA0
+_BLOCK         = 0xA1
+
+_TRACK_TYPE_AUDIO = 2
+# Elements que es recorren per dins (la resta se salten sencers)
+_MASTERS = {_SEGMENT, _INFO, _TRACKS, _TRACK_ENTRY, _CLUSTER, _BLOCK_GROUP}
+# Mida "desconeguda": tots els bits de valor a 1
+_UNKNOWN = object()
+
+
+class WebMError(ValueError):
+    """El fitxer no és un WebM llegible."""
+
+
+@dataclass
+class WebMTrack:
+    number: int
+    type: int
+    codec: str
+
+    @property
+    def is_audio(self) -> bool:
+        return self.type == _TRACK_TYPE_AUDIO
+
+
+@dataclass
+class WebMInfo:
+    doc_type: str
+    duration: float | None   # segons; None si no hi ha cap bloc
+    tracks: list[WebMTrack] = field(default_factory=list)
+    timecode_scale: int = 1_000_000
+    # Posició de cada Cluster al fitxer i el seu timecode (per tallar-lo)
+    clusters: list[tuple[int, int]] = field(default_factory=list)
+    # Posició i longitud del camp de mida del Segment
+    segment_size: tuple[int, int] | None = None
+
+    @property
+    def has_audio(self) -> bool:
+        return any(t.is_audio for t in self.tracks)
+
+
+def _read_vint(stream: BinaryIO, keep_marker: bool) -> tuple[int | object, int] | None:
+    """Llegeix un enter de longitud variable EBML; None al final del fitxer."""
+    first = stream.read(1)
+    if not first:
+        return None
+    b = first[0]
+    if b == 0:
+        raise WebMError("vint invàlid")
+    length = 8 - b.bit_length() + 1
+    rest = stream.read(length - 1)
+    if len(rest) != length - 1:
+        raise WebMError("fitxer tallat")
+    value = b if keep_marker else b & (0xFF >> length)
+    all_ones = value == (0xFF >> length) and not keep_marker
+    for byte in rest:
+        value = (value << 8) | byte
+        all_ones = all_ones and byte == 0xFF
+    if all_ones:
+        return _UNKNOWN, length
+    return value, length
+
+
+def _read_uint(data: bytes) -> int:
+    return int.from_bytes(data, "big")
+
+
+def _read_float(data: bytes) -> float:
+    if len(data) == 4:
+        return struct.unpack(">f", data)[0]
+    if len(data) == 8:
+        return struct.unpack(">d", data)[0]
+    raise WebMError("float invàlid")
+
+
+def probe(stream: BinaryIO) -> WebMInfo:
+    """Analitza un WebM des de la posició actual de *stream* (ha de permetre seek)."""
+    stream.seek(0, 2)
+    end = stream.tell()
+    stream.seek(0)
+    if stream.read(4) != EBML_MAGIC:
+        raise WebMError("capçalera EBML absent")
+    stream.seek(0)
+
+    doc_type = ""
+    scale = 1_000_000           # ns per unitat de timecode (valor per defecte)
+    declared_duration = None
+    tracks: list[WebMTrack] = []
+    track: dict = {}
+    cluster_time = 0
+    first_ts = last_ts = None
+
+    clusters: list[list[int]] = []
+    segment_size = None
+
+    while stream.tell() < end:
+        element_start = stream.tell()
+        header = _read_vint(stream, keep_marker=True)
+        if header is None:
+            break
+        element_id, _ = header
+        size_start = stream.tell()
+        size_vint = _read_vint(stream, keep_marker=False)
+        if size_vint is None:
+            raise WebMError("fitxer tallat")
+        size, size_len = size_vint
+
+        if element_id in _MASTERS:
+            # Es recorre per dins: els fills segueixen a continuació
+            if element_id == _TRACK_ENTRY:
+                if track:
+                    tracks.append(_track(track))
+                track = {}
+            elif element_id == _CLUSTER:
+                clusters.append([element_start, 0])
+            elif element_id == _SEGMENT and segment_size is None:
+                segment_size = (size_start, size_len)
+            continue
+        # Només els elements que es recorren per dins poden tenir mida desconeguda
+        if size is _UNKNOWN:
+            raise WebMError("element de mida desconeguda inesperat")
+        if element_id == _EBML:
+            doc_type = _ebml_doc_type(stream.read(size))
+            continue
+        if stream.tell() + size > end:
+            break  # l'últim element està tallat: es fa servir el que s'ha llegit
+
+        if element_id in (_SIMPLE_BLOCK, _BLOCK):
+            start = stream.tell()
+            track_vint = _read_vint(stream, keep_marker=False)
+            if track_vint is None:
+                break
+            # El bloc ha de contenir almenys la pista i el timecode (2 bytes)
+            if size < track_vint[1] + 2:
+                raise WebMError("bloc massa curt")
+            ts = cluster_time + struct.unpack(">h", stream.read(2))[0]
+            first_ts = ts if first_ts is None else min(first_ts, ts)
+            last_ts = ts if last_ts is None else max(last_ts, ts)
+            stream.seek(start + size)
+        elif element_id in (_TIMECODESCALE, _TIMECODE, _TRACK_NUMBER, _TRACK_TYPE):
+            value = _read_uint(stream.read(size))
+            if element_id == _TIMECODESCALE:
+                scale = value
+            elif element_id == _TIMECODE:
+                cluster_time = value
+                if clusters:
+                    clusters[-1][1] = value
+            elif element_id == _TRACK_NUMBER:
+                track["number"] = value
+            else:
+                track["type"] = value
+        elif element_id == _DURATION:
+            declared_duration = _read_float(stream.read(size))
+        elif element_id == _CODEC_ID:
+            track["codec"] = stream.read(size).decode("ascii", "replace")
+        else:
+            stream.seek(size, 1)
+
+    if track:
+        tracks.append(_track(track))
+    if not doc_type:
+        raise WebMError("capçalera EBML sense DocType")
+
+    if declared_duration is not None:
+        duration = declared_duration * scale / 1e9
+    elif first_ts is not None:
+        duration = (last_ts - first_ts) * scale / 1e9
+    else:
+        duration = None
+    return WebMInfo(
+        doc_type=doc_type,
+        duration=duration,
+        tracks=tracks,
+        timecode_scale=scale,
+        clusters=[(offset, timecode) for offset, timecode in clusters],
+        segment_size=segment_size,
+    )
+
+
+def split(stream: BinaryIO, info: WebMInfo, max_seconds: float) -> list[bytes]:
+    """Talla el WebM en fitxers independents d'uns *max_seconds*, sempre entre Clusters.
+
+    Cada tros porta la capçalera original (EBML, Info, Tracks) amb la mida del
+    Segment marcada com a desconeguda, seguida dels seus Clusters sencers.
+    Retorna [] si no es pot tallar (un sol Cluster o sense Segment).
+    """
+    if info.segment_size is None or len(info.clusters) < 2:
+        return []
+    stream.seek(0, 2)
+    end = stream.tell()
+
+    # Clusters agrupats fins a omplir max_seconds cadascun
+    limit = max_seconds * 1e9 / info.timecode_scale
+    groups: list[tuple[int, int]] = []
+    group_start, group_time = info.clusters[0]
+    for offset, timecode in info.clusters[1:]:
+        if timecode - group_time >= limit:
+            groups.append((group_start, offset))
+            group_start, group_time = offset, timecode
+    groups.append((group_start, end))
+    if len(groups) < 2:
+        return []
+
+    stream.seek(0)
+    header = bytearray(stream.read(info.clusters[0][0]))
+    size_at, size_len = info.segment_size
+    # Mida desconeguda amb la mateixa longitud: la resta d'offsets no es mouen
+    header[size_at:size_at + size_len] = ((1 << (7 * size_len + 1)) - 1).to_bytes(size_len, "big")
+    pieces = []
+    for start, stop in groups:
+        stream.seek(start)
+        pieces.append(bytes(header) + stream.read(stop - start))
+    stream.seek(0)
+    return pieces
+
+
+def _ebml_doc_type(body: bytes) -> str:
+    stream = io.BytesIO(body)
+    while True:
+        header = _read_vint(stream, keep_marker=True)
+        if header is None:
+            return ""
+        element_id, _ = header
+        size_vint = _read_vint(stream, keep_marker=False)
+        if size_vint is None or size_vint[0] is _UNKNOWN:
+            return ""
+        data = stream.read(size_vint[0])
+        if element_id == _DOCTYPE:
+            return data.decode("ascii", "replace").rstrip("\x00")
+
+
+def _track(fields: dict) -> WebMTrack:
+    return WebMTrack(number=fields.get("number", 0), type=fields.get("type", 0), codec=fields.get("codec", ""))
@@ -42,7 +42,11 @@ export const useCallStore = defineStore('call', () => {
     const chat      = useChatStore()
     const scenarios = useScenarioStore()
     try {
-      const inc = await apiFetch<Incident>('/api/v1/incidents', { method: 'POST', body: JSON.stringify(body) })
+      const inc = await apiFetch<Incident>('/api/v1/incidents', {
+        method: 'POST',
+        // lang: el backend pregenera la primera frase de l'alertant en aquest idioma
+        body: JSON.stringify({ ...body, lang: localStorage.getItem('dispatch_lang') || 'ca' }),
+      })
       currentIncidentId.value = inc.id
       sessionIncidents.value.push(inc)
       chat.resetChat()
@@ -0,0 +1,124 @@
+"""
+Micro-benchmark dels rate limiters: memòria per clau i temps de check()
+(que és tot el temps amb el lock agafat).
+
+    python scripts/bench_rate_limit.py
+"""
+import gc
+import sys
+import time
+import tracemalloc
+from collections import defaultdict, deque
+from pathlib import Path
+from threading import Lock
+
+from fastapi import HTTPException
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from app.core import rate_limit  # noqa: E402
+from app.core.rate_limit import GCRALimiter  # noqa: E402
+
+
+class SlidingWindowLimiter:
+    """Limitador anterior (una deque de marques de temps per clau), com a referència."""
+
+    def __init__(self, max_calls: int, period_seconds: int):
+        self._max    = max_calls
+        self._period = period_seconds
+        self._calls: dict[str, deque] = defaultdict(deque)
+        self._lock   = Lock()
+
+    def check(self, key: str) -> None:
+        # Mateix rellotge que rate_limit: check_times() el substitueix als dos
+        now    = rate_limit.time.monotonic()
+        cutoff = now - self._period
+        with self._lock:
+            dq = self._calls[key]
+            while dq and dq[0] < cutoff:
+                dq.popleft()
+            if len(dq) >= self._max:
+                raise HTTPException(status_code=429, detail="Massa peticions")
+            dq.append(now)
+
+
+def _gcra(max_calls: int, period_seconds: int) -> GCRALimiter:
+    # Ràfega sencera, com la finestra lliscant: el benchmark en fa de max_calls
+    return GCRALimiter(max_calls, period_seconds, burst=max_calls)
+
+
+LIMITERS = {"sliding": SlidingWindowLimiter, "gcra": _gcra}
+
+
+def memory_per_key(factory, keys: int, calls_per_key: int) -> float:
+    """Bytes per clau després d'un atac amb `keys` usernames diferents."""
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    limiter = factory(max_calls=calls_per_key, period_seconds=60)
+    for i in range(keys):
+        for _ in range(calls_per_key):
+            limiter.check(f"user-{i}")
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    total = sum(stat.size_diff for stat in after.compare_to(before, "filename"))
+    return total / keys
+
+
+class _Clock:
+    """Rellotge manual: el benchmark avança el temps sense esperar."""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self) -> float:
+        return self.now
+
+
+def check_times(factory, max_calls: int, keys: int) -> tuple[float, float]:
+    """(mitjana, pitjor) en µs per check() en estat estacionari.
+
+    `keys` clients fan ràfegues de `max_calls` crides; després passa un
+    període sencer i es mesura cada check() de la ronda següent, que és quan
+    cal descartar l'estat caducat.
+    """
+    clock = _Clock()
+    rate_limit.time = clock
+    try:
+        limiter = factory(max_calls=max_calls, period_seconds=60)
+        for i in range(keys):
+            for _ in range(max_calls):
+                limiter.check(f"user-{i}")
+        clock.now += 61
+        samples = []
+        gc.disable()
+        for i in range(keys):
+            start = time.perf_counter()
+            try:
+                limiter.check(f"user-{i}")
+            except HTTPException:
+                pass
+            samples.append(time.perf_counter() - start)
+    finally:
+        gc.enable()
+        rate_limit.time = time
+    return sum(samples) / len(samples) * 1e6, max(samples) * 1e6
+
+
+def main() -> None:
+    print("Memòria per clau (bytes):")
+    print(f"  {'claus':>8} {'crides':>7}" + "".join(f"{name:>12}" for name in LIMITERS))
+    for keys, calls in ((1_000, 5), (100_000, 5), (10_000, 100)):
+        row = "".join(f"{memory_per_key(factory, keys, calls):>12.0f}" for factory in LIMITERS.values())
+        print(f"  {keys:>8} {calls:>7}{row}")
+
+    print("\nTemps per check() (lock agafat) després de caducar la finestra, µs (mitjana / pitjor):")
+    print(f"  {'max_calls':>9} {'claus':>7}" + "".join(f"{name:>18}" for name in LIMITERS))
+    for max_calls, keys in ((5, 10_000), (1_000, 100), (10_000, 10)):
+        row = "".join(
+            f"{'%.2f / %.1f' % check_times(factory, max_calls, keys):>18}" for factory in LIMITERS.values()
+        )
+        print(f"  {max_calls:>9} {keys:>7}{row}")
+
+
+if __name__ == "__main__":
+    main()
@@ -9,13 +9,18 @@ os.environ.update({
     "DEBUG": "true",
     "ANTHROPIC_API_KEY": "test-key",
     "DispatchSimKeyOpenAI": "test-key",
+    "TTS_CACHE_MAX_BYTES": "0",
 })
 
 from app.main import app  # noqa: E402
 from app.db.session import engine, get_session  # noqa: E402
 from app.core.security import hash_password  # noqa: E402
-from app.core.rate_limit import login_limiter, chat_limiter, transcribe_limiter, tts_limiter  # noqa: E402
+from app.core import deps  # noqa: E402
+from app.core.rate_limit import login_limiter, chat_limiter, speculate_limiter, transcribe_limiter, tts_limiter  # noqa: E402
 from app.models.user import User, UserRole  # noqa: E402
+from app.api.v1.endpoints.simulation import _replies as simulation_replies  # noqa: E402
+from app.services import http_clients, simulation_service, usage_ledger, voice_service  # noqa: E402
+from app.services.ai_service import ai_breaker, ai_latency, summary_latency  # noqa: E402
 
 
 @pytest.fixture(autouse=True)
@@ -25,8 +30,21 @@ def setup_db():
     yield
     SQLModel.metadata.drop_all(engine)
     # Reset rate limiters between tests
-    for limiter in (login_limiter, chat_limiter, transcribe_limiter, tts_limiter):
-        limiter._calls.clear()
+    for limiter in (login_limiter, chat_limiter, speculate_limiter, transcribe_limiter, tts_limiter):
+        limiter.reset()
+    deps._tokens.clear()
+    deps._users.clear()
+    ai_breaker.reset()
+    ai_latency._samples.clear()
+    summary_latency._samples.clear()
+    usage_ledger._pending.clear()
+    simulation_service._call_states.clear()
+    simulation_service._speculations.clear()
+    simulation_replies.clear()
+    voice_service._transcripts.clear()
+    voice_service._presynth.clear()
+    for tracker in http_clients.health.values():
+        tracker.reset()
 
 
 @pytest.fixture
@@ -84,3 +102,37 @@ def operator_token(client, operator_user):
 
 def auth_header(token: str) -> dict:
     return {"Authorization": f"Bearer {token}"}
+
+
+def ebml_element(element_id: int, body: bytes, unknown_size: bool = False) -> bytes:
+    head = element_id.to_bytes((element_id.bit_length() + 7) // 8, "big")
+    size = b"\x01\xff\xff\xff\xff\xff\xff\xff" if unknown_size else (0x10 << 24 | len(body)).to_bytes(4, "big")
+    return head + size + body
+
+
+def webm_clip(duration_ms: int = 1500, audio: bool = True, frame_ms: int = 20, cluster_ms: int = 30_000) -> bytes:
+    """Minimal WebM as MediaRecorder writes it: unknown-size Segment/Cluster, no Duration.
+
+    A new Cluster starts every *cluster_ms*.
+    """
+    track = (
+        ebml_element(0xD7, b"\x01")
+        + ebml_element(0x83, b"\x02" if audio else b"\x01")
+        + ebml_element(0x86, b"A_OPUS" if audio else b"V_VP8")
+    )
+    clusters = b""
+    for cluster_ts in range(0, duration_ms + 1, cluster_ms):
+        blocks = b"".join(
+            ebml_element(0xA3, b"\x81" + (ts - cluster_ts).to_bytes(2, "big") + b"\x80" + b"\x00" * 16)
+            for ts in range(cluster_ts, min(cluster_ts + cluster_ms, duration_ms + 1), frame_ms)
+        )
+        timecode = ebml_element(0xE7, cluster_ts.to_bytes(4, "big"))
+        clusters += ebml_element(0x1F43B675, timecode + blocks, unknown_size=True)
+    return (
+        ebml_element(0x1A45DFA3, ebml_element(0x4282, b"webm"))
+        + ebml_element(0x18538067, (
+            ebml_element(0x1549A966, ebml_element(0x2AD7B1, (1_000_000).to_bytes(3, "big")))
+            + ebml_element(0x1654AE6B, ebml_element(0xAE, track))
+            + clusters
+        ), unknown_size=True)
+    )
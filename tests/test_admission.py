@@ -0,0 +1,85 @@
+import asyncio
+
+import pytest
+from fastapi import HTTPException
+
+from app.core.admission import PRIORITY_OPERATOR, PRIORITY_SILENCE, AdmissionController
+
+
+def _controller(**kw) -> AdmissionController:
+    return AdmissionController("t", **{"max_concurrent": 1, "max_queue": 4, "retry_after_seconds": 3, **kw})
+
+
+class TestAdmissionController:
+    def test_caps_concurrency(self):
+        ctl = _controller(max_concurrent=2)
+        running = peak = 0
+
+        async def job():
+            nonlocal running, peak
+            async with ctl.slot():
+                running += 1
+                peak = max(peak, running)
+                await asyncio.sleep(0.02)
+                running -= 1
+
+        async def main():
+            await asyncio.gather(*[job() for _ in range(4)])
+
+        asyncio.run(main())
+        assert peak == 2
+        assert ctl.snapshot()["admitted"] == 4
+        assert ctl.snapshot()["active"] == 0
+
+    def test_full_queue_returns_503_with_retry_after(self):
+        ctl = _controller(max_queue=1)
+
+        async def main():
+            async with ctl.slot():
+                waiter = asyncio.create_task(ctl._acquire(PRIORITY_OPERATOR, 0))
+                await asyncio.sleep(0)
+                with pytest.raises(HTTPException) as exc_info:
+                    await ctl._acquire(PRIORITY_OPERATOR, 0)
+                waiter.cancel()
+            return exc_info.value
+
+        exc = asyncio.run(main())
+        assert exc.status_code == 503
+        assert exc.headers["Retry-After"] == "3"
+        assert ctl.snapshot()["rejected"] == 1
+
+    def test_operator_turns_before_silence_then_by_priority(self):
+        ctl = _controller()
+        order: list[str] = []
+
+        async def job(name, turn_class, priority):
+            async with ctl.slot(turn_class, priority):
+                order.append(name)
+
+        async def main():
+            async with ctl.slot():
+                tasks = [
+                    asyncio.create_task(job("silence", PRIORITY_SILENCE, 5)),
+                    asyncio.create_task(job("op-p2", PRIORITY_OPERATOR, 2)),
+                    asyncio.create_task(job("op-p5", PRIORITY_OPERATOR, 5)),
+                ]
+                await asyncio.sleep(0)
+                assert ctl.queue_depth == 3
+            await asyncio.gather(*tasks)
+
+        asyncio.run(main())
+        assert order == ["op-p5", "op-p2", "silence"]
+
+    def test_cancelled_waiter_does_not_leak_slot(self):
+        ctl = _controller()
+
+        async def main():
+            async with ctl.slot():
+                waiter = asyncio.create_task(ctl._acquire(PRIORITY_OPERATOR, 0))
+                await asyncio.sleep(0)
+                waiter.cancel()
+            async with ctl.slot() as wait:
+                return wait
+
+        assert asyncio.run(main()) == 0.0
+        assert ctl.snapshot()["active"] == 0
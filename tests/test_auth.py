@@ -3,8 +3,10 @@ from datetime import datetime, timedelta, timezone
 from sqlmodel import Session
 
 from tests.conftest import auth_header
+from app.core.deps import forget_user
 from app.core.security import hash_password
 from app.models.user import User, UserRole
+from app.services.cleanup import run_expired_user_cleanup
 
 
 class TestRegister:
@@ -103,3 +105,30 @@ class TestMe:
     def test_me_no_token(self, client):
         res = client.get("/api/v1/auth/me")
         assert res.status_code in (401, 403)  # depends on bearer scheme handling
+
+
+class TestAuthCache:
+    def test_repeat_requests_skip_the_database(self, client, operator_token, operator_user, session):
+        assert client.get("/api/v1/auth/me", headers=auth_header(operator_token)).status_code == 200
+        # Canvi directe a la BD, sense passar per update_user: la memòria cau no ho veu
+        session.delete(operator_user)
+        session.commit()
+        assert client.get("/api/v1/auth/me", headers=auth_header(operator_token)).status_code == 200
+        forget_user(operator_user.id)
+        assert client.get("/api/v1/auth/me", headers=auth_header(operator_token)).status_code == 401
+
+    def test_update_user_invalidates(self, client, admin_token, operator_token, operator_user):
+        assert client.get("/api/v1/auth/me", headers=auth_header(operator_token)).status_code == 200
+        res = client.patch(
+            f"/api/v1/users/{operator_user.id}", json={"is_active": False}, headers=auth_header(admin_token),
+        )
+        assert res.status_code == 200
+        assert client.get("/api/v1/auth/me", headers=auth_header(operator_token)).status_code == 401
+
+    def test_expired_user_cleanup_invalidates(self, client, operator_token, operator_user, session):
+        assert client.get("/api/v1/auth/me", headers=auth_header(operator_token)).status_code == 200
+        operator_user.expires_at = datetime.now(timezone.utc) - timedelta(minutes=1)
+        session.add(operator_user)
+        session.commit()
+        assert run_expired_user_cleanup() == 1
+        assert client.get("/api/v1/auth/me", headers=auth_header(operator_token)).status_code == 401
@@ -0,0 +1,29 @@
+import time
+
+from app.core.cache import LRUCache
+
+
+class TestLRUCache:
+    def test_evicts_least_recently_used(self):
+        cache = LRUCache(maxsize=2)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        cache.get("a")
+        cache.set("c", 3)
+        assert cache.get("b") is None
+        assert cache.get("a") == 1 and cache.get("c") == 3
+
+    def test_ttl_expires_entries(self):
+        cache = LRUCache(maxsize=4, ttl=0.01)
+        cache.set("a", 1)
+        time.sleep(0.02)
+        assert cache.get("a") is None
+        assert len(cache) == 0
+
+    def test_snapshot_counts_hits(self):
+        cache = LRUCache(maxsize=4)
+        cache.set("a", 1)
+        cache.get("a")
+        cache.get("b")
+        snap = cache.snapshot()
+        assert (snap["hits"], snap["misses"], snap["hit_rate"]) == (1, 1, 0.5)
@@ -1,40 +1,226 @@
+import asyncio
+import re
+import threading
+
 import pytest
 from fastapi import HTTPException
+from sqlmodel import select
 
-from app.core.rate_limit import SlidingWindowLimiter
-
+from app.core import rate_limit
+from app.core.rate_limit import GCRALimiter, RedisRateLimitBackend, SQLRateLimitBackend
+from app.core.resilience import CircuitBreaker
+from app.models.rate_limit import RateLimitBucket
 
-class TestSlidingWindowLimiter:
-    def test_allows_within_limit(self):
-        limiter = SlidingWindowLimiter(max_calls=3, period_seconds=60)
-        for _ in range(3):
-            limiter.check("user1")  # should not raise
 
-    def test_blocks_over_limit(self):
-        limiter = SlidingWindowLimiter(max_calls=2, period_seconds=60)
-        limiter.check("user1")
-        limiter.check("user1")
+class TestGCRALimiter:
+    def test_allows_burst_then_blocks(self):
+        limiter = GCRALimiter(max_calls=4, period_seconds=60)   # ràfega de 2, després una cada 20 s
+        for _ in range(2):
+            limiter.check("user1")
         with pytest.raises(HTTPException) as exc_info:
             limiter.check("user1")
         assert exc_info.value.status_code == 429
+        assert "Massa peticions" in exc_info.value.detail
+        assert exc_info.value.headers["Retry-After"] == "20"
+
+    def test_full_burst_then_one_per_period(self):
+        limiter = GCRALimiter(max_calls=5, period_seconds=60, burst=5)
+        for _ in range(5):
+            limiter.check("user1")
+        with pytest.raises(HTTPException) as exc_info:
+            limiter.check("user1")
+        assert exc_info.value.headers["Retry-After"] == "60"
+
+    @pytest.mark.parametrize("burst", [1, None, 5, 10])
+    def test_never_more_than_max_calls_in_any_period(self, monkeypatch, burst):
+        clock = [1000.0]
+        monkeypatch.setattr(rate_limit.time, "monotonic", lambda: clock[0])
+        limiter = GCRALimiter(max_calls=10, period_seconds=60, burst=burst)
+        accepted = []
+        for _ in range(2400):   # un intent cada 0,25 s durant 10 minuts
+            try:
+                limiter.check("user1")
+                accepted.append(clock[0])
+            except HTTPException:
+                pass
+            clock[0] += 0.25
+        first = 0
+        for last, t in enumerate(accepted):
+            while accepted[first] <= t - 60:
+                first += 1
+            assert last - first + 1 <= 10
+        expected_burst = burst or 5
+        # Ritme sostingut: max_calls - burst + 1 per període
+        assert len(accepted) >= expected_burst + (10 - expected_burst + 1) * 10 - 1
+
+    @pytest.mark.parametrize("limiter", rate_limit._limiters, ids=lambda limiter: limiter._name)
+    def test_message_describes_real_policy(self, monkeypatch, limiter):
+        clock = [1000.0]
+        monkeypatch.setattr(rate_limit.time, "monotonic", lambda: clock[0])
+        limiter.reset()
+        allowed = 0
+        with pytest.raises(HTTPException) as exc_info:
+            while True:
+                limiter.check("user1")
+                allowed += 1
+        burst, interval = re.search(
+            r"permeten (\d+) seguides i després una cada ([\d.]+) s", exc_info.value.detail,
+        ).groups()
+        assert allowed == int(burst)
+        clock[0] += float(interval)
+        limiter.check("user1")   # la següent arriba just quan diu el missatge
+        with pytest.raises(HTTPException):
+            limiter.check("user1")
 
     def test_different_keys_independent(self):
-        limiter = SlidingWindowLimiter(max_calls=1, period_seconds=60)
+        limiter = GCRALimiter(max_calls=1, period_seconds=60)
         limiter.check("user1")
-        limiter.check("user2")  # different key, should not raise
+        limiter.check("user2")
 
-    def test_window_expires(self):
+    def test_capacity_refills(self):
         import time
-        limiter = SlidingWindowLimiter(max_calls=1, period_seconds=0.1)  # 100ms window
+        limiter = GCRALimiter(max_calls=3, period_seconds=0.3)   # ràfega de 2, 0.15 s per crida
+        limiter.check("user1")
+        limiter.check("user1")
+        with pytest.raises(HTTPException):
+            limiter.check("user1")
+        time.sleep(0.16)   # una crida recuperada
         limiter.check("user1")
         with pytest.raises(HTTPException):
             limiter.check("user1")
-        time.sleep(0.15)  # wait for window to expire
-        limiter.check("user1")  # should work again
 
-    def test_429_detail_message(self):
-        limiter = SlidingWindowLimiter(max_calls=1, period_seconds=60)
+    def test_idle_keys_are_evicted(self, monkeypatch):
+        clock = [1000.0]
+        monkeypatch.setattr(rate_limit.time, "monotonic", lambda: clock[0])
+        limiter = GCRALimiter(max_calls=5, period_seconds=60)   # una crida costa 60/3 s
+        for i in range(1000):
+            limiter.check(f"attacker-{i}")
+        assert len(limiter) == 1000
+        clock[0] += 21   # cada clau torna a estar buida
+        for i in range(200):
+            limiter.check(f"user-{i}")
+        assert len(limiter) == 200
+
+    def test_reset(self):
+        limiter = GCRALimiter(max_calls=1, period_seconds=60)
+        limiter.check("x")
+        limiter.reset()
         limiter.check("x")
+
+
+class TestSharedBackend:
+    """Dos GCRALimiter amb el mateix nom i backend fan de dos workers."""
+
+    def _workers(self, backend, max_calls=10, lease_calls=1):
+        # burst = max_calls: ràfega sencera, de manera que el límit és fàcil de comptar
+        return [
+            GCRALimiter(max_calls=max_calls, period_seconds=60, burst=max_calls, name="chat",
+                        backend=backend, lease_calls=lease_calls)
+            for _ in range(2)
+        ]
+
+    def test_sql_limit_is_shared_between_workers(self):
+        from app.db.session import engine
+        a, b = self._workers(SQLRateLimitBackend(engine), max_calls=4)
+        a.check("user1")
+        b.check("user1")
+        a.check("user1")
+        b.check("user1")
         with pytest.raises(HTTPException) as exc_info:
-            limiter.check("x")
-        assert "Massa peticions" in exc_info.value.detail
+            a.check("user1")
+        assert exc_info.value.headers["Retry-After"] == "60"
+        b.check("user2")
+
+    def test_lease_avoids_round_trips_until_near_the_limit(self):
+        from app.db.session import engine
+        a, b = self._workers(SQLRateLimitBackend(engine), max_calls=10, lease_calls=3)
+        allowed = 0
+        for limiter in (a, b) * 10:
+            try:
+                limiter.check("user1")
+                allowed += 1
+            except HTTPException:
+                pass
+        assert allowed == 10   # el total entre workers no supera el límit
+        stats = [limiter.snapshot() for limiter in (a, b)]
+        assert sum(s["local"] for s in stats) > 0
+        assert sum(s["round_trips"] for s in stats) < 20
+
+    def test_sql_purge_removes_idle_keys(self, session):
+        from app.db.session import engine
+        backend = SQLRateLimitBackend(engine)
+        backend.acquire("chat:user1", 1, 6.0, 60.0, now=1000.0)
+        backend.acquire("chat:user2", 1, 6.0, 60.0, now=1003.0)
+        assert backend.purge(now=1007.0) == 1
+        assert [row.key for row in session.exec(select(RateLimitBucket)).all()] == ["chat:user2"]
+
+    def test_backend_failure_falls_back_to_local_limit(self):
+        class Broken:
+            name = "broken"
+
+            def acquire(self, *args):
+                raise ConnectionError("down")
+
+        limiter = GCRALimiter(max_calls=1, period_seconds=60, name="chat", backend=Broken())
+        limiter.check("user1")
+        with pytest.raises(HTTPException):
+            limiter.check("user1")
+        assert limiter.snapshot()["fallbacks"] == 2
+
+    def test_outage_opens_breaker_and_stops_round_trips(self):
+        attempts = []
+
+        class Down:
+            name = "down"
+
+            def acquire(self, *args):
+                attempts.append(args)
+                raise ConnectionError("down")
+
+        breaker = CircuitBreaker("rate_limit", failure_threshold=3, reset_seconds=60)
+        limiter = GCRALimiter(max_calls=20, period_seconds=60, name="chat", backend=Down(), breaker=breaker)
+        for _ in range(10):
+            limiter.check("user1")
+        assert len(attempts) == 3
+        snapshot = limiter.snapshot()
+        assert (snapshot["fallbacks"], snapshot["breaker"]) == (10, "open")
+
+    def test_breaker_probe_returns_to_shared_backend(self):
+        from app.db.session import engine
+        breaker = CircuitBreaker("rate_limit", failure_threshold=1, reset_seconds=60)
+        breaker.record_failure()
+        limiter = GCRALimiter(max_calls=5, period_seconds=60, name="chat",
+                              backend=SQLRateLimitBackend(engine), breaker=breaker)
+        limiter.check("user1")
+        assert limiter.snapshot()["round_trips"] == 0
+        breaker.reset()
+        limiter.check("user1")
+        assert limiter.snapshot()["round_trips"] == 1
+
+    def test_acheck_runs_round_trip_off_the_event_loop(self):
+        threads = []
+
+        class Recording:
+            name = "recording"
+
+            def acquire(self, key, cells, interval, limit, now):
+                threads.append(threading.get_ident())
+                return True, now + cells * interval
+
+        limiter = GCRALimiter(max_calls=5, period_seconds=60, name="chat", backend=Recording())
+
+        async def run():
+            await limiter.acheck("user1")
+            return threading.get_ident()
+
+        loop_thread = asyncio.run(run())
+        assert threads and loop_thread not in threads
+
+    def test_redis_limit_is_shared_between_workers(self):
+        fakeredis = pytest.importorskip("fakeredis")   # requirements-dev.txt
+        a, b = self._workers(RedisRateLimitBackend(fakeredis.FakeRedis()), max_calls=3)
+        a.check("user1")
+        b.check("user1")
+        a.check("user1")
+        with pytest.raises(HTTPException):
+            b.check("user1")
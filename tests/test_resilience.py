@@ -0,0 +1,182 @@
+import asyncio
+
+import pytest
+
+from tests.conftest import auth_header
+from app.core.config import settings
+from app.core.resilience import CircuitBreaker, ProviderHealth, backoff_delay
+from app.services import ai_service
+from app.services.llm_backend import LLMError, LLMResult, get_backend
+
+
+class TestCircuitBreaker:
+    def test_opens_after_threshold(self):
+        breaker = CircuitBreaker("t", failure_threshold=2, reset_seconds=60)
+        breaker.record_failure()
+        assert breaker.allow()
+        breaker.record_failure()
+        assert breaker.state == CircuitBreaker.OPEN
+        assert not breaker.allow()
+
+    def test_half_open_allows_single_probe(self):
+        breaker = CircuitBreaker("t", failure_threshold=1, reset_seconds=0)
+        breaker.record_failure()
+        assert breaker.allow()       # probe
+        assert not breaker.allow()   # només una
+        breaker.record_success()
+        assert breaker.state == CircuitBreaker.CLOSED
+
+    def test_failed_probe_reopens(self):
+        breaker = CircuitBreaker("t", failure_threshold=1, reset_seconds=0.05)
+        breaker.record_failure()
+        breaker._opened_at -= 1
+        assert breaker.allow()
+        breaker.record_failure()
+        assert breaker.state == CircuitBreaker.OPEN
+
+    def test_backoff_is_bounded(self):
+        assert all(0 <= backoff_delay(a, 0.5, 2.0) <= 2.0 for a in range(10))
+
+
+def _health(**overrides) -> ProviderHealth:
+    options = dict(window=10, min_samples=4, max_error_rate=0.5, failure_threshold=3,
+                   slow_seconds=1.0, retry_seconds=60)
+    return ProviderHealth("p", **{**options, **overrides})
+
+
+class TestProviderHealth:
+    def test_consecutive_failures_mark_unhealthy(self):
+        health = _health()
+        for _ in range(3):
+            assert health.allow()
+            health.record(False, 0.1)
+        assert health.state == ProviderHealth.UNHEALTHY
+        assert not health.allow()
+        assert health.snapshot()["skipped"] == 1
+
+    def test_error_rate_marks_unhealthy(self):
+        health = _health(failure_threshold=10)
+        for ok in (True, False, True, False):
+            health.record(ok, 0.1)
+        assert health.state == ProviderHealth.UNHEALTHY
+
+    def test_slow_call_counts_as_error(self):
+        health = _health(failure_threshold=1)
+        health.record(True, 2.5)
+        assert health.state == ProviderHealth.UNHEALTHY
+
+    def test_trial_call_after_retry_interval(self):
+        health = _health(failure_threshold=1, retry_seconds=0)
+        health.record(False, 0.1)
+        assert health.allow()        # crida de prova
+        assert not health.allow()    # només una
+        health.record(True, 0.1)
+        assert health.state == ProviderHealth.HEALTHY
+
+    def test_probe_recovers(self):
+        health = _health(failure_threshold=1)
+        health.record(False, 0.1)
+        health.record_probe(False)
+        assert health.state == ProviderHealth.UNHEALTHY
+        health.record_probe(True)
+        assert health.state == ProviderHealth.HEALTHY
+        assert health.snapshot()["calls"] == 0
+
+
+@pytest.fixture
+def flaky_backend(monkeypatch):
+    """Backend that fails `failures` times with the given error, then answers."""
+    state = {"failures": 0, "calls": 0, "transient": True}
+
+    async def complete(system, messages, max_tokens, on_delta=None):
+        state["calls"] += 1
+        if state["failures"] > 0:
+            state["failures"] -= 1
+            raise LLMError("boom", transient=state["transient"])
+        return LLMResult(text="Ajuda, si us plau!")
+
+    monkeypatch.setattr(get_backend(), "complete", complete)
+    monkeypatch.setattr(settings, "AI_RETRY_BASE_DELAY", 0.0)
+    return state
+
+
+def _generate(lang: str = "ca"):
+    return asyncio.run(ai_service.generate_alertant_response(
+        [{"role": "user", "content": "Digui?"}], "Incendio", lang=lang,
+    ))
+
+
+class TestAIRetries:
+    def test_transient_errors_are_retried(self, flaky_backend):
+        flaky_backend["failures"] = 2
+        reply = _generate()
+        assert reply.text == "Ajuda, si us plau!"
+        assert reply.retries == 2
+
+    def test_permanent_error_not_retried(self, flaky_backend):
+        flaky_backend.update(failures=1, transient=False)
+        with pytest.raises(LLMError):
+            _generate()
+        assert flaky_backend["calls"] == 1
+
+    def test_open_circuit_answers_degraded(self, flaky_backend, monkeypatch):
+        monkeypatch.setattr(settings, "AI_MAX_RETRIES", 0)
+        flaky_backend["failures"] = 100
+        for _ in range(settings.AI_BREAKER_FAILURE_THRESHOLD - 1):
+            with pytest.raises(LLMError):
+                _generate()
+        reply = _generate(lang="es")
+        assert reply.degraded
+        assert reply.text in ai_service._DEGRADED_LINES["es"]
+        calls = flaky_backend["calls"]
+        _generate()
+        assert flaky_backend["calls"] == calls  # circuit open: upstream not called
+
+    def test_hedged_request_wins(self, monkeypatch):
+        calls = []
+
+        async def complete(system, messages, max_tokens, on_delta=None):
+            calls.append(1)
+            await asyncio.sleep(1.0 if len(calls) == 1 else 0.01)
+            return LLMResult(text=f"resposta {len(calls)}")
+
+        monkeypatch.setattr(get_backend(), "complete", complete)
+        for _ in range(settings.AI_HEDGE_MIN_SAMPLES):
+            ai_service.ai_latency.observe(0.05)
+        reply = _generate()
+        assert reply.text == "resposta 2"
+        assert ai_service.ai_admission.snapshot()["active"] == 0
+
+    def test_no_hedge_without_free_admission_slot(self, monkeypatch):
+        calls = []
+
+        async def complete(system, messages, max_tokens, on_delta=None):
+            calls.append(1)
+            await asyncio.sleep(0.2)
+            return LLMResult(text=f"resposta {len(calls)}")
+
+        monkeypatch.setattr(get_backend(), "complete", complete)
+        monkeypatch.setattr(ai_service, "ai_admission", ai_service.AdmissionController(
+            "ai", max_concurrent=1, max_queue=4, retry_after_seconds=1,
+        ))
+        for _ in range(settings.AI_HEDGE_MIN_SAMPLES):
+            ai_service.ai_latency.observe(0.05)
+        reply = _generate()
+        assert reply.text == "resposta 1"
+        assert len(calls) == 1
+
+    def test_summaries_do_not_feed_turn_latency(self, flaky_backend):
+        asyncio.run(ai_service.summarize_call(None, [{"role": "user", "content": "Hi ha foc"}]))
+        assert len(ai_service.ai_latency) == 0
+        assert len(ai_service.summary_latency) == 1
+
+
+class TestMonitoring:
+    def test_status_requires_trainer(self, client, operator_token):
+        res = client.get("/api/v1/monitoring/status", headers=auth_header(operator_token))
+        assert res.status_code == 403
+
+    def test_status_exposes_breaker(self, client, admin_token):
+        res = client.get("/api/v1/monitoring/status", headers=auth_header(admin_token))
+        assert res.status_code == 200
+        assert res.json()["ai"]["breaker"]["state"] == "closed"
@@ -0,0 +1,856 @@
+import asyncio
+import base64
+import json
+import time
+from contextlib import asynccontextmanager
+from types import SimpleNamespace
+
+import anyio.to_thread
+import httpx
+import pytest
+from sqlalchemy import event
+from starlette.websockets import WebSocketDisconnect
+from sqlmodel import select
+
+from tests.conftest import auth_header, webm_clip
+from app.api.v1.endpoints import simulation as simulation_endpoints
+from app.core.config import Settings, settings
+from app.core import deps
+from app.core.rate_limit import GCRALimiter
+from app.db.session import engine
+from app.main import app
+from app.models.incident import ChatMessage
+from app.services import ai_service
+from app.services.llm_backend import StubBackend, get_backend
+from app.models.incident import Incident
+from app.services import simulation_service, usage_ledger, voice_service
+from app.services.simulation_service import _EndMarkerFilter, _messages_to_fold, _window_by_budget
+
+
+def _fake_response(text: str, cache_read: int = 0):
+    return SimpleNamespace(
+        content=[SimpleNamespace(type="text", text=text)],
+        usage=SimpleNamespace(
+            input_tokens=120, output_tokens=20,
+            cache_read_input_tokens=cache_read, cache_creation_input_tokens=0,
+        ),
+    )
+
+
+@pytest.fixture
+def fake_ai(monkeypatch):
+    """Replaces the Anthropic call with an async stub that sleeps `delay` seconds."""
+    monkeypatch.setattr(settings, "AI_PREFETCH_OPENING_LINE", False)
+    state = SimpleNamespace(
+        reply="Hi ha foc a casa meva, ajudi'm!", delay=0.0, calls=0, chunks=None, requests=[],
+    )
+
+    async def create(**kwargs):
+        state.calls += 1
+        state.requests.append(kwargs)
+        await asyncio.sleep(state.delay)
+        return _fake_response(state.reply)
+
+    @asynccontextmanager
+    async def stream(**kwargs):
+        state.calls += 1
+
+        async def text_stream():
+            for chunk in state.chunks or [state.reply]:
+                yield chunk
+
+        async def get_final_message():
+            return _fake_response("".join(state.chunks or [state.reply]))
+
+        yield SimpleNamespace(text_stream=text_stream(), get_final_message=get_final_message)
+
+    client = get_backend()._client
+    monkeypatch.setattr(client.messages, "create", create)
+    monkeypatch.setattr(client.messages, "stream", stream)
+    return state
+
+
+def _new_incident(client, token) -> int:
+    res = client.post("/api/v1/incidents", json={
+        "type": "Incendio", "location": "Andorra la Vella",
+        "description": "Foc a un edifici", "priority": 3,
+    }, headers=auth_header(token))
+    return res.json()["id"]
+
+
+class TestChat:
+    def test_chat_persists_both_messages(self, client, operator_token, session, fake_ai):
+        inc_id = _new_incident(client, operator_token)
+        res = client.post("/api/v1/simulate/chat", json={
+            "incident_id": inc_id, "operator_message": "112, quina és la seva emergència?",
+        }, headers=auth_header(operator_token))
+        assert res.status_code == 200
+        assert res.json()["content"] == fake_ai.reply
+        roles = [m.role for m in session.exec(
+            select(ChatMessage).where(ChatMessage.incident_id == inc_id).order_by(ChatMessage.id)
+        )]
+        assert roles == ["user", "assistant"]
+
+    def test_end_marker_finalizes_call(self, client, operator_token, fake_ai):
+        fake_ai.reply = "D'acord, gràcies. Adéu. [FI]"
+        inc_id = _new_incident(client, operator_token)
+        res = client.post("/api/v1/simulate/chat", json={
+            "incident_id": inc_id, "operator_message": "Pot penjar, adéu senyora.",
+        }, headers=auth_header(operator_token))
+        data = res.json()
+        assert data["call_ended"] is True
+        assert "[FI]" not in data["content"]
+
+    def test_reply_is_presynthesised_when_enabled(self, client, operator_token, fake_ai, monkeypatch):
+        started = []
+        monkeypatch.setattr(settings, "TTS_PRESYNTHESIZE", True)
+        monkeypatch.setattr(voice_service, "presynthesize", lambda text, voice: started.append((text, voice)))
+        inc_id = _new_incident(client, operator_token)
+        res = client.post("/api/v1/simulate/chat", json={
+            "incident_id": inc_id, "operator_message": "112, quina és la seva emergència?",
+        }, headers=auth_header(operator_token))
+        assert started == [(fake_ai.reply, res.json()["voice"])]
+
+    def test_concurrency_not_capped_by_threadpool(self, client, operator_token, fake_ai, monkeypatch):
+        """Concurrent turns must overlap even with a tiny worker threadpool."""
+        fake_ai.delay = 0.3
+        # 8 turns at once from one user is past the chat burst; only concurrency is under test
+        monkeypatch.setattr(simulation_endpoints, "chat_limiter", GCRALimiter(max_calls=8, period_seconds=60, burst=8))
+        incident_ids = [_new_incident(client, operator_token) for _ in range(8)]
+        headers = auth_header(operator_token)
+
+        async def run() -> float:
+            limiter = anyio.to_thread.current_default_thread_limiter()
+            limiter.total_tokens = 2
+            transport = httpx.ASGITransport(app=app)
+            async with httpx.AsyncClient(transport=transport, base_url="http://test") as ac:
+                start = time.perf_counter()
+                responses = await asyncio.gather(*[
+                    ac.post("/api/v1/simulate/chat", json={
+                        "incident_id": inc_id, "operator_message": "Què ha passat exactament?",
+                    }, headers=headers)
+                    for inc_id in incident_ids
+                ])
+                elapsed = time.perf_counter() - start
+            assert all(r.status_code == 200 for r in responses)
+            return elapsed
+
+        elapsed = asyncio.run(run())
+        # Serialitzat a 2 fils trigaria >= 8 * 0.3 / 2 = 1.2 s
+        assert elapsed < 1.0
+
+    @pytest.mark.parametrize("auth_cached", [True, False])
+    def test_no_connection_held_while_model_generates(self, client, operator_token, fake_ai, monkeypatch,
+                                                      auth_cached):
+        messages = get_backend()._client.messages
+        fake_create = messages.create
+        checked_out = []
+
+        async def create(**kwargs):
+            checked_out.append(engine.pool.checkedout())
+            return await fake_create(**kwargs)
+
+        monkeypatch.setattr(messages, "create", create)
+        inc_id = _new_incident(client, operator_token)
+        if not auth_cached:
+            deps._tokens.clear()
+            deps._users.clear()
+        # Connections the test's own fixtures hold
+        baseline = engine.pool.checkedout()
+        res = client.post("/api/v1/simulate/chat", json={
+            "incident_id": inc_id, "operator_message": "Què ha passat exactament?",
+        }, headers=auth_header(operator_token))
+        assert res.status_code == 200
+        assert checked_out == [baseline]
+
+    def test_concurrent_turns_do_not_exhaust_the_pool(self, client, operator_token, fake_ai, monkeypatch):
+        """More turns in flight than pooled connections, all authenticating on a cold cache."""
+        fake_ai.delay = 0.3
+        calls = 20  # the default pool holds 5 + 10 overflow connections
+        monkeypatch.setattr(simulation_endpoints, "chat_limiter",
+                            GCRALimiter(max_calls=calls, period_seconds=60, burst=calls))
+        incident_ids = [_new_incident(client, operator_token) for _ in range(calls)]
+        deps._tokens.clear()
+        deps._users.clear()
+        start = time.perf_counter()
+        responses = _gather_posts("/api/v1/simulate/chat", [
+            ({"incident_id": inc_id, "operator_message": "Què ha passat exactament?"}, {})
+            for inc_id in incident_ids
+        ], auth_header(operator_token))
+        assert [r.status_code for r in responses] == [200] * calls
+        assert time.perf_counter() - start < 5
+
+
+def _gather_posts(path, bodies, headers):
+    """Sends all *bodies* concurrently on a single event loop."""
+    async def run():
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as ac:
+            return await asyncio.gather(*[
+                ac.post(path, json=body, headers={**headers, **extra}) for body, extra in bodies
+            ])
+    return asyncio.run(run())
+
+
+class TestTurnSerialisation:
+    def test_same_incident_turns_run_one_at_a_time(self, client, operator_token, session, fake_ai):
+        fake_ai.delay = 0.2
+        inc_id = _new_incident(client, operator_token)
+        start = time.perf_counter()
+        responses = _gather_posts("/api/v1/simulate/chat", [
+            ({"incident_id": inc_id, "operator_message": "Què ha passat exactament?"}, {}),
+            ({"incident_id": inc_id, "operator_message": "On és vostè ara mateix?"}, {}),
+        ], auth_header(operator_token))
+        assert [r.status_code for r in responses] == [200, 200]
+        assert time.perf_counter() - start >= 0.4
+        roles = [m.role for m in session.exec(
+            select(ChatMessage).where(ChatMessage.incident_id == inc_id).order_by(ChatMessage.id)
+        )]
+        assert roles == ["user", "assistant", "user", "assistant"]
+        # El segon torn veu el primer sencer
+        assert len(fake_ai.requests[1]["messages"]) == 3
+        assert simulation_service._turn_locks == {}
+
+    def test_silent_trigger_rejected_while_turn_in_flight(self, client, operator_token, fake_ai):
+        fake_ai.delay = 0.2
+        inc_id = _new_incident(client, operator_token)
+        body = {"incident_id": inc_id, "operator_message": "Què ha passat exactament?"}
+
+        async def run():
+            transport = httpx.ASGITransport(app=app)
+            async with httpx.AsyncClient(transport=transport, base_url="http://test") as ac:
+                turn = asyncio.create_task(ac.post("/api/v1/simulate/chat", json=body,
+                                                   headers=auth_header(operator_token)))
+                await asyncio.sleep(0.05)
+                silent = await ac.post("/api/v1/simulate/chat", json={
+                    "incident_id": inc_id, "silent_trigger": True,
+                }, headers=auth_header(operator_token))
+                return await turn, silent
+
+        turn, silent = asyncio.run(run())
+        assert turn.status_code == 200
+        assert silent.status_code == 409
+
+
+class TestIdempotency:
+    def _body(self, inc_id, text="Què ha passat exactament?"):
+        return {"incident_id": inc_id, "operator_message": text}
+
+    def test_retry_replays_stored_response(self, client, operator_token, session, fake_ai):
+        inc_id = _new_incident(client, operator_token)
+        headers = {**auth_header(operator_token), "Idempotency-Key": "k-1"}
+        first = client.post("/api/v1/simulate/chat", json=self._body(inc_id), headers=headers)
+        fake_ai.reply = "Una altra resposta"
+        second = client.post("/api/v1/simulate/chat", json=self._body(inc_id), headers=headers)
+        assert second.status_code == 200
+        assert second.json() == first.json()
+        assert fake_ai.calls == 1
+        assert len(session.exec(select(ChatMessage).where(ChatMessage.incident_id == inc_id)).all()) == 2
+
+    def test_concurrent_duplicates_generate_once(self, client, operator_token, fake_ai):
+        fake_ai.delay = 0.1
+        inc_id = _new_incident(client, operator_token)
+        key = {"Idempotency-Key": "k-2"}
+        responses = _gather_posts("/api/v1/simulate/chat", [
+            (self._body(inc_id), key), (self._body(inc_id), key),
+        ], auth_header(operator_token))
+        assert [r.status_code for r in responses] == [200, 200]
+        assert responses[0].json() == responses[1].json()
+        assert fake_ai.calls == 1
+
+    def test_key_reused_with_other_body_rejected(self, client, operator_token, fake_ai):
+        inc_id = _new_incident(client, operator_token)
+        headers = {**auth_header(operator_token), "Idempotency-Key": "k-3"}
+        client.post("/api/v1/simulate/chat", json=self._body(inc_id), headers=headers)
+        res = client.post("/api/v1/simulate/chat", json=self._body(inc_id, "Una altra pregunta diferent"),
+                          headers=headers)
+        assert res.status_code == 422
+
+    def test_stream_replay_sends_done_only(self, client, operator_token, fake_ai):
+        inc_id = _new_incident(client, operator_token)
+        headers = {**auth_header(operator_token), "Idempotency-Key": "k-4"}
+        client.post("/api/v1/simulate/chat/stream", json=self._body(inc_id), headers=headers)
+        res = client.post("/api/v1/simulate/chat/stream", json=self._body(inc_id), headers=headers)
+        assert res.text.startswith("event: done")
+        assert fake_ai.calls == 1
+
+
+class TestChatStream:
+    def test_stream_emits_deltas_then_done(self, client, operator_token, session, fake_ai):
+        fake_ai.chunks = ["D'acord, ", "gràcies. Adéu. [", "FI]"]
+        inc_id = _new_incident(client, operator_token)
+        res = client.post("/api/v1/simulate/chat/stream", json={
+            "incident_id": inc_id, "operator_message": "Pot penjar, adéu senyora.",
+        }, headers=auth_header(operator_token))
+        assert res.status_code == 200
+        assert res.headers["content-type"].startswith("text/event-stream")
+
+        events = [
+            (block.split("\n")[0].removeprefix("event: "), json.loads(block.split("\n")[1].removeprefix("data: ")))
+            for block in res.text.strip().split("\n\n")
+        ]
+        deltas = "".join(data["text"] for name, data in events if name == "delta")
+        assert "[" not in deltas
+        assert events[-1][0] == "done"
+        assert events[-1][1]["call_ended"] is True
+        assert events[-1][1]["content"] == "D'acord, gràcies. Adéu."
+        assert len(session.exec(select(ChatMessage).where(ChatMessage.incident_id == inc_id)).all()) == 2
+
+    def test_stream_validates_before_streaming(self, client, operator_token, fake_ai):
+        res = client.post("/api/v1/simulate/chat/stream", json={
+            "incident_id": 999, "operator_message": "Hola, què passa?",
+        }, headers=auth_header(operator_token))
+        assert res.status_code == 404
+
+
+class TestPromptCaching:
+    def test_system_prompt_has_cache_breakpoints(self, client, operator_token, fake_ai):
+        inc_id = _new_incident(client, operator_token)
+        client.post("/api/v1/simulate/chat", json={
+            "incident_id": inc_id, "operator_message": "112, quina és la seva emergència?",
+        }, headers=auth_header(operator_token))
+        system = fake_ai.requests[-1]["system"]
+        assert [b["cache_control"] for b in system] == [{"type": "ephemeral"}] * 2
+        assert system[0]["text"] == ai_service._BEHAVIOUR_RULES
+        assert "Foc a un edifici" in system[1]["text"]
+
+    def test_system_blocks_memoized(self):
+        ai_service._system_blocks.cache_clear()
+        args = ("Incendio", "Escaldes", None, None, "Pánico", None, "ca")
+        assert ai_service._system_blocks(*args) is ai_service._system_blocks(*args)
+        assert ai_service._system_blocks.cache_info().hits == 1
+
+    def test_cache_hit_tokens_reported(self, fake_ai, monkeypatch):
+        async def create(**kwargs):
+            return _fake_response("Ajuda, si us plau!", cache_read=1800)
+
+        monkeypatch.setattr(get_backend()._client.messages, "create", create)
+        reply = asyncio.run(ai_service.generate_alertant_response(
+            [{"role": "user", "content": "Hola?"}], "Incendio",
+        ))
+        assert reply.usage.cache_read_tokens == 1800
+
+
+class TestEndMarkerFilter:
+    def test_marker_split_across_chunks(self):
+        f = _EndMarkerFilter()
+        out = f.feed("Adéu. [") + f.feed("F") + f.feed("I]") + f.flush()
+        assert out == "Adéu. "
+
+    def test_bracket_that_is_not_marker_is_released(self):
+        f = _EndMarkerFilter()
+        out = f.feed("Pis [") + f.feed("3] segona porta") + f.flush()
+        assert out == "Pis [3] segona porta"
+
+
+class TestHistoryWindow:
+    def _turns(self, n: int, size: int = 400) -> list[dict]:
+        return [
+            {"role": "user" if i % 2 == 0 else "assistant", "content": "x" * size}
+            for i in range(n)
+        ]
+
+    def test_window_keeps_newest_within_budget(self):
+        history = self._turns(21)
+        window = _window_by_budget(history, budget=500)
+        assert window[-1] is history[-1]
+        assert window[0]["role"] == "user"
+        assert sum(len(m["content"]) // 4 + 4 for m in window) <= 500
+
+    def test_window_always_keeps_current_turn(self):
+        history = self._turns(1, size=10_000)
+        assert _window_by_budget(history, budget=100) == history
+
+    def test_fold_selection_ends_on_assistant(self):
+        msgs = [ChatMessage(id=i, incident_id=1, role=t["role"], content=t["content"])
+                for i, t in enumerate(self._turns(20), start=1)]
+        assert _messages_to_fold(msgs[:4], budget=3000) == []
+        folded = _messages_to_fold(msgs, budget=1000)
+        assert folded and folded[-1].role == "assistant"
+        assert sum(len(m.content) // 4 + 4 for m in msgs[len(folded):]) <= 500
+
+    def test_fold_persists_summary(self, client, operator_token, session, fake_ai):
+        fake_ai.reply = "La Marta Puig, Carrer Major 3, 2n 1a. Foc a la cuina."
+        inc_id = _new_incident(client, operator_token)
+        asyncio.run(simulation_service._fold_history(
+            inc_id, None, None,
+            [{"role": "user", "content": "Com es diu?"}, {"role": "assistant", "content": "Marta Puig."}],
+            upto_id=2, lang="ca",
+        ))
+        incident = session.get(Incident, inc_id)
+        assert incident.history_summary == fake_ai.reply
+        assert incident.summary_upto_id == 2
+
+    def test_summary_sent_in_system_prompt(self, client, operator_token, session, fake_ai):
+        inc_id = _new_incident(client, operator_token)
+        incident = session.get(Incident, inc_id)
+        incident.history_summary = "Es diu Marta Puig."
+        incident.summary_upto_id = 0
+        session.add(incident)
+        session.commit()
+        client.post("/api/v1/simulate/chat", json={
+            "incident_id": inc_id, "operator_message": "Com es diu vostè?",
+        }, headers=auth_header(operator_token))
+        system = fake_ai.requests[-1]["system"]
+        assert "Es diu Marta Puig." in system[-1]["text"]
+
+
+class TestStubBackend:
+    def test_deterministic_and_streams_tokens(self):
+        backend = StubBackend(latency_ms=0, tokens_per_second=0)
+        messages = [{"role": "user", "content": "Quina és la seva emergència?"}]
+        chunks: list[str] = []
+
+        async def on_delta(chunk: str) -> None:
+            chunks.append(chunk)
+
+        first = asyncio.run(backend.complete("system", messages, 500, on_delta))
+        second = asyncio.run(backend.complete("system", messages, 500))
+        assert first.text == second.text
+        assert "".join(chunks) == first.text
+        assert first.usage.output_tokens == len(chunks)
+        assert "[FI]" not in first.text
+
+    def test_end_marker_behaviour(self):
+        backend = StubBackend(latency_ms=0, tokens_per_second=0, end_after_turns=2)
+        one = [{"role": "user", "content": "Digui?"}]
+        two = one + [{"role": "assistant", "content": "Ajuda!"}, {"role": "user", "content": "On és?"}]
+        assert "[FI]" not in asyncio.run(backend.complete("s", one, 500)).text
+        assert asyncio.run(backend.complete("s", two, 500)).text.endswith("[FI]")
+        bye = [{"role": "user", "content": "Ja pot penjar, adéu."}]
+        assert asyncio.run(StubBackend(0, 0).complete("s", bye, 500)).text.endswith("[FI]")
+
+    def test_latency_is_applied(self):
+        backend = StubBackend(latency_ms=100, tokens_per_second=0)
+        start = time.perf_counter()
+        asyncio.run(backend.complete("s", [{"role": "user", "content": "Hola"}], 500))
+        assert time.perf_counter() - start >= 0.1
+
+
+class TestAdmission:
+    def test_saturated_returns_503(self, client, operator_token, fake_ai, monkeypatch):
+        monkeypatch.setattr(ai_service.ai_admission, "_max", 0)
+        monkeypatch.setattr(ai_service.ai_admission, "_max_queue", 0)
+        inc_id = _new_incident(client, operator_token)
+        res = client.post("/api/v1/simulate/chat", json={
+            "incident_id": inc_id, "operator_message": "Quina és la seva emergència?",
+        }, headers=auth_header(operator_token))
+        assert res.status_code == 503
+        assert "Retry-After" in res.headers
+        assert fake_ai.calls == 0
+
+
+class TestCallStateCache:
+    def _say(self, client, token, inc_id, text="Quina és la seva emergència?"):
+        return client.post("/api/v1/simulate/chat", json={
+            "incident_id": inc_id, "operator_message": text,
+        }, headers=auth_header(token))
+
+    def test_later_turns_do_not_reload_history(self, client, operator_token, fake_ai):
+        inc_id = _new_incident(client, operator_token)
+        self._say(client, operator_token, inc_id)
+
+        statements = []
+        def capture(conn, cursor, statement, *args):
+            statements.append(statement)
+        event.listen(engine, "before_cursor_execute", capture)
+        try:
+            assert self._say(client, operator_token, inc_id, "On és exactament?").status_code == 200
+            assert client.post("/api/v1/simulate/chat", json={
+                "incident_id": inc_id, "silent_trigger": True,
+            }, headers=auth_header(operator_token)).status_code == 200
+        finally:
+            event.remove(engine, "before_cursor_execute", capture)
+
+        selects = [s for s in statements if s.lstrip().upper().startswith("SELECT")]
+        # Only the last-message-id check touches chatmessage
+        assert not any("chatmessage.content" in s or "FROM scenario" in s for s in selects)
+        history = fake_ai.requests[-1]["messages"]
+        assert [m["content"] for m in history[:3]] == [
+            "Quina és la seva emergència?", fake_ai.reply, "On és exactament?",
+        ]
+
+    def test_turn_written_by_another_worker_reloads_history(self, client, operator_token, session, fake_ai):
+        inc_id = _new_incident(client, operator_token)
+        self._say(client, operator_token, inc_id)
+        # Another worker served a turn of this call: this process's cache is behind
+        session.add(ChatMessage(incident_id=inc_id, role="user", content="Hi ha ferits?"))
+        session.add(ChatMessage(incident_id=inc_id, role="assistant", content="Sí, un home a terra."))
+        session.commit()
+
+        assert self._say(client, operator_token, inc_id, "On és exactament?").status_code == 200
+        history = fake_ai.requests[-1]["messages"]
+        assert [m["content"] for m in history[2:5]] == [
+            "Hi ha ferits?", "Sí, un home a terra.", "On és exactament?",
+        ]
+
+    def test_cached_last_role_guards_silent_trigger(self, client, operator_token, session, fake_ai):
+        inc_id = _new_incident(client, operator_token)
+        self._say(client, operator_token, inc_id)
+        session.add(ChatMessage(incident_id=inc_id, role="user", content="Hola?"))
+        session.commit()
+        simulation_service._call_states.clear()
+        res = client.post("/api/v1/simulate/chat", json={
+            "incident_id": inc_id, "silent_trigger": True,
+        }, headers=auth_header(operator_token))
+        assert res.status_code == 409
+
+    def test_state_dropped_when_call_ends(self, client, operator_token, fake_ai):
+        inc_id = _new_incident(client, operator_token)
+        self._say(client, operator_token, inc_id)
+        assert simulation_service._call_states.get(inc_id) is not None
+        client.patch(f"/api/v1/incidents/{inc_id}/call", headers=auth_header(operator_token))
+        assert simulation_service._call_states.get(inc_id) is None
+
+
+class TestOpeningLine:
+    def _profile(self) -> dict:
+        return {
+            "incident_type": "Incendio", "instructions_ia": None, "location": "Encamp",
+            "victim_status": None, "initial_emotion": None, "description": "Foc",
+        }
+
+    def test_first_turn_served_from_prefetch(self, client, operator_token, session, fake_ai):
+        fake_ai.reply = "Ajuda! Hi ha hagut un accident!"
+        inc_id = _new_incident(client, operator_token)
+        incident = session.get(Incident, inc_id)
+        request = simulation_service.ChatRequest(incident_id=inc_id, operator_message="112... digui!")
+
+        async def run():
+            await simulation_service.prefetch_opening_line(inc_id, 3, self._profile(), "ca")
+            await asyncio.sleep(0.01)
+            fake_ai.reply = "Això no s'hauria de generar."
+            return await simulation_service.process_chat(
+                request, incident, simulation_service.load_call_state(incident, session),
+            )
+
+        reply, _, _ = asyncio.run(run())
+        assert reply == "Ajuda! Hi ha hagut un accident!"
+        assert fake_ai.calls == 1
+
+    def test_other_first_message_discards_prefetch(self, client, operator_token, session, fake_ai):
+        fake_ai.reply = "Resposta a la salutació estàndard."
+        inc_id = _new_incident(client, operator_token)
+        incident = session.get(Incident, inc_id)
+        request = simulation_service.ChatRequest(
+            incident_id=inc_id, operator_message="Bombers, on és el foc exactament?",
+        )
+
+        async def run():
+            await simulation_service.prefetch_opening_line(
+                inc_id, 3, self._profile(), "ca", user_id=incident.creator_id,
+            )
+            await asyncio.sleep(0.01)
+            fake_ai.reply = "Al carrer Major, 3!"
+            return await simulation_service.process_chat(
+                request, incident, simulation_service.load_call_state(incident, session),
+            )
+
+        reply, _, _ = asyncio.run(run())
+        assert reply == "Al carrer Major, 3!"
+        assert fake_ai.calls == 2
+        assert inc_id not in simulation_service._opening_lines
+        # La línia generada i no servida també costa
+        rows = [(r.kind, r.incident_id, r.user_id) for r in usage_ledger._pending]
+        assert ("prefetch", inc_id, incident.creator_id) in rows
+
+    def test_finished_line_cancelled_is_recorded(self, fake_ai):
+        async def run():
+            await simulation_service.prefetch_opening_line(77, 1, self._profile(), "ca", user_id=5)
+            await asyncio.sleep(0.01)
+            simulation_service.cancel_opening_line(77)
+
+        asyncio.run(run())
+        assert [(r.kind, r.incident_id, r.user_id) for r in usage_ledger._pending] == [("prefetch", 77, 5)]
+
+    def test_prefetch_is_off_by_default(self):
+        assert Settings.model_fields["AI_PREFETCH_OPENING_LINE"].default is False
+
+    def test_language_mismatch_falls_back(self, client, operator_token, session, fake_ai):
+        inc_id = _new_incident(client, operator_token)
+        incident = session.get(Incident, inc_id)
+        request = simulation_service.ChatRequest(incident_id=inc_id, operator_message="Hola, ¿qué ocurre?", lang="es")
+
+        async def run():
+            await simulation_service.prefetch_opening_line(inc_id, 3, self._profile(), "ca")
+            return await simulation_service.process_chat(
+                request, incident, simulation_service.load_call_state(incident, session),
+            )
+
+        asyncio.run(run())
+        assert fake_ai.calls == 2
+        assert inc_id not in simulation_service._opening_lines
+
+    def test_cancel_drops_pending_line(self):
+        async def run():
+            await simulation_service.prefetch_opening_line(77, 1, self._profile(), "ca")
+            task = simulation_service._opening_lines[77].task
+            simulation_service.cancel_opening_line(77)
+            await asyncio.sleep(0)
+            return task
+
+        task = asyncio.run(run())
+        assert task.cancelled()
+        assert 77 not in simulation_service._opening_lines
+
+
+@pytest.fixture
+def fake_voice(monkeypatch):
+    """Replaces Whisper and TTS with local fakes."""
+    state = SimpleNamespace(transcript="Hi ha foc a la cuina del veí", spoken=[])
+
+    async def transcribe(audio_bytes, lang, key=None, info=None):
+        return state.transcript
+
+    async def synthesize(text, voice):
+        state.spoken.append((text, voice))
+        return f"mp3:{text}".encode()
+
+    monkeypatch.setattr(voice_service, "transcribe", transcribe)
+    monkeypatch.setattr(voice_service, "synthesize", synthesize)
+    return state
+
+
+_WEBM = webm_clip()
+
+
+def _turn_events(ws) -> list:
+    """Receives frames until the end of a turn's audio (or an error)."""
+    frames = []
+    while True:
+        message = ws.receive()
+        if message.get("bytes") is not None:
+            frames.append(message["bytes"])
+            continue
+        frames.append(json.loads(message["text"]))
+        if frames[-1]["type"] in ("audio_end", "error"):
+            return frames
+
+
+class TestCallSession:
+    def _connect(self, client, inc_id):
+        return client.websocket_connect(f"/api/v1/simulate/call/{inc_id}")
+
+    def test_no_connection_held_between_turns(self, client, operator_token, fake_ai, fake_voice):
+        inc_id = _new_incident(client, operator_token)
+        # Connections the test's own fixtures hold
+        baseline = engine.pool.checkedout()
+        with self._connect(client, inc_id) as ws:
+            ws.send_json({"type": "start", "token": operator_token, "lang": "ca"})
+            assert ws.receive_json() == {"type": "ready", "incident_id": inc_id}
+            assert engine.pool.checkedout() == baseline
+            ws.send_json({"type": "text", "text": "Què ha passat exactament?"})
+            assert _turn_events(ws)[-1] == {"type": "audio_end"}
+            assert engine.pool.checkedout() == baseline
+
+    def test_oversized_utterance_is_dropped_whole(self, client, operator_token, fake_ai, fake_voice, monkeypatch):
+        monkeypatch.setattr(voice_service, "MAX_AUDIO_BYTES", 100)
+        inc_id = _new_incident(client, operator_token)
+        with self._connect(client, inc_id) as ws:
+            ws.send_json({"type": "start", "token": operator_token, "lang": "ca"})
+            assert ws.receive_json() == {"type": "ready", "incident_id": inc_id}
+            ws.send_bytes(b"a" * 60)
+            ws.send_bytes(b"b" * 60)
+            assert ws.receive_json()["status"] == 413
+            ws.send_bytes(b"c" * 60)   # cua del mateix torn: no es transcriu
+            ws.send_json({"type": "end_of_utterance"})
+            ws.send_json({"type": "text", "text": "Em sent? Què ha passat?"})
+            frames = _turn_events(ws)
+        assert not any(isinstance(f, dict) and f["type"] == "transcript" for f in frames)
+        assert fake_ai.calls == 1
+
+    def test_spoken_turn_runs_whole_pipeline(self, client, operator_token, session, fake_ai, fake_voice):
+        inc_id = _new_incident(client, operator_token)
+        with self._connect(client, inc_id) as ws:
+            ws.send_json({"type": "start", "token": operator_token, "lang": "ca"})
+            assert ws.receive_json() == {"type": "ready", "incident_id": inc_id}
+            ws.send_bytes(_WEBM[:10])
+            ws.send_bytes(_WEBM[10:])
+            ws.send_json({"type": "end_of_utterance"})
+            assert ws.receive_json() == {"type": "transcript", "text": fake_voice.transcript}
+            frames = _turn_events(ws)
+            [reply] = [f for f in frames if isinstance(f, dict) and f["type"] == "reply"]
+            assert reply["content"] == fake_ai.reply
+            assert f"mp3:{fake_ai.reply}".encode() in frames
+
+            ws.send_json({"type": "text", "text": "On és exactament el foc?"})
+            assert _turn_events(ws)[-1] == {"type": "audio_end"}
+
+        roles = [m.role for m in session.exec(
+            select(ChatMessage).where(ChatMessage.incident_id == inc_id).order_by(ChatMessage.id)
+        )]
+        assert roles == ["user", "assistant", "user", "assistant"]
+
+    def test_noise_transcript_skips_turn(self, client, operator_token, fake_ai, fake_voice):
+        fake_voice.transcript = ""
+        inc_id = _new_incident(client, operator_token)
+        with self._connect(client, inc_id) as ws:
+            ws.send_json({"type": "start", "token": operator_token})
+            ws.receive_json()
+            ws.send_bytes(_WEBM)
+            ws.send_json({"type": "end_of_utterance"})
+            assert ws.receive_json() == {"type": "transcript", "text": ""}
+            ws.send_json({"type": "silence"})
+            _turn_events(ws)
+        assert fake_ai.calls == 1
+
+    def test_invalid_audio_reports_error(self, client, operator_token, fake_ai, fake_voice):
+        inc_id = _new_incident(client, operator_token)
+        with self._connect(client, inc_id) as ws:
+            ws.send_json({"type": "start", "token": operator_token})
+            ws.receive_json()
+            ws.send_bytes(b"RIFF....")
+            ws.send_json({"type": "end_of_utterance"})
+            assert ws.receive_json() == {
+                "type": "error", "status": 415, "detail": "Format d'àudio no vàlid (es requereix WebM)",
+            }
+
+    def test_bad_token_closes_socket(self, client, operator_token, fake_ai):
+        inc_id = _new_incident(client, operator_token)
+        with self._connect(client, inc_id) as ws:
+            ws.send_json({"type": "start", "token": "nope"})
+            with pytest.raises(WebSocketDisconnect) as exc:
+                ws.receive_json()
+        assert exc.value.code == 1008
+
+    def test_call_end_closes_socket(self, client, operator_token, fake_ai, fake_voice):
+        fake_ai.reply = "D'acord, ja venen. Adéu. [FI]"
+        inc_id = _new_incident(client, operator_token)
+        with self._connect(client, inc_id) as ws:
+            ws.send_json({"type": "start", "token": operator_token})
+            ws.receive_json()
+            ws.send_json({"type": "text", "text": "Ja hi van els bombers, adéu."})
+            frames = _turn_events(ws)
+            assert any(isinstance(f, dict) and f.get("call_ended") for f in frames)
+            with pytest.raises(WebSocketDisconnect):
+                ws.receive_json()
+
+
+class TestSpeculation:
+    @pytest.fixture(autouse=True)
+    def enabled(self, monkeypatch):
+        monkeypatch.setattr(settings, "AI_SPECULATIVE_REPLIES", True)
+        monkeypatch.setattr(simulation_service, "_speculation_stats", dict.fromkeys(
+            simulation_service._speculation_stats, 0,
+        ))
+
+    @staticmethod
+    def _first_turn(ws, token):
+        ws.send_json({"type": "start", "token": token})
+        ws.receive_json()
+        ws.send_json({"type": "text", "text": "112, digui què passa?"})
+        _turn_events(ws)
+
+    def test_matching_final_reuses_speculation(self, client, operator_token, fake_ai, fake_voice):
+        fake_ai.delay = 0.1
+        inc_id = _new_incident(client, operator_token)
+        with client.websocket_connect(f"/api/v1/simulate/call/{inc_id}") as ws:
+            self._first_turn(ws, operator_token)
+            fake_ai.reply = "Al segon pis, de pressa!"
+            ws.send_json({"type": "partial", "text": "on és el foc exactament"})
+            ws.send_json({"type": "text", "text": "On és el foc, exactament?"})
+            frames = _turn_events(ws)
+        [reply] = [f for f in frames if isinstance(f, dict) and f["type"] == "reply"]
+        assert reply["content"] == "Al segon pis, de pressa!"
+        assert fake_ai.calls == 2
+        snapshot = simulation_service.speculation_snapshot()
+        assert (snapshot["hits"], snapshot["misses"], snapshot["hit_rate"]) == (1, 0, 1.0)
+
+    def test_different_final_restarts_generation(self, client, operator_token, fake_ai, fake_voice):
+        inc_id = _new_incident(client, operator_token)
+        with client.websocket_connect(f"/api/v1/simulate/call/{inc_id}") as ws:
+            self._first_turn(ws, operator_token)
+            ws.send_json({"type": "partial", "text": "on és el foc"})
+            ws.send_json({"type": "partial", "text": "on és el foc i hi ha"})
+            ws.send_json({"type": "text", "text": "On és el foc i hi ha ferits?"})
+            _turn_events(ws)
+        # first turn, speculations (the first may be cancelled before it starts), real turn
+        assert fake_ai.calls in (3, 4)
+        snapshot = simulation_service.speculation_snapshot()
+        assert (snapshot["started"], snapshot["restarted"], snapshot["hits"], snapshot["misses"]) == (2, 1, 0, 1)
+        assert simulation_service._speculations == {}
+
+    def test_disabled_speculation_does_no_work(self, client, operator_token, fake_ai, monkeypatch):
+        monkeypatch.setattr(settings, "AI_SPECULATIVE_REPLIES", False)
+        monkeypatch.setattr(simulation_endpoints, "_read_call", None)   # no s'ha d'arribar a cridar
+        inc_id = _new_incident(client, operator_token)
+        res = client.post("/api/v1/simulate/chat/speculate", json={
+            "incident_id": inc_id, "operator_message": "Hi ha un foc a la cuina",
+        }, headers=auth_header(operator_token))
+        assert res.json() == {"speculating": False}
+        assert simulation_endpoints.speculate_limiter.snapshot()["keys"] == 0
+
+    def test_first_exchange_is_not_speculated(self, client, operator_token, fake_ai):
+        inc_id = _new_incident(client, operator_token)
+        res = client.post("/api/v1/simulate/chat/speculate", json={
+            "incident_id": inc_id, "operator_message": "Hi ha un foc a la cuina",
+        }, headers=auth_header(operator_token))
+        assert res.status_code == 202
+        assert res.json() == {"speculating": False}
+
+    def test_disabled_by_default(self, client, operator_token, fake_ai, monkeypatch):
+        monkeypatch.setattr(settings, "AI_SPECULATIVE_REPLIES", False)
+        inc_id = _new_incident(client, operator_token)
+        client.post("/api/v1/simulate/chat", json={"incident_id": inc_id, "operator_message": "Què ha passat?"},
+                    headers=auth_header(operator_token))
+        res = client.post("/api/v1/simulate/chat/speculate", json={
+            "incident_id": inc_id, "operator_message": "On és el foc",
+        }, headers=auth_header(operator_token))
+        assert res.json() == {"speculating": False}
+        assert fake_ai.calls == 1
+
+
+class TestSentencePipeline:
+    def test_splitter_cuts_complete_sentences(self):
+        splitter = voice_service.SentenceSplitter()
+        sentences = []
+        for chunk in ["Ajuda! Hi ", "ha foc a la cui", "na. Vinguin ràpid", "? Sí"]:
+            sentences += splitter.feed(chunk)
+        assert sentences == ["Ajuda!", "Hi ha foc a la cuina.", "Vinguin ràpid?"]
+        assert splitter.flush() == "Sí"
+
+    def test_first_sentence_synthesised_before_reply_ends(self, fake_voice):
+        async def run():
+            speech = voice_service.SpeechPipeline("nova")
+            speech.feed("Ajuda, hi ha foc! Estic ")
+            await asyncio.sleep(0)
+            started_early = list(fake_voice.spoken)
+            speech.feed("al segon pis.")
+            speech.close()
+            return started_early, [s async for s in speech.segments()]
+
+        started_early, segments = asyncio.run(run())
+        assert started_early == [("Ajuda, hi ha foc!", "nova")]
+        assert segments == [
+            ("Ajuda, hi ha foc!", b"mp3:Ajuda, hi ha foc!"),
+            ("Estic al segon pis.", b"mp3:Estic al segon pis."),
+        ]
+
+    def test_stream_sends_audio_per_sentence(self, client, operator_token, fake_ai, fake_voice):
+        fake_ai.chunks = ["Hi ha foc. ", "Vinguin, ", "si us plau!"]
+        inc_id = _new_incident(client, operator_token)
+        res = client.post("/api/v1/simulate/chat/stream?speak=true", json={
+            "incident_id": inc_id, "operator_message": "Què ha passat exactament?",
+        }, headers=auth_header(operator_token))
+        events = [
+            (block.split("\n")[0].removeprefix("event: "), json.loads(block.split("\n")[1].removeprefix("data: ")))
+            for block in res.text.strip().split("\n\n")
+        ]
+        audio = [data for name, data in events if name == "audio"]
+        assert [a["text"] for a in audio] == ["Hi ha foc.", "Vinguin, si us plau!"]
+        assert base64.b64decode(audio[0]["audio"]) == b"mp3:Hi ha foc."
+        assert events[-1][0] == "audio_end"
+        assert any(name == "done" for name, _ in events)
+
+    def test_failed_speech_setup_releases_turn(self, client, operator_token, fake_ai, monkeypatch):
+        def broken(voice, max_parallel):
+            raise RuntimeError("no voice")
+
+        monkeypatch.setattr(simulation_endpoints, "SpeechPipeline", broken)
+        inc_id = _new_incident(client, operator_token)
+        body = {"incident_id": inc_id, "operator_message": "Què ha passat exactament?"}
+        with pytest.raises(RuntimeError):
+            client.post("/api/v1/simulate/chat/stream?speak=true", json=body, headers=auth_header(operator_token))
+        assert simulation_service._turn_locks == {}
+        res = client.post("/api/v1/simulate/chat", json=body, headers=auth_header(operator_token))
+        assert res.status_code == 200
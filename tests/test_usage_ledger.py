@@ -0,0 +1,109 @@
+import pytest
+from sqlmodel import select
+
+from tests.conftest import auth_header
+from app.core.config import settings
+from app.models.ai_usage import AIUsageRecord
+from app.services import usage_ledger
+from app.services.ai_service import AIReply
+from app.services.llm_backend import AIUsage, LLMResult, get_backend
+
+
+@pytest.fixture
+def fake_backend(monkeypatch):
+    """Backend that always answers with fixed token usage."""
+    monkeypatch.setattr(settings, "AI_PREFETCH_OPENING_LINE", False)
+
+    async def complete(system, messages, max_tokens, on_delta=None):
+        return LLMResult(
+            text="Hi ha foc, vinguin!",
+            usage=AIUsage(input_tokens=100, output_tokens=10, cache_read_tokens=80),
+        )
+
+    monkeypatch.setattr(get_backend(), "complete", complete)
+
+
+def _chat(client, token, message="112, quina és la seva emergència?"):
+    inc = client.post("/api/v1/incidents", json={
+        "type": "Incendio", "location": "Andorra la Vella",
+        "description": "Foc a un edifici", "priority": 3,
+    }, headers=auth_header(token)).json()
+    res = client.post("/api/v1/simulate/chat", json={
+        "incident_id": inc["id"], "operator_message": message,
+    }, headers=auth_header(token))
+    assert res.status_code == 200
+    return inc["id"]
+
+
+def _reply(**kwargs) -> AIReply:
+    return AIReply(text="x", model="stub", usage=AIUsage(input_tokens=1, output_tokens=1), **kwargs)
+
+
+class TestLedger:
+    def test_turn_is_recorded_off_the_request_path(self, client, operator_token, operator_user,
+                                                  session, fake_backend):
+        inc_id = _chat(client, operator_token)
+        assert session.exec(select(AIUsageRecord)).all() == []
+        assert usage_ledger.flush() == 1
+
+        row = session.exec(select(AIUsageRecord)).one()
+        assert row.incident_id == inc_id
+        assert row.user_id == operator_user.id
+        assert row.kind == "turn"
+        assert (row.input_tokens, row.output_tokens, row.cache_read_tokens) == (100, 10, 80)
+        assert row.model == get_backend().model
+
+    def test_latency_excludes_queue_wait(self, session):
+        usage_ledger.record(_reply(queue_wait=0.2), elapsed=0.5)
+        usage_ledger.flush()
+        row = session.exec(select(AIUsageRecord)).one()
+        assert (row.ai_latency_ms, row.queue_wait_ms) == (300, 200)
+
+    def test_deleted_incident_does_not_block_the_ledger(self, client, operator_token, operator_user,
+                                                        session, fake_backend):
+        inc_id = _chat(client, operator_token)
+        usage_ledger.record(_reply(), kind="summary", incident_id=inc_id, user_id=operator_user.id)
+        assert client.delete(f"/api/v1/incidents/{inc_id}", headers=auth_header(operator_token)).status_code == 204
+
+        assert usage_ledger.flush() == 2
+        assert usage_ledger.pending() == 0
+        rows = session.exec(select(AIUsageRecord)).all()
+        assert [(r.incident_id, r.user_id) for r in rows] == [(None, operator_user.id)] * 2
+
+    def test_pending_rows_are_bounded(self, monkeypatch):
+        monkeypatch.setattr(settings, "AI_USAGE_MAX_PENDING", 3)
+        for _ in range(5):
+            usage_ledger.record(_reply())
+        assert usage_ledger.pending() == 3
+        assert usage_ledger.snapshot()["dropped"] >= 2
+
+
+class TestUsageAggregates:
+    def test_per_user_totals(self, client, operator_token, operator_user, admin_token, fake_backend):
+        _chat(client, operator_token)
+        _chat(client, operator_token)
+        usage_ledger.record(_reply(retries=1), kind="summary", user_id=operator_user.id)
+        usage_ledger.record(_reply(), kind="speculation", user_id=operator_user.id)
+        usage_ledger.record(_reply(), kind="prefetch", user_id=operator_user.id)
+        usage_ledger.flush()
+
+        res = client.get("/api/v1/monitoring/usage?group_by=user", headers=auth_header(admin_token))
+        assert res.status_code == 200
+        [row] = res.json()
+        assert row["key"] == str(operator_user.id)
+        assert (row["calls"], row["turns"], row["summaries"]) == (5, 2, 1)
+        assert (row["speculations"], row["prefetches"]) == (1, 1)
+        assert row["input_tokens"] == 203
+        assert row["retries"] == 1
+        assert row["p95_ai_latency_ms"] is not None
+
+    def test_per_day(self, client, operator_token, admin_token, fake_backend):
+        _chat(client, operator_token)
+        usage_ledger.flush()
+        res = client.get("/api/v1/monitoring/usage?group_by=day", headers=auth_header(admin_token))
+        [row] = res.json()
+        assert len(row["key"]) == 10  # YYYY-MM-DD
+
+    def test_operator_forbidden(self, client, operator_token):
+        res = client.get("/api/v1/monitoring/usage", headers=auth_header(operator_token))
+        assert res.status_code == 403
@@ -0,0 +1,439 @@
+import asyncio
+import io
+import time
+from types import SimpleNamespace
+
+import httpx
+import pytest
+
+from tests.conftest import auth_header, webm_clip
+from app.api.v1.endpoints import voice as voice_endpoints
+from app.core.config import settings
+from app.core.rate_limit import GCRALimiter
+from app.main import app
+from app.services import http_clients, voice_service, webm
+from app.services.http_clients import ELEVENLABS, OPENAI
+from app.services.tts_cache import TTSCache, speech_key
+
+
+@pytest.fixture
+def providers(monkeypatch):
+    """Routes the shared provider clients to in-process mock transports."""
+    calls = []
+    responses = {OPENAI: httpx.Response(200, content=b"oai-mp3"), ELEVENLABS: httpx.Response(200, content=b"el-mp3")}
+
+    def transport(provider):
+        def handler(request: httpx.Request) -> httpx.Response:
+            calls.append((provider, request.url.path))
+            response = responses[provider]
+            return response() if callable(response) else response
+        return httpx.MockTransport(handler)
+
+    for provider, base_url in ((OPENAI, "https://api.openai.com/v1"), (ELEVENLABS, "https://api.elevenlabs.io/v1")):
+        monkeypatch.setitem(http_clients._clients, provider,
+                            httpx.AsyncClient(base_url=base_url, transport=transport(provider)))
+    monkeypatch.setattr(settings, "DispatchSimKeyEleven", "el-key")
+    return calls, responses
+
+
+class TestHTTPClients:
+    def test_client_is_shared_and_configured(self, monkeypatch):
+        monkeypatch.setattr(http_clients, "_clients", {})
+        client = http_clients.get_client(OPENAI)
+        assert http_clients.get_client(OPENAI) is client
+        assert str(client.base_url) == "https://api.openai.com/v1/"
+        assert client.headers["Authorization"] == f"Bearer {settings.DispatchSimKeyOpenAI}"
+        assert client.timeout.connect == settings.HTTP_CONNECT_TIMEOUT
+        asyncio.run(http_clients.close_clients())
+        assert client.is_closed
+        assert http_clients._clients == {}
+
+    def test_closed_client_is_rebuilt(self, monkeypatch):
+        monkeypatch.setattr(http_clients, "_clients", {})
+        client = http_clients.get_client(ELEVENLABS)
+        asyncio.run(client.aclose())
+        assert http_clients.get_client(ELEVENLABS) is not client
+        asyncio.run(http_clients.close_clients())
+
+
+class TestSpeak:
+    def test_elevenlabs_first(self, client, operator_token, providers):
+        calls, _ = providers
+        res = client.post("/api/v1/voice/speak", json={"text": "Hola", "voice": "EXAVITQu4vr4xnSDxMaL"},
+                          headers=auth_header(operator_token))
+        assert res.status_code == 200
+        assert res.content == b"el-mp3"
+        assert calls == [(ELEVENLABS, "/v1/text-to-speech/EXAVITQu4vr4xnSDxMaL/stream")]
+
+    def test_falls_back_to_openai(self, client, operator_token, providers):
+        calls, responses = providers
+        responses[ELEVENLABS] = httpx.Response(500, text="boom")
+        res = client.post("/api/v1/voice/speak", json={"text": "Hola", "voice": "EXAVITQu4vr4xnSDxMaL"},
+                          headers=auth_header(operator_token))
+        assert res.content == b"oai-mp3"
+        assert [p for p, _ in calls] == [ELEVENLABS, OPENAI]
+
+
+def _streamed(*chunks, fail_after=None):
+    """Provider response whose body arrives in *chunks* (optionally breaking mid-way)."""
+    async def body():
+        for i, chunk in enumerate(chunks):
+            if i == fail_after:
+                raise httpx.ReadError("connection reset")
+            yield chunk
+    return lambda: httpx.Response(200, content=body())
+
+
+class TestSpeakStreaming:
+    def test_chunks_are_relayed(self, client, operator_token, providers):
+        _, responses = providers
+        responses[ELEVENLABS] = _streamed(b"ID3", b"frame-1", b"frame-2")
+        with client.stream("POST", "/api/v1/voice/speak", json={"text": "Hola"},
+                           headers=auth_header(operator_token)) as res:
+            assert res.status_code == 200
+            assert res.headers["Content-Encoding"] == "identity"
+            assert b"".join(res.iter_bytes()) == b"ID3frame-1frame-2"
+
+    def test_falls_back_when_first_provider_breaks_before_first_byte(self, client, operator_token, providers):
+        calls, responses = providers
+        responses[ELEVENLABS] = _streamed(b"ID3", fail_after=0)
+        res = client.post("/api/v1/voice/speak", json={"text": "Hola"}, headers=auth_header(operator_token))
+        assert res.content == b"oai-mp3"
+        assert [p for p, _ in calls] == [ELEVENLABS, OPENAI]
+
+    def test_no_fallback_once_audio_started(self, client, operator_token, providers, tmp_path, monkeypatch):
+        calls, responses = providers
+        cache = TTSCache(tmp_path, max_bytes=1024)
+        monkeypatch.setattr(voice_service, "tts_cache", cache)
+        responses[ELEVENLABS] = _streamed(b"ID3", b"frame-1", fail_after=1)
+        res = client.post("/api/v1/voice/speak", json={"text": "Hola"}, headers=auth_header(operator_token))
+        assert res.content == b"ID3"
+        assert [p for p, _ in calls] == [ELEVENLABS]
+        assert cache.snapshot()["entries"] == 0   # l'àudio tallat no es desa
+
+    def test_both_providers_fail(self, client, operator_token, providers):
+        _, responses = providers
+        responses[ELEVENLABS] = httpx.Response(500, text="boom")
+        responses[OPENAI] = httpx.Response(429, text="slow down")
+        res = client.post("/api/v1/voice/speak", json={"text": "Hola"}, headers=auth_header(operator_token))
+        assert res.status_code == 502
+
+
+class TestProviderFailover:
+    def _speak(self, client, token):
+        return client.post("/api/v1/voice/speak", json={"text": "Hola", "voice": "EXAVITQu4vr4xnSDxMaL"},
+                           headers=auth_header(token))
+
+    def test_unhealthy_provider_is_skipped(self, client, operator_token, providers):
+        calls, responses = providers
+        responses[ELEVENLABS] = httpx.Response(503, text="down")
+        for _ in range(settings.PROVIDER_FAILURE_THRESHOLD):
+            assert self._speak(client, operator_token).content == b"oai-mp3"
+        calls.clear()
+        assert self._speak(client, operator_token).content == b"oai-mp3"
+        assert [p for p, _ in calls] == [OPENAI]
+        status = http_clients.provider_status()[ELEVENLABS]
+        assert (status["state"], status["skipped"]) == ("unhealthy", 1)
+
+    def test_client_errors_do_not_mark_provider_unhealthy(self, client, operator_token, providers):
+        _, responses = providers
+        responses[ELEVENLABS] = httpx.Response(400, text="voice_not_found")
+        for _ in range(settings.PROVIDER_FAILURE_THRESHOLD + 1):
+            assert self._speak(client, operator_token).content == b"oai-mp3"
+        status = http_clients.provider_status()[ELEVENLABS]
+        assert (status["state"], status["consecutive_failures"]) == ("healthy", 0)
+
+    def test_stalled_provider_times_out_to_fallback(self, client, operator_token, providers, monkeypatch):
+        _, responses = providers
+        monkeypatch.setattr(settings, "VOICE_TTS_FIRST_BYTE_TIMEOUT", 0.1)
+
+        async def stalled():
+            await asyncio.sleep(5)
+            yield b"late"
+
+        responses[ELEVENLABS] = lambda: httpx.Response(200, content=stalled())
+        start = time.perf_counter()
+        assert self._speak(client, operator_token).content == b"oai-mp3"
+        assert time.perf_counter() - start < 2
+        assert http_clients.health[ELEVENLABS].snapshot()["consecutive_failures"] == 1
+
+    def test_background_probe_restores_provider(self, client, operator_token, providers):
+        calls, responses = providers
+        responses[ELEVENLABS] = httpx.Response(503, text="down")
+        for _ in range(settings.PROVIDER_FAILURE_THRESHOLD):
+            self._speak(client, operator_token)
+        responses[ELEVENLABS] = httpx.Response(200, content=b"el-mp3")
+        asyncio.run(http_clients.probe_unhealthy())
+        assert calls[-1] == (ELEVENLABS, "/v1/models")
+        assert self._speak(client, operator_token).content == b"el-mp3"
+
+    def test_status_lists_providers(self, client, admin_token):
+        res = client.get("/api/v1/monitoring/status", headers=auth_header(admin_token))
+        assert set(res.json()["providers"]) == {OPENAI, ELEVENLABS}
+
+
+class TestPresynthesis:
+    def _run(self, *texts, speak_text="Ajudin-me, si us plau."):
+        """Pre-synthesises *texts* and then asks /voice/speak, all on one event loop."""
+        async def run(token):
+            for text in texts:
+                voice_service.presynthesize(text, "nova")
+            transport = httpx.ASGITransport(app=app)
+            async with httpx.AsyncClient(transport=transport, base_url="http://test") as ac:
+                return await ac.post("/api/v1/voice/speak", json={"text": speak_text, "voice": "nova"},
+                                     headers=auth_header(token))
+        return run
+
+    def test_speak_waits_for_inflight_synthesis(self, operator_token, providers):
+        calls, responses = providers
+
+        async def slow():
+            await asyncio.sleep(0.1)
+            yield b"el-mp3"
+
+        responses[ELEVENLABS] = lambda: httpx.Response(200, content=slow())
+        res = asyncio.run(self._run("Ajudin-me, si us plau.")(operator_token))
+        assert res.content == b"el-mp3"
+        assert res.headers["X-TTS-Cache"] == "presynthesized"
+        assert len(calls) == 1
+
+    def test_other_text_synthesised_live(self, operator_token, providers):
+        calls, _ = providers
+        res = asyncio.run(self._run("Una altra frase.")(operator_token))
+        assert res.headers["X-TTS-Cache"] == "miss"
+        assert len(calls) == 2
+
+    def test_failed_presynthesis_falls_back(self, operator_token, providers, monkeypatch):
+        calls, responses = providers
+        attempts = iter([httpx.Response(500, text="boom"), httpx.Response(200, content=b"el-mp3")])
+        responses[ELEVENLABS] = lambda: next(attempts)
+        monkeypatch.setattr(settings, "DispatchSimKeyOpenAI", "")
+        res = asyncio.run(self._run("Ajudin-me, si us plau.")(operator_token))
+        assert res.status_code == 200
+        assert res.content == b"el-mp3"
+        assert len(calls) == 2
+
+
+class TestTranscribe:
+    def _post(self, client, token, content, name="a.webm", mime="audio/webm"):
+        return client.post("/api/v1/voice/transcribe", files={"audio": (name, content, mime)},
+                           headers=auth_header(token))
+
+    def test_transcribes_webm(self, client, operator_token, providers):
+        calls, responses = providers
+        responses[OPENAI] = httpx.Response(200, json={"text": "Hi ha foc a la cuina del veí"})
+        res = self._post(client, operator_token, webm_clip())
+        assert res.json() == {"text": "Hi ha foc a la cuina del veí"}
+        assert calls == [(OPENAI, "/v1/audio/transcriptions")]
+
+    def test_hallucination_is_dropped(self, client, operator_token, providers):
+        _, responses = providers
+        responses[OPENAI] = httpx.Response(200, json={"text": "Thank you for watching!"})
+        res = self._post(client, operator_token, webm_clip())
+        assert res.json() == {"text": ""}
+
+    def test_rejects_non_webm(self, client, operator_token, providers):
+        res = self._post(client, operator_token, b"RIFF" + b"\x00" * 32, "a.wav", "audio/wav")
+        assert res.status_code == 415
+
+    def test_short_clip_rejected_before_whisper(self, client, operator_token, providers):
+        calls, _ = providers
+        res = self._post(client, operator_token, webm_clip(duration_ms=200))
+        assert res.status_code == 422
+        assert calls == []
+
+    def test_clip_without_audio_track(self, client, operator_token, providers):
+        calls, _ = providers
+        res = self._post(client, operator_token, webm_clip(audio=False))
+        assert res.status_code == 415
+        assert calls == []
+
+    def test_oversized_upload_rejected(self, client, operator_token, providers):
+        calls, _ = providers
+        clip = webm_clip() + b"\x00" * voice_service.MAX_AUDIO_BYTES
+        res = self._post(client, operator_token, clip)
+        assert res.status_code == 413
+        assert calls == []
+
+    def test_oversized_stream_without_length(self, client, operator_token, providers):
+        # Cos per trossos (sense Content-Length): es talla en passar el límit
+        boundary = "xyz"
+        head = (f'--{boundary}\r\nContent-Disposition: form-data; name="audio"; filename="a.webm"\r\n'
+                'Content-Type: audio/webm\r\n\r\n').encode()
+
+        def body():
+            yield head
+            for _ in range(8):
+                yield b"\x00" * (1024 * 1024)
+
+        res = client.post("/api/v1/voice/transcribe", content=body(), headers={
+            **auth_header(operator_token), "Content-Type": f"multipart/form-data; boundary={boundary}",
+        })
+        assert res.status_code == 413
+
+    def test_missing_audio_field(self, client, operator_token, providers):
+        res = client.post("/api/v1/voice/transcribe", files={"other": ("a.webm", webm_clip(), "audio/webm")},
+                          headers=auth_header(operator_token))
+        assert res.status_code == 422
+
+
+class TestTranscriptionCache:
+    def _post(self, client, token, content, lang="ca"):
+        return client.post(f"/api/v1/voice/transcribe?lang={lang}", files={"audio": ("a.webm", content, "audio/webm")},
+                           headers=auth_header(token))
+
+    def test_resend_served_from_cache(self, client, operator_token, providers, monkeypatch):
+        calls, responses = providers
+        # Un sol intent permès: el reenviament no ha de consumir límit
+        monkeypatch.setattr(voice_endpoints, "transcribe_limiter", GCRALimiter(max_calls=1, period_seconds=60))
+        responses[OPENAI] = httpx.Response(200, json={"text": "Hi ha foc a la cuina del veí"})
+        clip = webm_clip()
+        first = self._post(client, operator_token, clip)
+        second = self._post(client, operator_token, clip)
+        assert first.json() == second.json() == {"text": "Hi ha foc a la cuina del veí"}
+        assert len(calls) == 1
+
+    def test_hallucination_verdict_is_cached(self, client, operator_token, providers):
+        calls, responses = providers
+        responses[OPENAI] = httpx.Response(200, json={"text": "Thank you for watching!"})
+        clip = webm_clip()
+        assert self._post(client, operator_token, clip).json() == {"text": ""}
+        assert self._post(client, operator_token, clip).json() == {"text": ""}
+        assert len(calls) == 1
+
+    def test_language_is_part_of_key(self, client, operator_token, providers):
+        calls, responses = providers
+        responses[OPENAI] = httpx.Response(200, json={"text": "Hi ha foc a la cuina del veí"})
+        clip = webm_clip()
+        self._post(client, operator_token, clip, lang="ca")
+        self._post(client, operator_token, clip, lang="es")
+        assert len(calls) == 2
+
+    def test_failures_are_not_cached(self, client, operator_token, providers):
+        calls, responses = providers
+        responses[OPENAI] = httpx.Response(500, text="boom")
+        clip = webm_clip()
+        assert self._post(client, operator_token, clip).status_code == 502
+        responses[OPENAI] = httpx.Response(200, json={"text": "Hi ha foc a la cuina del veí"})
+        assert self._post(client, operator_token, clip).json() == {"text": "Hi ha foc a la cuina del veí"}
+        assert len(calls) == 2
+
+
+class TestChunkedTranscription:
+    @pytest.fixture
+    def whisper(self, monkeypatch):
+        """Fake Whisper: answers each chunk with its start time, later chunks first."""
+        state = SimpleNamespace(calls=0, running=0, peak=0, texts={})
+
+        async def fake(audio, lang):
+            start = webm.probe(io.BytesIO(audio)).clusters[0][1] // 1000
+            state.calls += 1
+            state.running += 1
+            state.peak = max(state.peak, state.running)
+            await asyncio.sleep(0.05 / (1 + start))
+            state.running -= 1
+            return state.texts.get(start, f"Tros que comença al segon {start}")
+
+        monkeypatch.setattr(voice_service, "_whisper", fake)
+        monkeypatch.setattr(settings, "VOICE_CHUNKED_TRANSCRIPTION_SECONDS", 20.0)
+        monkeypatch.setattr(settings, "VOICE_CHUNK_SECONDS", 10.0)
+        monkeypatch.setattr(settings, "VOICE_CHUNK_MAX_PARALLEL", 2)
+        return state
+
+    def _transcribe(self, clip):
+        info = voice_service.check_audio(clip)
+        return asyncio.run(voice_service.transcribe(clip, "ca", info=info))
+
+    def test_long_clip_stitched_in_order(self, whisper):
+        text = self._transcribe(webm_clip(duration_ms=35_000, cluster_ms=5000))
+        assert text == ("Tros que comença al segon 0 Tros que comença al segon 10 "
+                        "Tros que comença al segon 20 Tros que comença al segon 30")
+        assert whisper.calls == 4
+        assert whisper.peak == 2
+
+    def test_hallucination_filtered_per_chunk(self, whisper):
+        whisper.texts[10] = "Thank you for watching!"
+        text = self._transcribe(webm_clip(duration_ms=25_000, cluster_ms=5000))
+        assert text == "Tros que comença al segon 0 Tros que comença al segon 20"
+
+    def test_short_clip_sent_whole(self, whisper):
+        self._transcribe(webm_clip(duration_ms=15_000, cluster_ms=5000))
+        assert whisper.calls == 1
+
+
+@pytest.fixture
+def disk_cache(tmp_path, monkeypatch):
+    cache = TTSCache(tmp_path, max_bytes=1024)
+    monkeypatch.setattr(voice_service, "tts_cache", cache)
+    return cache
+
+
+class TestTTSCache:
+    def test_lru_eviction_by_size(self, tmp_path):
+        cache = TTSCache(tmp_path, max_bytes=100)
+        keys = [speech_key("openai", "tts-1-hd", "nova", None, str(i)) for i in range(3)]
+        cache.put(keys[0], b"a" * 40)
+        cache.put(keys[1], b"b" * 40)
+        assert cache.get(keys[0]) is not None   # keys[1] passa a ser la menys usada
+        cache.put(keys[2], b"c" * 40)
+        assert cache.get(keys[1]) is None
+        assert cache.get(keys[0]) == b"a" * 40
+        assert not (tmp_path / f"{keys[1]}.mp3").exists()
+
+    def test_index_survives_restart(self, tmp_path):
+        key = speech_key("openai", "tts-1-hd", "nova", None, "Hola")
+        TTSCache(tmp_path, max_bytes=100).put(key, b"mp3")
+        assert TTSCache(tmp_path, max_bytes=100).get(key) == b"mp3"
+
+    def test_key_depends_on_voice_settings(self):
+        base = speech_key("elevenlabs", "m", "v", {"stability": 0.5}, "Hola")
+        assert base != speech_key("elevenlabs", "m", "v", {"stability": 0.7}, "Hola")
+
+    def test_speak_hits_cache_on_repeat(self, client, operator_token, providers, disk_cache):
+        calls, _ = providers
+        body = {"text": "Hi ha foc!", "voice": "EXAVITQu4vr4xnSDxMaL"}
+        first = client.post("/api/v1/voice/speak", json=body, headers=auth_header(operator_token))
+        second = client.post("/api/v1/voice/speak", json=body, headers=auth_header(operator_token))
+        assert (first.headers["X-TTS-Cache"], second.headers["X-TTS-Cache"]) == ("miss", "hit")
+        assert second.content == first.content == b"el-mp3"
+        assert len(calls) == 1
+        assert second.headers["ETag"] == first.headers["ETag"]
+
+    def test_fallback_audio_not_cached_as_primary(self, client, operator_token, providers, disk_cache):
+        calls, responses = providers
+        responses[ELEVENLABS] = httpx.Response(500, text="boom")
+        body = {"text": "Hi ha foc!", "voice": "EXAVITQu4vr4xnSDxMaL"}
+        client.post("/api/v1/voice/speak", json=body, headers=auth_header(operator_token))
+        responses[ELEVENLABS] = httpx.Response(200, content=b"el-mp3")
+        res = client.post("/api/v1/voice/speak", json=body, headers=auth_header(operator_token))
+        assert res.content == b"el-mp3"
+
+    def test_cached_audio_supports_range_and_etag(self, client, operator_token, providers, disk_cache):
+        _, responses = providers
+        responses[ELEVENLABS] = httpx.Response(200, content=b"0123456789")
+        res = client.post("/api/v1/voice/speak", json={"text": "Hola", "voice": "EXAVITQu4vr4xnSDxMaL"},
+                          headers=auth_header(operator_token))
+        assert res.headers["Cache-Control"].startswith("private")
+        url = res.headers["Content-Location"]
+        assert url.startswith("/api/v1/voice/audio/")
+
+        headers = auth_header(operator_token)
+        partial = client.get(url, headers={**headers, "Range": "bytes=2-5", "Accept-Encoding": "gzip"})
+        assert partial.status_code == 206
+        assert partial.content == b"2345"
+        assert partial.headers["Cache-Control"].startswith("private")
+
+        etag = partial.headers["ETag"]
+        assert client.get(url, headers={**headers, "If-None-Match": etag}).status_code == 304
+        assert client.get("/api/v1/voice/audio/" + "0" * 64, headers=headers).status_code == 404
+
+    def test_cached_audio_requires_auth(self, client, operator_token, providers, disk_cache):
+        res = client.post("/api/v1/voice/speak", json={"text": "Hola", "voice": "EXAVITQu4vr4xnSDxMaL"},
+                          headers=auth_header(operator_token))
+        assert client.get(res.headers["Content-Location"]).status_code in (401, 403)
+
+    def test_no_content_location_without_disk_cache(self, client, operator_token, providers):
+        res = client.post("/api/v1/voice/speak", json={"text": "Hola", "voice": "EXAVITQu4vr4xnSDxMaL"},
+                          headers=auth_header(operator_token))
+        assert res.status_code == 200
+        assert "Content-Location" not in res.headers
@@ -0,0 +1,75 @@
+import io
+import struct
+
+import pytest
+
+from tests.conftest import ebml_element, webm_clip
+from app.services import webm
+
+
+def _probe(data: bytes) -> webm.WebMInfo:
+    return webm.probe(io.BytesIO(data))
+
+
+class TestProbe:
+    def test_mediarecorder_clip(self):
+        info = _probe(webm_clip(duration_ms=1500))
+        assert info.doc_type == "webm"
+        assert info.has_audio
+        assert info.tracks[0].codec == "A_OPUS"
+        assert info.duration == pytest.approx(1.5)
+
+    def test_declared_duration_wins(self):
+        header = ebml_element(0x1A45DFA3, ebml_element(0x4282, b"webm"))
+        info_el = ebml_element(0x1549A966, ebml_element(0x2AD7B1, (1_000_000).to_bytes(3, "big"))
+                        + ebml_element(0x4489, struct.pack(">d", 4200.0)))
+        assert _probe(header + ebml_element(0x18538067, info_el)).duration == pytest.approx(4.2)
+
+    def test_truncated_tail_is_tolerated(self):
+        clip = webm_clip(duration_ms=1000)
+        assert _probe(clip[:-5]).duration == pytest.approx(0.98)
+
+    def test_no_blocks_means_unknown_duration(self):
+        assert _probe(ebml_element(0x1A45DFA3, ebml_element(0x4282, b"webm"))).duration is None
+
+    def test_not_ebml(self):
+        with pytest.raises(webm.WebMError):
+            _probe(b"RIFF" + b"\x00" * 32)
+
+    def test_garbage_after_magic(self):
+        with pytest.raises(webm.WebMError):
+            _probe(webm.EBML_MAGIC + b"\x00" * 32)
+
+    def test_ebml_header_of_unknown_size(self):
+        with pytest.raises(webm.WebMError):
+            _probe(bytes.fromhex("1A45DFA3 01FFFFFFFFFFFFFF") + b"\x42\x82\x84webm")
+
+    def test_block_too_short_for_its_timecode(self):
+        clip = webm_clip(duration_ms=1000)
+        # SimpleBlock de 2 bytes al final: pista (1 byte) i mig timecode
+        with pytest.raises(webm.WebMError):
+            _probe(clip + ebml_element(0xA3, b"\x81\x00"))
+
+
+class TestSplit:
+    def test_cuts_between_clusters(self):
+        clip = webm_clip(duration_ms=25_000, cluster_ms=5000)
+        pieces = webm.split(io.BytesIO(clip), _probe(clip), max_seconds=10)
+        infos = [_probe(piece) for piece in pieces]
+        assert [info.clusters[0][1] for info in infos] == [0, 10_000, 20_000]
+        assert all(info.has_audio for info in infos)
+
+    def test_known_segment_size_becomes_unknown(self):
+        clip = webm_clip(duration_ms=12_000, cluster_ms=5000)
+        info = _probe(clip)
+        at, length = info.segment_size
+        body = clip[at + length:]
+        sized = clip[:at] + (0x10 << 24 | len(body)).to_bytes(4, "big") + body
+        pieces = webm.split(io.BytesIO(sized), _probe(sized), max_seconds=5)
+        assert len(pieces) == 3
+        assert _probe(pieces[1]).duration == pytest.approx(4.98)
+        assert pieces[0][at:at + 4] == b"\x1f\xff\xff\xff"
+
+    def test_single_cluster_is_not_split(self):
+        clip = webm_clip(duration_ms=3000)
+        assert webm.split(io.BytesIO(clip), _probe(clip), max_seconds=1) == []